@@ -0,0 +1,166 @@
+"""
+Upload of avatars of users.
+
+- <AvatarUploadHandler> keeps the uploaded file in memory and stops the upload
+  as soon as the file is larger than AVATAR_MAX_BYTES: the rest of the body is
+  skipped, not buffered (requests with larger Content-Length are rejected
+  before reading of the body, see the view <upload_user_avatar_view>);
+- the request thread reads the header of the image only (format and
+  dimensions, decompression bombs are rejected);
+- decoding and resizing to AVATAR_SIZE x AVATAR_SIZE (JPEG, the center of the
+  image is cropped) are done by the thread pool of the process, the response
+  is sent before it;
+- the new file replaces the avatar of the profile in one transaction, the
+  previous file is deleted after the commit (old avatars are not kept in
+  media/users/).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from megano_store.settings import (AVATAR_FORMATS, AVATAR_MAX_BYTES, AVATAR_MAX_PIXELS,
+                                   AVATAR_QUALITY, AVATAR_SIZE, AVATAR_WORKERS)
+from megano_store.utils import write_errors
+from .models import Profile
+
+FIELD_NAME = "avatar"
+FORM_OVERHEAD = 16 * 1024  # boundaries and headers of multipart form (bytes)
+
+_lock = threading.Lock()
+_executor = None
+
+
+class AvatarUploadHandler(FileUploadHandler):
+    """
+    Upload handler of the view <upload_user_avatar_view> (see the top of the module).
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.too_large = False
+        self.buffer = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        if field_name != FIELD_NAME:
+            raise SkipFile()
+        super().new_file(field_name, *args, **kwargs)
+        self.buffer = BytesIO()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > AVATAR_MAX_BYTES:
+            self.too_large = True
+            # the rest of the body is read and skipped, the client gets the response
+            raise StopUpload(connection_reset=False)
+        self.buffer.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.buffer.seek(0)
+        return InMemoryUploadedFile(
+            file=self.buffer,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+
+def check_image(file) -> str | None:
+    """
+    Read the header of the image (the image is not decoded).
+    :return: error or None
+    """
+    try:
+        with Image.open(file) as image:
+            image_format, (width, height) = image.format, image.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return "File is not an image."
+    finally:
+        file.seek(0)
+
+    if image_format not in AVATAR_FORMATS:
+        return f"Format <{image_format}> is not supported, " \
+               f"allowed formats: {', '.join(AVATAR_FORMATS)}."
+    if width * height > AVATAR_MAX_PIXELS:
+        return f"Image is too large: {width} x {height} pixels."
+    return None
+
+
+def resize_image(content: bytes) -> bytes:
+    """
+    :return: JPEG AVATAR_SIZE x AVATAR_SIZE (transparent pixels are white)
+    """
+    with Image.open(BytesIO(content)) as image:
+        # JPEG is decoded at reduced scale, which is not less than needed
+        image.draft("RGB", (AVATAR_SIZE, AVATAR_SIZE))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":  # palette, grayscale, CMYK, transparency
+            image = image.convert("RGBA")
+        image = ImageOps.fit(image, (AVATAR_SIZE, AVATAR_SIZE), Image.Resampling.LANCZOS)
+
+    if image.mode == "RGBA":
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+
+    output = BytesIO()
+    image.save(output, "JPEG", quality=AVATAR_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def set_avatar(user_id: int, content: bytes) -> None:
+    """
+    Resize the image and replace the avatar of the user (task of the thread pool).
+    :param user_id: ID of the user
+    :param content: uploaded file
+    """
+    new_name = ""
+    try:
+        data = resize_image(content)
+
+        with transaction.atomic():
+            profile = Profile.objects.select_related("belong_to_user").get(
+                belong_to_user_id=user_id
+            )
+            old_name = profile.avatar.name
+            profile.avatar.save("avatar.jpg", ContentFile(data), save=False)
+            new_name = profile.avatar.name
+            profile.save(update_fields=["avatar"])
+
+            if old_name:
+                transaction.on_commit(lambda: default_storage.delete(old_name),
+                                      robust=True)
+
+    except Exception as exc:
+        if new_name:  # the file of the rolled back avatar
+            default_storage.delete(new_name)
+        write_errors({"AvatarError": f"{type(exc).__name__} : {exc}",
+                      "user_id": user_id}, "errors_from_avatars.log")
+    finally:
+        connections.close_all()  # connections of this thread
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool of the process: it is created at the first upload, so threads
+    are not created in the master process of gunicorn before fork.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=AVATAR_WORKERS,
+                                           thread_name_prefix="avatar")
+    return _executor
+
+
+def schedule_avatar(user_id: int, file) -> None:
+    get_executor().submit(set_avatar, user_id, file.read())
@@ -4,6 +4,8 @@ from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
 
+from megano_store.settings import AVATAR_MAX_BYTES
+
 User = get_user_model()
 
 
@@ -16,9 +18,9 @@ phone_validator = RegexValidator(
 
 
 def validate_avatar_size(avatar):
-    max_size_mb = 2
-    if avatar.size > max_size_mb * 1024 * 1024:
-        raise ValidationError(f"File size must not exceed {max_size_mb} MB.")
+    max_size_mb = AVATAR_MAX_BYTES / 1024 / 1024
+    if avatar.size > AVATAR_MAX_BYTES:
+        raise ValidationError(f"File size must not exceed {max_size_mb:g} MB.")
 
 
 def user_avatar_path(instance: "Profile", filename: str) -> str:
@@ -46,6 +48,7 @@ class Profile(models.Model):
         max_length=14,
         blank=True,
         default="",
+        db_index=True,  # uniqueness is checked by the profile view
     )
 
     def __str__(self):
@@ -9,4 +9,3 @@ from .models import Profile
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(belong_to_user=instance)
-
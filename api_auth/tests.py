@@ -1,3 +1,96 @@
-# from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+
+from megano_store.ratelimit import take_tokens
+from megano_store.settings import RATE_LIMITS
+from megano_store.testing import test_settings
+from .models import Profile
+
+User = get_user_model()
+
+
+@mock.patch("megano_store.ratelimit.time.time")
+class TokenBucketTest(SimpleTestCase):
+
+    def setUp(self):
+        self.limit = RATE_LIMITS["auth"]["limit"]
+        self.period = RATE_LIMITS["auth"]["period"]
+
+    def take(self, buckets: dict, keys: list) -> tuple:
+        updated, retry_after = take_tokens(buckets, keys, "auth")
+        if updated is not None:
+            buckets.update(updated)
+        return updated, retry_after
+
+    def test_burst_is_limited(self, now):
+        now.return_value = 1000.0
+        buckets = {}
+
+        for _ in range(self.limit):
+            self.assertIsNotNone(self.take(buckets, ["a"])[0])
+
+        updated, retry_after = self.take(buckets, ["a"])
+        self.assertIsNone(updated)
+        self.assertEqual(retry_after, self.period // self.limit)
+
+    def test_bucket_is_refilled(self, now):
+        now.return_value = 1000.0
+        buckets = {"a": (0, 1000.0)}
+        self.assertIsNone(self.take(buckets, ["a"])[0])
+
+        now.return_value += self.period / self.limit
+        self.assertIsNotNone(self.take(buckets, ["a"])[0])
+        self.assertIsNone(self.take(buckets, ["a"])[0])
+
+        # the bucket is not refilled over its size
+        now.return_value += self.period * 10
+        for _ in range(self.limit):
+            self.assertIsNotNone(self.take(buckets, ["a"])[0])
+        self.assertIsNone(self.take(buckets, ["a"])[0])
+
+    def test_every_bucket_is_checked(self, now):
+        now.return_value = 1000.0
+        buckets = {"ip": (5, 1000.0), "username": (0.5, 1000.0)}
+
+        updated, retry_after = self.take(buckets, ["ip", "username"])
+
+        self.assertIsNone(updated)
+        self.assertGreater(retry_after, 0)
+        self.assertEqual(buckets["ip"], (5, 1000.0))  # the token is not taken
+
+
+@test_settings
+class SignInUpTest(TestCase):
+
+    def sign(self, action: str, ip: str = "10.0.0.1", **data):
+        return self.client.post(f"/api/sign-{action}", json.dumps(data),
+                                content_type="application/json",
+                                HTTP_X_REAL_IP=ip)
+
+    def test_sign_up_creates_one_profile(self):
+        response = self.sign("up", username="new_user", password="Secret-123",
+                             name="New")
+
+        self.assertEqual(response.status_code, 201)
+        user = User.objects.get(username="new_user")
+        self.assertEqual(Profile.objects.filter(belong_to_user=user).count(), 1)
+
+    def test_password_guessing_is_limited(self):
+        User.objects.create_user(username="victim", password="Secret-123")
+        limit = RATE_LIMITS["auth"]["limit"]
+
+        # buckets of the name: new addresses do not help
+        statuses = [self.sign("in", ip=f"10.0.0.{i}", username="victim",
+                              password="wrong").status_code
+                    for i in range(limit + 1)]
+
+        self.assertEqual(statuses, [400] * limit + [429])
+        response = self.sign("in", ip="10.0.1.1", username="victim",
+                             password="Secret-123")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(self.sign("in", ip="10.0.1.1", username="other",
+                                   password="wrong").status_code, 400)
@@ -4,10 +4,14 @@ import json
 from django.contrib.auth import authenticate, get_user_model, login, logout
 from django.contrib.auth.password_validation import validate_password
 from django.http import HttpRequest, JsonResponse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
+from .avatars import FORM_OVERHEAD, AvatarUploadHandler, check_image, schedule_avatar
 from .models import Profile
 from api_order.cart import save_session_cart_to_db
 from api_order.models import Order
+from megano_store.ratelimit import rate_limit
+from megano_store.settings import AVATAR_MAX_BYTES
 from megano_store.utils import apply_exception_handler, get_user_fullname, write_errors
 
 User = get_user_model()
@@ -26,8 +30,12 @@ def if_session_order_exists(request: HttpRequest, user: User,
       (used in function <save_session_cart_to_db>).
     :return: None
     """
-    order = Order.objects.filter(session_key=request.session.session_key,
-                                 user__isnull=True).first()
+    order = None
+    session_key = request.session.session_key
+
+    if session_key:  # index <session_key, user> of model Order is used
+        order = Order.objects.filter(session_key=session_key,
+                                     user__isnull=True).first()
     if order:
         order.user = user
         order.session_key = None
@@ -41,6 +49,7 @@ def if_session_order_exists(request: HttpRequest, user: User,
 
 
 @apply_exception_handler
+@rate_limit("auth")
 def user_register_or_login_view(request: HttpRequest) -> JsonResponse:
     """
     Register or log in user. Previously invoke functions:
@@ -75,7 +84,7 @@ def user_register_or_login_view(request: HttpRequest) -> JsonResponse:
                     user = User.objects.create_user(username=username,
                                                     password=password,
                                                     first_name=firstname)
-                    Profile.objects.create(belong_to_user=user)
+                    # profile is created by the signal (see signals.py)
 
                     if_session_order_exists(request,user, True)
 
@@ -153,6 +162,7 @@ def user_profile_view(request: HttpRequest) -> JsonResponse|None:
             curr_user.last_name = full_name[1]
 
         email = data.get("email").strip()
+        # index of auth_user.email is created by SQL (see README, 2.8)
         if User.objects.filter(email=email).exists():
             errors["UserEmailError"] = f"Email <{email}> already exists."
 
@@ -175,6 +185,7 @@ def user_profile_view(request: HttpRequest) -> JsonResponse|None:
 
 
 @apply_exception_handler
+@rate_limit("auth")
 def change_user_password_view(request: HttpRequest) -> JsonResponse:
 
     curr_user = request.user
@@ -197,19 +208,51 @@ def change_user_password_view(request: HttpRequest) -> JsonResponse:
         return JsonResponse(errors, status=400)
 
 
+@csrf_exempt
 @apply_exception_handler
 def upload_user_avatar_view(request: HttpRequest) -> JsonResponse:
+    """
+    Upload new avatar of the user (see api_auth/avatars.py).
+    CSRF token is checked by <upload_avatar> after the upload handler is set:
+    the middleware would read the body by default handlers.
+    :param request: HttpRequest
+    :return: JsonResponse
+    """
+    if int(request.META.get("CONTENT_LENGTH") or 0) > AVATAR_MAX_BYTES + FORM_OVERHEAD:
+        return avatar_too_large()
+
+    request.upload_handlers = [AvatarUploadHandler(request)]
+    return upload_avatar(request)
+
+
+@csrf_protect
+def upload_avatar(request: HttpRequest) -> JsonResponse:
 
     new_avatar = request.FILES.get("avatar")
 
+    if request.upload_handlers[0].too_large:
+        return avatar_too_large()
+
     if new_avatar:
-        profile = request.user.profile
-        profile.avatar = new_avatar
-        profile.save()
-        return JsonResponse({"Success": "New avatar has been set."}, status=201)
+        error = check_image(new_avatar)
+        if error:
+            errors = {"UploadError": error}
+            write_errors(errors, "errors_from_if.log")
+            return JsonResponse(errors, status=400)
+
+        # the image is resized and saved in the background
+        schedule_avatar(request.user.profile.belong_to_user_id, new_avatar)
+        return JsonResponse({"Success": "New avatar is accepted, it is being processed."},
+                            status=202)
 
     else:
         errors = {"UploadError": "New avatar file has not been uploaded."}
         write_errors(errors, "errors_from_if.log")
         return JsonResponse(errors, status=400)
 
+
+def avatar_too_large() -> JsonResponse:
+    errors = {"UploadError": "File size must not exceed "
+                             f"{AVATAR_MAX_BYTES / 1024 / 1024:g} MB."}
+    write_errors(errors, "errors_from_if.log")
+    return JsonResponse(errors, status=413)
@@ -1,20 +1,31 @@
 
+from datetime import timedelta
+
+from django import forms
 from django.contrib import admin
+from django.db.models import Sum
+from django.utils import timezone
 
-from .models import Cart, CartItem, Order, OrderItem
+from megano_store.admin_utils import EstimatedCountPaginator
+from megano_store.routers import ReadOnlyChangeListMixin
+from .models import (Cart, CartItem, Order, OrderItem, OrderStatusLog,
+                     SalesRollup, ProductSalesRollup, CategorySalesRollup, StatusRollup,
+                     ROLLUP_PERIOD_DAY)
 
 
 class CartItemInline(admin.TabularInline):
     model = CartItem
     extra = 1
+    autocomplete_fields = ("product",)
 
 
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
 
     list_display = ("id", "user", "created_at",)
     list_display_links = ("id", "user",)
     search_fields = ("user__username",)
+    autocomplete_fields = ("user",)
     readonly_fields = ("id", "created_at",)
     ordering = ("id",)
 
@@ -30,14 +41,56 @@ class CartAdmin(admin.ModelAdmin):
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 1
+    autocomplete_fields = ("product",)
+
+
+class OrderStatusLogInline(admin.TabularInline):
+    model = OrderStatusLog
+    extra = 0
+    can_delete = False
+    readonly_fields = ("status_from", "status_to", "changed_by", "created_at",)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("changed_by")
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class OrderAdminForm(forms.ModelForm):
+    class Meta:
+        model = Order
+        fields = "__all__"
+
+    def clean_status(self):
+        """
+        Field <status> is validated by state machine of the order
+        (see ORDER_STATUS_TRANSITIONS in models.py).
+        """
+        status = self.cleaned_data["status"]
+        if (status != self.instance.status
+                and not self.instance.can_change_status(status)):
+            raise forms.ValidationError(
+                f"Transition from status <{self.instance.status}> "
+                f"to <{status}> is not allowed."
+            )
+        return status
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
 
+    form = OrderAdminForm
     list_display = ("id", "user", "status", "created_at",)
     list_display_links = ("id", "user",)
-    search_fields = ("delivery_city", "delivery_address",)
+    list_filter = ("status",)  # index <status, created_at> is used
+    list_select_related = ("user",)
+    # search by beginning: <LIKE 'term%'> uses indexes with collation NOCASE
+    search_fields = ("=id", "^delivery_city", "^delivery_address",)
+    search_help_text = "ID of the order, beginning of the city or the address."
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    autocomplete_fields = ("user",)
     readonly_fields = ("id", "created_at", "session_key",)
     ordering = ("id",)
 
@@ -60,5 +113,65 @@ class OrderAdmin(admin.ModelAdmin):
         }),
     ]
 
-    inlines = [OrderItemInline,]
-
+    inlines = [OrderItemInline, OrderStatusLogInline,]
+
+    def save_model(self, request, obj, form, change):
+        if "status" in form.changed_data:
+            status = obj.status
+            obj.status = form.initial.get("status") or ""
+            if not change:
+                super().save_model(request, obj, form, change)
+            obj.change_status(status, request.user)
+        super().save_model(request, obj, form, change)
+
+
+
+@admin.register(SalesRollup)
+class SalesRollupAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
+    """
+    Read-only dashboard of sales. Only rollup tables are queried
+    (see rollup.py), tables of orders are not touched.
+    """
+    change_list_template = "admin/api_order/salesrollup/change_list.html"
+    dashboard_days = 30
+    top_limit = 10
+
+    list_display = ("period_start", "period", "orders_count", "units", "revenue",)
+    list_filter = ("period",)
+    date_hierarchy = "period_start"
+    ordering = ("-period_start",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        date_from = timezone.now() - timedelta(days=self.dashboard_days)
+        lookup = {"period": ROLLUP_PERIOD_DAY, "period_start__gte": date_from}
+
+        extra_context = extra_context or {}
+        extra_context["dashboard_days"] = self.dashboard_days
+        extra_context["top_products"] = (
+            ProductSalesRollup.objects.filter(**lookup)
+            .values("product_id", "product__title")
+            .annotate(units_sum=Sum("units"), revenue_sum=Sum("revenue"))
+            .order_by("-units_sum")[:self.top_limit]
+        )
+        extra_context["top_categories"] = (
+            CategorySalesRollup.objects.filter(**lookup)
+            .values("category_id", "category__title")
+            .annotate(units_sum=Sum("units"), revenue_sum=Sum("revenue"))
+            .order_by("-units_sum")[:self.top_limit]
+        )
+        extra_context["statuses"] = (
+            StatusRollup.objects.filter(**lookup)
+            .values("status")
+            .annotate(orders_sum=Sum("orders_count"))
+            .order_by("status")
+        )
+        return super().changelist_view(request, extra_context=extra_context)
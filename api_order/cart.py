@@ -29,6 +29,7 @@ def get_cart(request: HttpRequest) -> list:
     if cart_session:
         products = Product.objects.filter(id__in=cart_session.keys())
         products = products.annotate(reviews_count=Count("reviews"))
+        products = products.prefetch_related("images", "tags")
 
         return format_queryset_to_list(products, cart_session)
 
@@ -46,6 +47,7 @@ def get_cart(request: HttpRequest) -> list:
 
                 products = Product.objects.filter(id__in=prod_count.keys())
                 products = products.annotate(reviews_count=Count("reviews"))
+                products = products.prefetch_related("images", "tags")
 
                 prod_list = format_queryset_to_list(products, prod_count)
 
@@ -90,6 +92,7 @@ def add_or_remove_session_cart(request: HttpRequest, action: int) -> list:
 
     products = Product.objects.filter(id__in=cart_session.keys())
     products = products.annotate(reviews_count=Count("reviews"))
+    products = products.prefetch_related("images", "tags")
 
     return format_queryset_to_list(products, cart_session)
 
@@ -112,9 +115,11 @@ def save_session_cart_to_db(request: HttpRequest, new_user: User = None) -> None
     else:
         cart, _ = Cart.objects.get_or_create(user=request.user)
 
+    products = Product.objects.in_bulk([int(prod_id) for prod_id in cart_session])
+
     for prod_id, quantity in cart_session.items():
 
-        product = Product.objects.get(id=int(prod_id))
+        product = products[int(prod_id)]
 
         if new_user is not None:
             if quantity > 0:
@@ -0,0 +1,125 @@
+
+import functools
+import hashlib
+from datetime import timedelta
+
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.utils import timezone
+
+from megano_store.settings import IDEMPOTENCY_HEADER, IDEMPOTENCY_KEY_TTL
+from megano_store.utils import write_errors
+from .models import IdempotencyKey
+
+
+def get_key_owner(request: HttpRequest) -> str:
+    """
+    Owner of the idempotency key: authenticated user or session of anonymous user.
+    :param request: HttpRequest
+    :return: string (user ID or session key), "" - anonymous user without session
+    """
+    if request.user.is_authenticated:
+        return "user_" + str(request.user.pk)
+    return request.session.session_key or ""
+
+
+def replay_response(record: IdempotencyKey) -> HttpResponse:
+    """
+    Compose response from the stored one (database is not changed).
+    :param record: instance of IdempotencyKey
+    :return: HttpResponse
+    """
+    response = HttpResponse(record.response_body,
+                            status=record.response_status,
+                            content_type="application/json")
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def delete_expired_keys() -> int:
+    """
+    Delete idempotency keys, which are older than IDEMPOTENCY_KEY_TTL.
+    :return: number of deleted keys
+    """
+    expired_before = timezone.now() - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=expired_before).delete()
+    return deleted
+
+
+def idempotent(scope: str):
+    """
+    This decorator is used for POST requests, which create orders or payments.
+    If the request has header <Idempotency-Key>, the response of the view is stored
+    (model IdempotencyKey), and the repeated request with the same key
+    gets the stored response without invoking the view
+    (models Order, OrderItem, Product are not touched).
+    The key row is written first, inside the same transaction as the view,
+    so concurrent duplicates wait for the first request and then get its response.
+    Responses with status 5xx and raised exceptions are not stored.
+    The path of the request is hashed with the body, so the same key for another
+    order is rejected, not replayed. Keys of anonymous users without session
+    are ignored: such clients cannot be told apart, they would get responses
+    of each other.
+    :param scope: name of the endpoint (the same key can be used for other endpoint)
+    :return: decorator
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(request: HttpRequest, *args, **kwargs):
+
+            key = request.headers.get(IDEMPOTENCY_HEADER, "").strip()
+
+            if request.method != "POST" or not key:
+                return func(request, *args, **kwargs)
+
+            if len(key) > 64:
+                errors = {"IdempotencyError":
+                    f"Header <{IDEMPOTENCY_HEADER}> is longer than 64 characters."}
+                write_errors(errors, "errors_from_if.log")
+                return JsonResponse(errors, status=400)
+
+            owner = get_key_owner(request)
+            if not owner:
+                return func(request, *args, **kwargs)
+
+            request_hash = hashlib.sha256(
+                request.path.encode("utf-8") + b"\n" + request.body
+            ).hexdigest()
+            expired_before = timezone.now() - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+
+            with transaction.atomic():
+                # write statement goes first: it takes the write lock of SQLite,
+                # so a concurrent duplicate waits here until this one is committed
+                IdempotencyKey.objects.filter(
+                    key=key, scope=scope, owner=owner, created_at__lt=expired_before
+                ).delete()
+
+                record, created = IdempotencyKey.objects.get_or_create(
+                    key=key, scope=scope, owner=owner,
+                    defaults={"request_hash": request_hash}
+                )
+
+                if not created:
+                    if record.request_hash != request_hash:
+                        errors = {"IdempotencyError":
+                            f"Key <{key}> is already used for another request."}
+                        write_errors(errors, "errors_from_if.log")
+                        return JsonResponse(errors, status=400)
+
+                    return replay_response(record)
+
+                response = func(request, *args, **kwargs)
+
+                if response.status_code >= 500:
+                    record.delete()
+                else:
+                    record.response_status = response.status_code
+                    record.response_body = response.content.decode("utf-8")
+                    record.save(update_fields=["response_status", "response_body"])
+
+                return response
+
+        return wrapper
+
+    return decorator
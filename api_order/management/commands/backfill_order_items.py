@@ -0,0 +1,49 @@
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api_order.models import OrderItem
+from api_product.models import Product
+
+
+class Command(BaseCommand):
+    help = ("Fill snapshot fields (price, title, image) of order items, "
+            "which were created before these fields were added. "
+            "Current data of products is used.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        updated = 0
+        last_pk = 0
+
+        while True:
+            items = list(
+                OrderItem.objects.filter(title="", pk__gt=last_pk).order_by("pk")[:batch_size]
+            )
+            if not items:
+                break
+            last_pk = items[-1].pk
+
+            products = Product.objects.prefetch_related("images").in_bulk(
+                {item.product_id for item in items}
+            )
+            for item in items:
+                product = products[item.product_id]
+                images = product.images.all()
+                first_image = images[0] if images else None
+
+                item.price = product.price
+                item.title = product.title
+                item.image = first_image.image.name if first_image else ""
+                item.image_alt = first_image.description if first_image else ""
+
+            with transaction.atomic():
+                OrderItem.objects.bulk_update(
+                    items, ["price", "title", "image", "image_alt"]
+                )
+            updated += len(items)
+
+        self.stdout.write(self.style.SUCCESS(f"Order items updated: {updated}"))
@@ -0,0 +1,12 @@
+
+from django.core.management.base import BaseCommand
+
+from api_order.idempotency import delete_expired_keys
+
+
+class Command(BaseCommand):
+    help = "Delete idempotency keys of orders and payments, which are expired."
+
+    def handle(self, *args, **options):
+        deleted = delete_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f"Expired idempotency keys deleted: {deleted}"))
@@ -0,0 +1,17 @@
+
+from django.core.management.base import BaseCommand
+
+from megano_store.sessions import delete_expired_sessions
+from megano_store.settings import SESSION_PURGE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Delete expired sessions by batches (every batch - one transaction, "
+            "so checkouts are not blocked).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=SESSION_PURGE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        deleted = delete_expired_sessions(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Expired sessions deleted: {deleted}"))
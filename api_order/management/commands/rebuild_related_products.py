@@ -0,0 +1,39 @@
+
+from django.core.management.base import BaseCommand
+
+from api_order.models import OrderItem, OrderStatusLog, ORDER_STATUS_PAID
+from api_product.recommendations import rebuild_neighbors
+
+
+def get_paid_baskets(chunk_size: int):
+    """
+    Generator of products of paid orders, orders are read by chunks.
+    :param chunk_size: number of orders in one chunk
+    :return: lists of ID of products (one list - one order)
+    """
+    order_ids = sorted(set(
+        OrderStatusLog.objects.filter(status_to=ORDER_STATUS_PAID)
+        .values_list("order_id", flat=True)
+    ))
+    for i in range(0, len(order_ids), chunk_size):
+        baskets = {}
+        items = OrderItem.objects.filter(
+            order_id__in=order_ids[i:i + chunk_size]
+        ).values_list("order_id", "product_id")
+
+        for order_id, product_id in items:
+            baskets.setdefault(order_id, []).append(product_id)
+
+        yield from baskets.values()
+
+
+class Command(BaseCommand):
+    help = ("Delete the index of products, which are frequently bought together, "
+            "and compute it again from the history of paid orders.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = rebuild_neighbors(get_paid_baskets(options["chunk_size"]))
+        self.stdout.write(self.style.SUCCESS(f"Related products are rebuilt: {created}"))
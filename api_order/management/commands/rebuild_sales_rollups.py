@@ -0,0 +1,19 @@
+
+from django.core.management.base import BaseCommand
+
+from api_order.rollup import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ("Delete sales rollups (days and hours) and compute them again "
+            "from the history of orders.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = rebuild_rollups(chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(
+            "Rollups are rebuilt (rows): " +
+            ", ".join(f"{name} - {count}" for name, count in created.items())
+        ))
@@ -1,8 +1,9 @@
 
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models.functions import Collate
 
-from api_product.models import Product
+from api_product.models import Category, Product
 
 User = get_user_model()
 
@@ -34,16 +35,66 @@ class CartItem(models.Model):
             return "Basket item for anonymous user"
 
 
+ORDER_STATUS_CREATED = "created"
+ORDER_STATUS_PENDING = "pending"
+ORDER_STATUS_PAID = "paid"
+ORDER_STATUS_DELIVERED = "delivered"
+ORDER_STATUS_CANCELLED = "cancelled"
+
+ORDER_STATUS_CHOICES = [
+    (ORDER_STATUS_CREATED, "Created"),
+    (ORDER_STATUS_PENDING, "Pending"),
+    (ORDER_STATUS_PAID, "Paid"),
+    (ORDER_STATUS_DELIVERED, "Delivered"),
+    (ORDER_STATUS_CANCELLED, "Cancelled"),
+]
+
+# Allowed transitions of the order state machine: {status_from: (status_to, ...)}.
+# <pending> -> <pending> is allowed, because the user can confirm the order again
+# (change delivery or payment options) before the payment.
+ORDER_STATUS_TRANSITIONS = {
+    "": (ORDER_STATUS_CREATED,),
+    ORDER_STATUS_CREATED: (ORDER_STATUS_PENDING, ORDER_STATUS_CANCELLED),
+    ORDER_STATUS_PENDING: (ORDER_STATUS_PENDING, ORDER_STATUS_PAID,
+                           ORDER_STATUS_CANCELLED),
+    ORDER_STATUS_PAID: (ORDER_STATUS_DELIVERED, ORDER_STATUS_CANCELLED),
+    ORDER_STATUS_DELIVERED: (),
+    ORDER_STATUS_CANCELLED: (),
+}
+
+
 class Order(models.Model):
+    """
+    Indexes:
+    - <user, created_at> - list of orders of the user (history of orders);
+    - <session_key, user> - search of the anonymous order at login or registration;
+    - <status, created_at> - lists of orders filtered by status (admin, reports);
+    - <delivery_city>, <delivery_address> with collation NOCASE - search of admin
+      by beginning (case insensitive <LIKE 'term%'> of SQLite uses them).
+    Field <status> must be changed only by method <change_status>.
+    """
     class Meta:
         default_related_name = "orders"
         ordering = ["created_at"]
         get_latest_by = "created_at"
+        indexes = [
+            models.Index(fields=["user", "created_at"],
+                         name="order_user_created_idx"),
+            models.Index(fields=["session_key", "user"],
+                         name="order_session_user_idx"),
+            models.Index(fields=["status", "created_at"],
+                         name="order_status_created_idx"),
+            models.Index(Collate("delivery_city", "NOCASE"),
+                         name="order_city_nocase_idx"),
+            models.Index(Collate("delivery_address", "NOCASE"),
+                         name="order_address_nocase_idx"),
+        ]
 
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
     session_key = models.CharField(max_length=48, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=24, null=True, blank=True, default="")
+    status = models.CharField(max_length=24, null=True, blank=True, default="",
+                              choices=ORDER_STATUS_CHOICES)
     delivery_type = models.CharField(max_length=32, null=True, blank=True, default="")
     delivery_city = models.CharField(max_length=32, null=True, blank=True, default="")
     delivery_address = models.TextField(null=True, blank=True, default="",
@@ -59,8 +110,64 @@ class Order(models.Model):
             return (f"Order ID {self.id} for anonymous user (session with key <" +
                     self.session_key + ">)")
 
+    def can_change_status(self, status: str) -> bool:
+        """
+        Check if transition from the current status to <status> is allowed.
+        :param status: new status of the order
+        :return: True or False
+        """
+        return status in ORDER_STATUS_TRANSITIONS.get(self.status or "", ())
+
+    def change_status(self, status: str, user: User = None) -> None:
+        """
+        Validate transition of the order to <status>, write it to the log
+        (model OrderStatusLog) and set new status. The order itself is not saved,
+        so this method must be invoked into <transaction.atomic> block
+        together with <order.save()>.
+        :param status: new status of the order
+        :param user: user, who changes status (None - anonymous user or system)
+        :return: None
+        """
+        if not self.can_change_status(status):
+            raise ValueError(f"Order {self.pk}: transition from status "
+                             f"<{self.status}> to <{status}> is not allowed.")
+
+        OrderStatusLog.objects.create(
+            order=self,
+            status_from=self.status or "",
+            status_to=status,
+            changed_by=user if user and user.is_authenticated else None,
+        )
+        self.status = status
+
+
+class OrderStatusLog(models.Model):
+    class Meta:
+        default_related_name = "statuslogs"
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["order", "created_at"],
+                         name="orderlog_order_created_idx"),
+        ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    status_from = models.CharField(max_length=24, blank=True, default="")
+    status_to = models.CharField(max_length=24, choices=ORDER_STATUS_CHOICES)
+    changed_by = models.ForeignKey(User, null=True, blank=True,
+                                   on_delete=models.SET_NULL,
+                                   related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return (f"Order {self.order_id}: <{self.status_from}> -> <{self.status_to}>")
+
 
 class OrderItem(models.Model):
+    """
+    Fields <price>, <title>, <image>, <image_alt> are snapshot of the product
+    at checkout (<image> - name of file of the first product image),
+    so the order is rendered without the live product and with price of purchase.
+    """
     class Meta:
         default_related_name = "orderitems"
         unique_together = ("order", "product")
@@ -68,6 +175,10 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveSmallIntegerField(default=1)
+    price = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    title = models.CharField(max_length=192, blank=True, default="")
+    image = models.CharField(max_length=160, blank=True, default="")
+    image_alt = models.CharField(max_length=128, blank=True, default="")
 
     def __str__(self):
         if self.order.user:
@@ -77,3 +188,99 @@ class OrderItem(models.Model):
             return (f"Item of order {self.order_id} for anonymous user " +
                     "(session with key <" + self.order.session_key + ">)")
 
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response of the request with header <Idempotency-Key>
+    (see idempotency.py). Key is unique for pair <scope, owner>, where
+    <scope> - name of the endpoint, <owner> - user ID or session key.
+    """
+    class Meta:
+        unique_together = ("key", "scope", "owner")
+
+    key = models.CharField(max_length=64)
+    scope = models.CharField(max_length=32)
+    owner = models.CharField(max_length=48, blank=True, default="")
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(default=200)
+    response_body = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Idempotency key <{self.key}> for <{self.scope}>"
+
+
+ROLLUP_PERIOD_DAY = "day"
+ROLLUP_PERIOD_HOUR = "hour"
+
+ROLLUP_PERIOD_CHOICES = [
+    (ROLLUP_PERIOD_DAY, "Day"),
+    (ROLLUP_PERIOD_HOUR, "Hour"),
+]
+
+
+class Rollup(models.Model):
+    """
+    Base model of the sales rollups: one row for period (day or hour),
+    which starts at <period_start>. Rows are updated incrementally
+    (see rollup.py and signals.py), raw tables of orders are not read for reports.
+    """
+    class Meta:
+        abstract = True
+
+    period = models.CharField(max_length=8, choices=ROLLUP_PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+
+
+class SalesRollup(Rollup):
+    class Meta:
+        unique_together = ("period", "period_start")
+        ordering = ["-period_start"]
+
+    orders_count = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"Sales for {self.period} from {self.period_start}"
+
+
+class ProductSalesRollup(Rollup):
+    class Meta:
+        unique_together = ("period", "period_start", "product")
+        indexes = [
+            models.Index(fields=["period", "period_start", "units"],
+                         name="prodrollup_period_units_idx"),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"Sales of product {self.product_id} for {self.period}"
+
+
+class CategorySalesRollup(Rollup):
+    class Meta:
+        unique_together = ("period", "period_start", "category")
+
+    category = models.ForeignKey(Category, null=True, blank=True,
+                                 on_delete=models.SET_NULL, related_name="+")
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"Sales of category {self.category_id} for {self.period}"
+
+
+class StatusRollup(Rollup):
+    class Meta:
+        unique_together = ("period", "period_start", "status")
+
+    status = models.CharField(max_length=24, choices=ORDER_STATUS_CHOICES)
+    orders_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Orders with status <{self.status}> for {self.period}"
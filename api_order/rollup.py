@@ -0,0 +1,212 @@
+
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from megano_store.utils import add_increments
+
+from .models import (Order, OrderItem, OrderStatusLog, SalesRollup, ProductSalesRollup,
+                     CategorySalesRollup, StatusRollup, ORDER_STATUS_PAID,
+                     ORDER_STATUS_DELIVERED, ROLLUP_PERIOD_DAY, ROLLUP_PERIOD_HOUR)
+
+# Rollups are updated incrementally:
+# - on every change of order status - StatusRollup (orders per status);
+# - when order becomes <paid> - SalesRollup, ProductSalesRollup, CategorySalesRollup.
+# Command <rebuild_sales_rollups> recomputes all rollups from the history of orders.
+
+
+def get_periods(moment: datetime) -> list:
+    """
+    Get starts of the day and the hour, which contain <moment> (in TIME_ZONE).
+    :param moment: datetime (aware)
+    :return: list of tuples (period, period_start)
+    """
+    moment = timezone.localtime(moment)
+    hour_start = moment.replace(minute=0, second=0, microsecond=0)
+    day_start = hour_start.replace(hour=0)
+
+    return [(ROLLUP_PERIOD_DAY, day_start), (ROLLUP_PERIOD_HOUR, hour_start)]
+
+
+def record_status_change(status: str, moment: datetime) -> None:
+    """
+    Count order, which gets <status>, in StatusRollup.
+    :param status: new status of order
+    :param moment: time of change of status
+    :return: None
+    """
+    add_increments(StatusRollup, ["period", "period_start", "status"], {
+        (period, period_start, status): {"orders_count": 1}
+        for period, period_start in get_periods(moment)
+    })
+
+
+def get_order_lines(order_ids: list) -> list:
+    """
+    Get items of orders (snapshot of price, see model OrderItem) with category
+    of products.
+    :param order_ids: list of ID of orders
+    :return: list of dictionaries
+    """
+    return list(OrderItem.objects.filter(order_id__in=order_ids).values(
+        "order_id", "product_id", "product__category_id", "quantity", "price"
+    ))
+
+
+def record_order_paid(order_id: int, moment: datetime) -> None:
+    """
+    Add paid order to SalesRollup, ProductSalesRollup and CategorySalesRollup.
+    :param order_id: ID of paid order
+    :param moment: time of payment
+    :return: None
+    """
+    lines = get_order_lines([order_id])
+    # increments are summed per row of rollup, every rollup is written by
+    # one statement (see <add_increments>)
+    sales = defaultdict(lambda: {"orders_count": 0, "units": 0, "revenue": Decimal(0)})
+    products = defaultdict(lambda: {"units": 0, "revenue": Decimal(0)})
+    categories = defaultdict(lambda: {"units": 0, "revenue": Decimal(0)})
+
+    for period, period_start in get_periods(moment):
+        sale = sales[(period, period_start)]
+        sale["orders_count"] += 1
+
+        for line in lines:
+            revenue = line["price"] * line["quantity"]
+            sale["units"] += line["quantity"]
+            sale["revenue"] += revenue
+
+            for rollup, key in ((products, line["product_id"]),
+                                (categories, line["product__category_id"])):
+                row = rollup[(period, period_start, key)]
+                row["units"] += line["quantity"]
+                row["revenue"] += revenue
+
+    add_increments(SalesRollup, ["period", "period_start"], sales)
+    add_increments(ProductSalesRollup, ["period", "period_start", "product"], products)
+    add_increments(CategorySalesRollup, ["period", "period_start", "category"],
+                   categories)
+
+
+def record_status_log(log: OrderStatusLog) -> None:
+    """
+    Add the change of order status to rollups (receiver of new log records).
+    :param log: instance of OrderStatusLog
+    :return: None
+    """
+    record_status_change(log.status_to, log.created_at)
+
+    if log.status_to == ORDER_STATUS_PAID:
+        record_order_paid(log.order_id, log.created_at)
+
+
+def rebuild_rollups(chunk_size: int = 1000) -> dict:
+    """
+    Delete all rollups and compute them again from the log of order statuses
+    (OrderStatusLog) and order items. Orders are processed by chunks.
+    Paid orders without log (created before the log was added) are counted
+    at the time of their creation.
+    The log is read up to its last record at the start (high-water mark).
+    Records, which are written during the rebuild, are added by receivers to
+    the old rows: they are applied again after the rows are recreated. The last
+    transaction holds the write lock of SQLite (<transaction_mode> IMMEDIATE),
+    so new payments wait for it and then update the new rows.
+    :param chunk_size: number of orders (log records) in one chunk
+    :return: dictionary with number of created rows for every rollup
+    """
+    sales = defaultdict(lambda: {"orders_count": 0, "units": 0, "revenue": Decimal(0)})
+    products = defaultdict(lambda: {"units": 0, "revenue": Decimal(0)})
+    categories = defaultdict(lambda: {"units": 0, "revenue": Decimal(0)})
+    statuses = defaultdict(lambda: {"orders_count": 0})
+
+    paid_at = {}  # {order_id: time of payment}
+    last_pk = 0
+    high_water = OrderStatusLog.objects.aggregate(Max("pk"))["pk__max"] or 0
+
+    while True:
+        logs = list(OrderStatusLog.objects.filter(
+            pk__gt=last_pk, pk__lte=high_water
+        ).order_by("pk").values(
+            "pk", "order_id", "status_to", "created_at"
+        )[:chunk_size])
+        if not logs:
+            break
+        last_pk = logs[-1]["pk"]
+
+        for log in logs:
+            for period, period_start in get_periods(log["created_at"]):
+                statuses[(period, period_start, log["status_to"])]["orders_count"] += 1
+            if log["status_to"] == ORDER_STATUS_PAID:
+                paid_at[log["order_id"]] = log["created_at"]
+
+    # orders, which are paid after the mark, have the log and are not legacy
+    legacy_orders = Order.objects.filter(
+        status__in=[ORDER_STATUS_PAID, ORDER_STATUS_DELIVERED]
+    ).exclude(statuslogs__status_to=ORDER_STATUS_PAID).values_list("pk", "created_at")
+
+    for order_id, created_at in legacy_orders.iterator(chunk_size=chunk_size):
+        paid_at[order_id] = created_at
+
+    order_ids = sorted(paid_at)
+
+    for i in range(0, len(order_ids), chunk_size):
+        lines_by_order = defaultdict(list)
+        for line in get_order_lines(order_ids[i:i + chunk_size]):
+            lines_by_order[line["order_id"]].append(line)
+
+        for order_id, lines in lines_by_order.items():
+            for period, period_start in get_periods(paid_at[order_id]):
+                sale = sales[(period, period_start)]
+                sale["orders_count"] += 1
+
+                for line in lines:
+                    revenue = line["price"] * line["quantity"]
+                    sale["units"] += line["quantity"]
+                    sale["revenue"] += revenue
+
+                    product = products[(period, period_start, line["product_id"])]
+                    product["units"] += line["quantity"]
+                    product["revenue"] += revenue
+
+                    category = categories[(period, period_start,
+                                           line["product__category_id"])]
+                    category["units"] += line["quantity"]
+                    category["revenue"] += revenue
+
+    with transaction.atomic():
+        for model in (SalesRollup, ProductSalesRollup, CategorySalesRollup,
+                      StatusRollup):
+            model.objects.all().delete()
+
+        SalesRollup.objects.bulk_create(
+            [SalesRollup(period=key[0], period_start=key[1], **values)
+             for key, values in sales.items()],
+            batch_size=chunk_size
+        )
+        ProductSalesRollup.objects.bulk_create(
+            [ProductSalesRollup(period=key[0], period_start=key[1],
+                                product_id=key[2], **values)
+             for key, values in products.items()],
+            batch_size=chunk_size
+        )
+        CategorySalesRollup.objects.bulk_create(
+            [CategorySalesRollup(period=key[0], period_start=key[1],
+                                 category_id=key[2], **values)
+             for key, values in categories.items()],
+            batch_size=chunk_size
+        )
+        StatusRollup.objects.bulk_create(
+            [StatusRollup(period=key[0], period_start=key[1], status=key[2], **values)
+             for key, values in statuses.items()],
+            batch_size=chunk_size
+        )
+
+        for log in OrderStatusLog.objects.filter(pk__gt=high_water).order_by("pk"):
+            record_status_log(log)
+
+    return {"sales": len(sales), "products": len(products),
+            "categories": len(categories), "statuses": len(statuses)}
@@ -0,0 +1,22 @@
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from api_product.recommendations import record_co_purchase
+from .models import OrderItem, OrderStatusLog, ORDER_STATUS_PAID
+from .rollup import record_status_log
+
+
+@receiver(post_save, sender=OrderStatusLog)
+def update_sales_rollups(sender, instance, created, **kwargs):
+    if created:
+        record_status_log(instance)
+
+
+@receiver(post_save, sender=OrderStatusLog)
+def update_related_products(sender, instance, created, **kwargs):
+    if created and instance.status_to == ORDER_STATUS_PAID:
+        record_co_purchase(list(
+            OrderItem.objects.filter(order_id=instance.order_id)
+            .values_list("product_id", flat=True)
+        ))
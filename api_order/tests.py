@@ -1,3 +1,311 @@
-# from django.test import TestCase
+import json
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from api_product.models import Category, Product
+from megano_store.queries import query_budget
+from megano_store.settings import IDEMPOTENCY_HEADER, QUERY_BUDGETS
+from megano_store.testing import test_settings
+from .models import (Order, OrderStatusLog, IdempotencyKey, SalesRollup,
+                     ProductSalesRollup, CategorySalesRollup, StatusRollup,
+                     ORDER_STATUS_CREATED, ORDER_STATUS_PENDING, ORDER_STATUS_PAID,
+                     ORDER_STATUS_DELIVERED, ORDER_STATUS_CANCELLED)
+from .rollup import get_order_lines, rebuild_rollups
+
+User = get_user_model()
+
+ROLLUPS = (SalesRollup, ProductSalesRollup, CategorySalesRollup, StatusRollup)
+
+
+def get_rollup_rows() -> dict:
+    """
+    :return: {name of model: set of rows without ID}
+    """
+    return {model.__name__: {
+        tuple(value for name, value in row.items() if name != "id")
+        for row in model.objects.values()
+    } for model in ROLLUPS}
+
+
+@test_settings
+class OrderTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="buyer", password="Secret-123")
+        cls.category = Category.objects.create(title="Phones")
+        cls.products = [
+            Product.objects.create(category=cls.category, title=f"Phone {i}",
+                                   price=Decimal("100.50") * i, count=10,
+                                   available=True, created_by=cls.user)
+            for i in (1, 2, 3)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def create_order(self, counts: dict, **headers):
+        return self.client.post(
+            reverse("api_order:orders"),
+            json.dumps([{"id": product.pk, "count": count}
+                        for product, count in counts.items()]),
+            content_type="application/json", headers=headers
+        )
+
+    def confirm_order(self, order_id: int):
+        return self.client.post(
+            reverse("api_order:oneorder-less-slash", kwargs={"pk": order_id}),
+            json.dumps({"deliveryType": "ordinary", "city": "Moscow",
+                        "address": "Red Square, 1", "paymentType": "online"}),
+            content_type="application/json"
+        )
+
+    def pay_order(self, order_id: int, **headers):
+        return self.client.post(
+            reverse("api_order:payment", kwargs={"pk": order_id}),
+            json.dumps({"number": "12345678"}),
+            content_type="application/json", headers=headers
+        )
+
+    def place_paid_order(self, counts: dict) -> int:
+        order_id = self.create_order(counts).json()["orderId"]
+        self.confirm_order(order_id)
+        self.pay_order(order_id)
+        return order_id
+
+
+class OrderStatusTest(OrderTestCase):
+
+    def test_checkout_writes_log(self):
+        order_id = self.place_paid_order({self.products[0]: 1})
+
+        order = Order.objects.get(pk=order_id)
+        self.assertEqual(order.status, ORDER_STATUS_PAID)
+        self.assertEqual(
+            list(order.statuslogs.values_list("status_from", "status_to")),
+            [("", ORDER_STATUS_CREATED), (ORDER_STATUS_CREATED, ORDER_STATUS_PENDING),
+             (ORDER_STATUS_PENDING, ORDER_STATUS_PAID)]
+        )
+        self.assertTrue(all(log.changed_by == self.user
+                            for log in order.statuslogs.all()))
+
+    def test_rejected_transitions(self):
+        order = Order.objects.create(user=self.user, status=ORDER_STATUS_CREATED)
+
+        for status in (ORDER_STATUS_CREATED, ORDER_STATUS_PAID, ORDER_STATUS_DELIVERED):
+            self.assertFalse(order.can_change_status(status))
+            with self.assertRaises(ValueError):
+                order.change_status(status, self.user)
+
+        order.change_status(ORDER_STATUS_CANCELLED, self.user)
+        for status in (ORDER_STATUS_PENDING, ORDER_STATUS_PAID, ORDER_STATUS_CANCELLED):
+            with self.assertRaises(ValueError):
+                order.change_status(status)
+
+        self.assertEqual(order.status, ORDER_STATUS_CANCELLED)
+        self.assertEqual(order.statuslogs.count(), 1)
+
+    def test_payment_of_created_order_is_rejected(self):
+        order_id = self.create_order({self.products[0]: 2}).json()["orderId"]
+
+        response = self.pay_order(order_id)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Order.objects.get(pk=order_id).status, ORDER_STATUS_CREATED)
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].count, 10)
+
+    def test_pending_order_is_confirmed_again(self):
+        order_id = self.create_order({self.products[0]: 1}).json()["orderId"]
+
+        self.assertEqual(self.confirm_order(order_id).status_code, 201)
+        self.assertEqual(self.confirm_order(order_id).status_code, 201)
+        self.assertEqual(Order.objects.get(pk=order_id).status, ORDER_STATUS_PENDING)
+
+
+class OrderViewTest(OrderTestCase):
+
+    def test_products_of_order(self):
+        order_id = self.create_order({self.products[0]: 2}).json()["orderId"]
+        Product.objects.filter(pk=self.products[0].pk).update(
+            title="Renamed", price=Decimal(1), description_short="Short"
+        )
+
+        response = self.client.get(
+            reverse("api_order:oneorder-less-slash", kwargs={"pk": order_id})
+        )
+
+        product = response.json()["products"][0]
+        # price and title are the snapshot at checkout, card fields are current
+        self.assertEqual((product["title"], product["price"]), ("Phone 1", "100.50"))
+        self.assertEqual(product["description"], "Short")
+        self.assertEqual(product["category"], self.category.pk)
+        self.assertEqual((product["count"], product["reviews"], product["tags"]),
+                         (2, 0, []))
+        self.assertEqual(product.keys(), {
+            "id", "category", "title", "description", "price", "freeDelivery",
+            "date", "rating", "images", "tags", "reviews", "count"
+        })
+
+
+class IdempotencyTest(OrderTestCase):
+
+    def test_order_is_created_once(self):
+        first = self.create_order({self.products[0]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+        second = self.create_order({self.products[0]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_key_of_another_body_is_rejected(self):
+        self.create_order({self.products[0]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+        response = self.create_order({self.products[1]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("IdempotencyError", response.json())
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_payment_is_replayed(self):
+        order_id = self.create_order({self.products[0]: 3}).json()["orderId"]
+        self.confirm_order(order_id)
+
+        first = self.pay_order(order_id, **{IDEMPOTENCY_HEADER: "pay"})
+        second = self.pay_order(order_id, **{IDEMPOTENCY_HEADER: "pay"})
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].count, 7)
+        self.assertEqual(OrderStatusLog.objects.filter(
+            order_id=order_id, status_to=ORDER_STATUS_PAID).count(), 1)
+
+    def test_key_of_another_order_is_rejected(self):
+        # the body of the payment is the same, the order is in the path
+        order_ids = [self.create_order({product: 1}).json()["orderId"]
+                     for product in self.products[:2]]
+        for order_id in order_ids:
+            self.confirm_order(order_id)
+
+        self.assertEqual(
+            self.pay_order(order_ids[0], **{IDEMPOTENCY_HEADER: "pay"}).status_code, 201
+        )
+        response = self.pay_order(order_ids[1], **{IDEMPOTENCY_HEADER: "pay"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("IdempotencyError", response.json())
+        self.assertEqual(Order.objects.get(pk=order_ids[1]).status, ORDER_STATUS_PENDING)
+
+    def test_keys_of_other_users_are_separate(self):
+        self.create_order({self.products[0]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+        self.client.force_login(User.objects.create_user(username="other"))
+        response = self.create_order({self.products[0]: 1}, **{IDEMPOTENCY_HEADER: "k1"})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_anonymous_user_without_session_is_not_replayed(self):
+        self.client.logout()
+
+        for _ in range(2):
+            self.client.cookies.clear()  # the view saves the cart into a new session
+            response = self.create_order({self.products[0]: 1},
+                                         **{IDEMPOTENCY_HEADER: "k1"})
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class RollupTest(OrderTestCase):
+
+    def test_increments_match_rebuild(self):
+        self.place_paid_order({self.products[0]: 2, self.products[1]: 1})
+        self.place_paid_order({self.products[1]: 3})
+        self.create_order({self.products[2]: 1})
+
+        incremental = get_rollup_rows()
+        rebuild_rollups(chunk_size=1)
+
+        self.assertEqual(get_rollup_rows(), incremental)
+        revenue = sum((row.revenue for row in SalesRollup.objects.filter(period="day")),
+                      Decimal(0))
+        self.assertEqual(revenue, Decimal("100.50") * 2 + Decimal("201.00") * 4)
+
+    def test_products_without_category_share_row(self):
+        # NULL does not conflict in the unique constraint of CategorySalesRollup
+        Product.objects.filter(pk__in=[product.pk for product in self.products[:2]]
+                               ).update(category=None)
+        self.place_paid_order({self.products[0]: 1, self.products[1]: 1})
+        self.place_paid_order({self.products[0]: 2})
+
+        row = CategorySalesRollup.objects.get(period="day", category=None)
+        self.assertEqual((row.units, row.revenue), (4, Decimal("502.50")))
+
+    def test_payment_during_rebuild_is_counted(self):
+        self.place_paid_order({self.products[0]: 1})
+        order_id = self.create_order({self.products[1]: 2}).json()["orderId"]
+        self.confirm_order(order_id)
+
+        statuses = []
+
+        def pay_and_get_lines(order_ids: list) -> list:
+            # the order is paid after the rebuild has read the log (receivers of
+            # the payment call this function too)
+            if not statuses:
+                statuses.append(None)
+                statuses[0] = self.pay_order(order_id).status_code
+            return get_order_lines(order_ids)
+
+        with mock.patch("api_order.rollup.get_order_lines", pay_and_get_lines):
+            rebuild_rollups()
+
+        self.assertEqual(statuses, [201])
+        rows = get_rollup_rows()
+        rebuild_rollups()
+
+        self.assertEqual(rows, get_rollup_rows())
+        self.assertEqual(SalesRollup.objects.get(period="day").orders_count, 2)
+
+
+class QueryBudgetTest(OrderTestCase):
+
+    def assert_budget(self, name: str, method: str, *args, **kwargs):
+        with query_budget(QUERY_BUDGETS[name], name):
+            response = getattr(self.client, method)(*args, **kwargs)
+            response.getvalue()  # streamed lists are read from the database here
+        self.assertLess(response.status_code, 400)
+
+    def test_views_of_orders(self):
+        self.place_paid_order({product: 1 for product in self.products})
+        order_id = self.create_order({product: 1 for product in self.products}
+                                     ).json()["orderId"]
+
+        self.assert_budget("api_order:basket", "get", reverse("api_order:basket"))
+        self.assert_budget("api_order:orders", "get", reverse("api_order:orders"))
+        self.assert_budget("api_order:orders", "post", reverse("api_order:orders"),
+                           json.dumps([{"id": product.pk, "count": 1}
+                                       for product in self.products]),
+                           content_type="application/json")
+        self.assert_budget("api_order:oneorder-less-slash", "get",
+                           reverse("api_order:oneorder-less-slash",
+                                   kwargs={"pk": order_id}))
+
+    def test_payment(self):
+        # rollups and related products do not depend on the number of products
+        order_id = self.create_order({product: 2 for product in self.products}
+                                     ).json()["orderId"]
+        self.confirm_order(order_id)
+
+        with query_budget(QUERY_BUDGETS["api_order:payment"], "api_order:payment"), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.pay_order(order_id)
+        self.assertEqual(response.status_code, 201)
@@ -2,18 +2,22 @@
 import json
 
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
 from django.db import transaction
-from django.db.models import Count
-from django.http import HttpRequest, JsonResponse
+from django.db.models import Count, Prefetch
+from django.http import Http404, HttpRequest, JsonResponse
 from django.shortcuts import get_object_or_404
 
 from . import cart
-from .models import Order, OrderItem
+from .idempotency import idempotent
+from .models import (Order, OrderItem, ORDER_STATUS_CREATED, ORDER_STATUS_PENDING,
+                     ORDER_STATUS_PAID)
 from api_product.models import Product
+from api_product.invalidation import change_products
 from megano_store.settings import SESSION_KEY_CART
 
 from megano_store.utils import (apply_exception_handler, write_errors,
-                                get_user_fullname, format_queryset_to_list)
+                                get_user_fullname)
 
 User = get_user_model()
 
@@ -40,10 +44,51 @@ def get_basket_view(request: HttpRequest) -> JsonResponse:
     return JsonResponse({}, status=400)
 
 
+def get_order_items_prefetch() -> Prefetch:
+    """
+    Items of orders with their products for <format_order_item_to_dict>
+    (tags and number of reviews of products are prefetched).
+    """
+    products = Product.objects.annotate(
+        reviews_count=Count("reviews")
+    ).prefetch_related("tags")
+    return Prefetch("orderitems", queryset=OrderItem.objects.prefetch_related(
+        Prefetch("product", queryset=products)
+    ))
+
+
+def format_order_item_to_dict(item: OrderItem) -> dict:
+    """
+    Compose dictionary of the product in the order: price, title and image are
+    the snapshot at checkout (see model OrderItem), other fields are taken from
+    the product (see <get_order_items_prefetch>).
+    :param item: instance of model OrderItem
+    :return: dictionary (SHORT description of product)
+    """
+    product = item.product
+
+    return {
+        "id": item.product_id,
+        "category": product.category_id,
+        "title": item.title,
+        "description": product.description_short,
+        "price": item.price,
+        "freeDelivery": product.free_delivery,
+        "date": product.created_at,
+        "rating": product.rating,
+        "images": [{"src": default_storage.url(item.image) if item.image else "",
+                    "alt": item.image_alt}],
+        "tags": [{"id": tag.pk, "name": tag.value} for tag in product.tags.all()],
+        "reviews": product.reviews_count,
+        "count": item.quantity,
+    }
+
+
 def format_order_to_dict(order: Order) -> dict:
     """
     Compose dictionary from order`s data.
-    For get list of products used function <format_queryset_to_list> (see <utils.py).
+    Products are composed by <format_order_item_to_dict>, items must be
+    prefetched by <get_order_items_prefetch>.
     :param order: instance of model Order
     :return: dictionary of order`s data
     """
@@ -67,21 +112,13 @@ def format_order_to_dict(order: Order) -> dict:
     order_items = order.orderitems.all()
 
     if order_items:
-        prod_count = {}
-
-        for item in order_items:
-            prod_count[str(item.product_id)] = item.quantity
-
-        # products = Product.objects.filter(orderitems__order=order)
-        products = Product.objects.filter(id__in=prod_count.keys())
-        products = products.annotate(reviews_count=Count("reviews"))
-
-        data["products"] = format_queryset_to_list(products, prod_count)
+        data["products"] = [format_order_item_to_dict(item) for item in order_items]
 
     return data
 
 
 @apply_exception_handler
+@idempotent("orders")
 def get_orders_view(request: HttpRequest) -> JsonResponse:
     """
     For current user:
@@ -91,6 +128,8 @@ def get_orders_view(request: HttpRequest) -> JsonResponse:
     <deliveryType>, <city>, <address>, <paymentType>.
     Depending on whether the user is authenticated or not,
     write either <user> field or <session_key> field of model <Order>.
+    POST request with header <Idempotency-Key> is performed only once
+    (see idempotency.py).
     :param request: HttpRequest (GET - without parameters, POST - list of products).
     :return: GET - list of orders; POST - ID of created order.
     """
@@ -101,6 +140,8 @@ def get_orders_view(request: HttpRequest) -> JsonResponse:
 
         if curr_user.is_authenticated:
             orders = Order.objects.filter(user=curr_user)
+            orders = orders.select_related("user__profile")
+            orders = orders.prefetch_related(get_order_items_prefetch())
 
             if orders:
                 for order in orders:
@@ -120,18 +161,25 @@ def get_orders_view(request: HttpRequest) -> JsonResponse:
         with transaction.atomic():
 
             if curr_user.is_authenticated:
-                order = Order.objects.create(user=curr_user, status="created")
+                order = Order.objects.create(user=curr_user)
             else:
                 order = Order.objects.create(
-                    session_key=request.session.session_key,
-                    status="created"
+                    session_key=request.session.session_key
                 )
+            order.change_status(ORDER_STATUS_CREATED, curr_user)
+
+            products = Product.objects.prefetch_related("images").in_bulk(
+                list(order_data.keys())
+            )
+            order_items = []
 
             for key, value in order_data.items():
                 prod_id_in_order = key
                 prod_count_in_order = value
 
-                prod_obj_db = get_object_or_404(Product, pk=prod_id_in_order)
+                prod_obj_db = products.get(prod_id_in_order)
+                if prod_obj_db is None:
+                    raise Http404(f"Product {prod_id_in_order} does not exist.")
 
                 if prod_count_in_order > 0:
                     prod_count_db = prod_obj_db.count
@@ -140,11 +188,18 @@ def get_orders_view(request: HttpRequest) -> JsonResponse:
                         if prod_count_in_order > prod_count_db:
                             prod_count_in_order = prod_count_db
 
-                        OrderItem.objects.create(
+                        images = prod_obj_db.images.all()
+                        first_image = images[0] if images else None
+
+                        order_items.append(OrderItem(
                             order=order,
                             product=prod_obj_db,
-                            quantity=prod_count_in_order
-                        )
+                            quantity=prod_count_in_order,
+                            price=prod_obj_db.price,
+                            title=prod_obj_db.title,
+                            image=first_image.image.name if first_image else "",
+                            image_alt=first_image.description if first_image else "",
+                        ))
                         order_total_cost += prod_obj_db.price * prod_count_in_order
                         is_order_delete = False
 
@@ -162,6 +217,7 @@ def get_orders_view(request: HttpRequest) -> JsonResponse:
                 return JsonResponse(errors, status=400)
 
             else:
+                OrderItem.objects.bulk_create(order_items)
                 order.payment_total_cost = order_total_cost
                 order.save()
 
@@ -191,22 +247,29 @@ def get_one_order_view(request: HttpRequest, **kwargs) -> JsonResponse:
     """
     #
     order_id = kwargs["pk"]
-    one_order = get_object_or_404(Order, pk=order_id)
+    one_order = get_object_or_404(
+        Order.objects.select_related("user__profile").prefetch_related(
+            get_order_items_prefetch()
+        ),
+        pk=order_id
+    )
 
     if request.method == "GET":
         return JsonResponse(format_order_to_dict(one_order), status=200)
 
     elif request.method == "POST":
-        if not one_order.user:
-            one_order.user = request.user
-        one_order.status = "pending"
-
         data = json.loads(request.body)
-        one_order.delivery_type = data.get("deliveryType")
-        one_order.delivery_city = data.get("city")
-        one_order.delivery_address = data.get("address")
-        one_order.payment_type = data.get("paymentType")
-        one_order.save()
+
+        with transaction.atomic():
+            if not one_order.user:
+                one_order.user = request.user
+            one_order.change_status(ORDER_STATUS_PENDING, request.user)
+
+            one_order.delivery_type = data.get("deliveryType")
+            one_order.delivery_city = data.get("city")
+            one_order.delivery_address = data.get("address")
+            one_order.payment_type = data.get("paymentType")
+            one_order.save()
 
         return JsonResponse({"orderId": order_id}, status=201)
 
@@ -219,10 +282,13 @@ def get_one_order_view(request: HttpRequest, **kwargs) -> JsonResponse:
 
 
 @apply_exception_handler
+@idempotent("payment")
 def order_payment_view(request: HttpRequest, **kwargs) -> JsonResponse:
     """
     POST request.
     Validate card and payment imitation for order with ID = kwargs["pk"].
+    Request with header <Idempotency-Key> is performed only once
+    (see idempotency.py).
     :param request: HttpRequest
     :param kwargs: ID of the order from URL pattern
     :return: JsonResponse (success message or error message)
@@ -236,10 +302,11 @@ def order_payment_view(request: HttpRequest, **kwargs) -> JsonResponse:
         with transaction.atomic():
             order_id = kwargs["pk"]
             order = get_object_or_404(Order, pk=order_id)
-            order.status = "paid"
+            order.change_status(ORDER_STATUS_PAID, request.user)
             order.save()
 
-            for item in order.orderitems.all():
+            products = []
+            for item in order.orderitems.select_related("product"):
                 product = item.product
 
                 if product.count > item.quantity:
@@ -247,7 +314,11 @@ def order_payment_view(request: HttpRequest, **kwargs) -> JsonResponse:
                 else:
                     product.count = 0
                     product.available = False
-                product.save()
+                products.append(product)
+            Product.objects.bulk_update(products, ["count", "available"])
+            # signals are not sent by bulk writes
+            change_products([product.pk for product in products],
+                            ["count", "available"])
 
             return JsonResponse(
                 {"Message": f"Order № {order_id} has been successfully paid."},
@@ -1,6 +1,11 @@
 
 from django.contrib import admin
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 
+from megano_store.admin_utils import EstimatedCountPaginator, PrefixSearchMixin
+from megano_store.routers import ReadOnlyChangeListMixin
+from megano_store.settings import ADMIN_REVIEWS_PREVIEW
 from .models import (Category, CategoryImage, Sale,
                      Product, ProductImage, ProductReview, ProductSpec, ProductTag)
 
@@ -11,10 +16,11 @@ class CategoryImageInline(admin.TabularInline):
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
 
     list_display = ("id", "title", "parent",)
     list_display_links = ("title",)
+    list_select_related = ("parent",)  # nullable FK is not joined by default
     search_fields = ("title",)
     readonly_fields = ("id",)
     ordering = ("id",)
@@ -27,6 +33,15 @@ class CategoryAdmin(admin.ModelAdmin):
 
     inlines = [CategoryImageInline,]
 
+    def get_search_results(self, request, queryset, search_term):
+        queryset, may_have_duplicates = super().get_search_results(
+            request, queryset, search_term)
+        # autocomplete of Product.category: subcategories only
+        if (request.GET.get("model_name") == "product"
+                and request.GET.get("field_name") == "category"):
+            queryset = queryset.exclude(parent__isnull=True)
+        return queryset, may_have_duplicates
+
 
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -41,25 +56,37 @@ class ProductSpecInline(admin.TabularInline):
 class ProductTagInline(admin.TabularInline):
     model = ProductTag.product.through
     extra = 1
+    autocomplete_fields = ("producttag",)
 
 
-class ProductReviewInline(admin.TabularInline):
-    model = ProductReview
-    extra = 0
-    can_add = False
-    can_change = False
-    can_delete = False
-    readonly_fields = [field.name for field in model._meta.fields]
+@admin.register(ProductTag)
+class ProductTagAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
 
+    list_display = ("id", "value",)
+    list_display_links = ("value",)
+    search_fields = ("value",)
+    ordering = ("id",)
+    fields = ("value",)
 
-@admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
 
+@admin.register(Product)
+class ProductAdmin(PrefixSearchMixin, ReadOnlyChangeListMixin, admin.ModelAdmin):
+    """
+    Reviews are not loaded as inline (popular products have thousands of them):
+    the last ADMIN_REVIEWS_PREVIEW reviews and the link to the paginated list.
+    """
     list_display = ("id", "category", "title", "price", "count",
                     "rating", "available",)
     list_display_links = ("title",)
-    search_fields = ("category__title", "title",)
-    readonly_fields = ("id", "created_at", "created_by",)
+    list_select_related = ("category",)
+    search_fields = ("title",)
+    search_help_text = "Beginning of the title or ID of the product."
+    prefix_search_fields = ("title_low",)
+    prefix_search_lower = True
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    autocomplete_fields = ("category",)
+    readonly_fields = ("id", "created_at", "created_by", "last_reviews",)
     ordering = ("id",)
 
     fieldsets = [
@@ -75,15 +102,34 @@ class ProductAdmin(admin.ModelAdmin):
             "fields": ("limited_edition", "created_at", "created_by",),
             "classes": ("collapse", "wide",),
         }),
+        ("Reviews", {
+            "fields": ("last_reviews",),
+            "classes": ("collapse", "wide",),
+        }),
     ]
 
     inlines = [
         ProductImageInline,
         ProductSpecInline,
         ProductTagInline,
-        ProductReviewInline,
     ]
 
+    @admin.display(description="Last reviews")
+    def last_reviews(self, obj):
+        if obj.pk is None:
+            return "-"
+
+        reviews = (obj.reviews.select_related("user")
+                   .order_by("-created_at")[:ADMIN_REVIEWS_PREVIEW])
+        url = reverse("admin:api_product_productreview_changelist")
+        return format_html(
+            "<ul>{}</ul><a href=\"{}?product__id__exact={}\">All reviews ({})</a>",
+            format_html_join("", "<li>{} ({}): {}</li>",
+                             ((review.user.username, review.rate, review.text[:100])
+                              for review in reviews)),
+            url, obj.pk, obj.reviews.count(),
+        )
+
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "category":
             kwargs["queryset"] = Category.objects.exclude(parent__isnull=True)
@@ -95,12 +141,36 @@ class ProductAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
 
+@admin.register(ProductReview)
+class ProductReviewAdmin(ReadOnlyChangeListMixin, admin.ModelAdmin):
+    """
+    Paginated read-only list of reviews (see ProductAdmin.last_reviews).
+    """
+    list_display = ("id", "product", "user", "rate", "created_at",)
+    list_display_links = ("id",)
+    list_select_related = ("product", "user",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ("-id",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Sale)
-class SaleAdmin(admin.ModelAdmin):
+class SaleAdmin(PrefixSearchMixin, ReadOnlyChangeListMixin, admin.ModelAdmin):
 
     list_display = ("id", "product", "price_sale", "date_from", "date_to",)
     list_display_links = ("product",)
-    search_fields = ("product",)
+    list_select_related = ("product",)
+    search_fields = ("product__title",)
+    search_help_text = "Beginning of the title of the product or ID of the sale."
+    prefix_search_fields = ("product__title_low",)
+    prefix_search_lower = True
+    autocomplete_fields = ("product",)
     readonly_fields = ("id",)
     ordering = ("id",)
 
@@ -0,0 +1,508 @@
+"""
+Bulk import and export of the catalog (commands <import_catalog>,
+<export_catalog>, <process_image_queue>).
+
+Record - one product (one line of JSONL or one row of CSV):
+    {"id": 15, "category": "Phones/Smartphones", "title": "...",
+     "description_short": "...", "description_full": "...", "price": "10.50",
+     "count": 5, "available": true, "free_delivery": false, "rating": "4.50",
+     "limited_edition": false, "tags": ["new", "hit"],
+     "specs": {"Color": "black"}, "images": [{"src": "...", "alt": "..."}]}
+CSV has the same columns: tags and images are separated by "|",
+specifications - "name=value|name=value", images - sources only.
+
+Import:
+- records are read and written by batches (one transaction per batch);
+- products are written by one <executemany> per batch: products with <id>
+  are upserted (INSERT ... ON CONFLICT DO UPDATE), products without <id> get
+  the next keys, <title_low> is computed here (method <save> of Product
+  is not called by bulk writes);
+- category is ID or path of titles "Parent/Child" (missing categories are
+  created), tags are found by value (missing tags are created): both are
+  looked up in dictionaries loaded once;
+- specifications and tags of the record replace the current ones (absent key
+  or empty CSV cell - current ones are kept);
+- images are not downloaded: they are queued (model ProductImageImport) and
+  processed by command <process_image_queue>.
+Fields, which are absent in the record, get default values.
+
+Export streams products by chunks (iterator), the table is not loaded at once.
+"""
+
+import csv
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from urllib.request import urlopen
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+from megano_store.routers import read_only_db
+from megano_store.settings import IMAGE_IMPORT_MAX_BYTES, IMAGE_IMPORT_TIMEOUT
+from megano_store.utils import write_errors
+from .models import (Category, Product, ProductImage, ProductImageImport, ProductSpec,
+                     ProductTag, IMAGE_IMPORT_PENDING, IMAGE_IMPORT_DONE,
+                     IMAGE_IMPORT_FAILED)
+from .preload import change_version as change_preload_version
+from .snapshot import change_version as change_snapshot_version
+from .suggest import change_version
+from .trigrams import index_products, index_tags
+
+CATALOG_FIELDS = ["id", "category", "title", "description_short", "description_full",
+                  "price", "count", "available", "free_delivery", "rating",
+                  "limited_edition", "tags", "specs", "images"]
+
+UPDATE_FIELDS = ["category", "title", "title_low", "description_short",
+                 "description_full", "price", "count", "available", "free_delivery",
+                 "rating", "limited_edition"]
+
+TRUE_VALUES = {"1", "true", "yes", "y", "on"}
+
+
+def get_category_paths() -> dict:
+    """
+    :return: dictionary {ID of category: "Parent/Child"}
+    """
+    categories = {pk: (title, parent_id) for pk, title, parent_id
+                  in Category.objects.values_list("pk", "title", "parent_id")}
+    paths = {}
+
+    def get_path(pk: int) -> str:
+        if pk not in paths:
+            title, parent_id = categories[pk]
+            paths[pk] = get_path(parent_id) + "/" + title if parent_id else title
+        return paths[pk]
+
+    for pk in categories:
+        get_path(pk)
+    return paths
+
+
+##  Reading and writing of records  ##
+
+def split_cell(value: str) -> list:
+    return [item.strip() for item in value.split("|") if item.strip()]
+
+
+def from_csv_row(row: dict) -> dict:
+    record = {key: value for key, value in row.items() if key and value not in ("", None)}
+
+    if "tags" in record:
+        record["tags"] = split_cell(record["tags"])
+    if "specs" in record:
+        record["specs"] = dict(item.split("=", 1) for item in split_cell(record["specs"]))
+    if "images" in record:
+        record["images"] = [{"src": src} for src in split_cell(record["images"])]
+    return record
+
+
+def to_csv_row(record: dict) -> dict:
+    row = dict(record)
+    row["tags"] = "|".join(record["tags"])
+    row["specs"] = "|".join(f"{name}={value}" for name, value in record["specs"].items())
+    row["images"] = "|".join(image["src"] for image in record["images"])
+    return row
+
+
+def read_records(file, file_format: str):
+    """
+    Iterator of records of the file (the file is read line by line).
+    """
+    if file_format == "csv":
+        for row in csv.DictReader(file):
+            yield from_csv_row(row)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_records(file, file_format: str, records) -> int:
+    """
+    Write records one by one.
+    :return: number of records
+    """
+    written = 0
+    if file_format == "csv":
+        writer = csv.DictWriter(file, fieldnames=CATALOG_FIELDS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(to_csv_row(record))
+            written += 1
+    else:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n")
+            written += 1
+    return written
+
+
+##  Export  ##
+
+def iter_catalog(chunk_size: int = 2000):
+    """
+    Records of all products: products are read by chunks of <chunk_size>
+    (keyset pagination by ID), relations of the chunk are read by three queries
+    as tuples (model instances are not created).
+    """
+    through = ProductTag.product.through
+
+    with read_only_db():
+        paths = get_category_paths()
+        last_pk = 0
+
+        while True:
+            rows = list(Product.objects.filter(pk__gt=last_pk).order_by("pk").values(
+                "id", "category_id", *UPDATE_FIELDS[1:]
+            )[:chunk_size])
+            if not rows:
+                return
+            ids = [row["id"] for row in rows]
+            last_pk = ids[-1]
+
+            tags, specs, images = defaultdict(list), defaultdict(dict), defaultdict(list)
+            for product_id, value in through.objects.filter(
+                    product_id__in=ids).values_list("product_id", "producttag__value"):
+                tags[product_id].append(value)
+            for product_id, name, value in ProductSpec.objects.filter(
+                    product_id__in=ids).values_list("product_id", "parameter", "value"):
+                specs[product_id][name] = value
+            for product_id, name, alt in ProductImage.objects.filter(
+                    product_id__in=ids).exclude(image="").order_by("pk").values_list(
+                    "product_id", "image", "description"):
+                images[product_id].append({"src": name, "alt": alt})
+
+            for row in rows:
+                pk = row.pop("id")
+                category_id = row.pop("category_id")
+                row.pop("title_low")
+                yield {"id": pk, "category": paths.get(category_id, ""), **row,
+                       "tags": tags[pk], "specs": specs[pk], "images": images[pk]}
+
+
+##  Import  ##
+
+def insert_rows(model, fields: list, rows: list, ignore_conflicts: bool = False,
+                update_fields: list = None) -> int:
+    """
+    Insert rows by one <executemany>: <bulk_create> creates and prepares model
+    instance for every row, it is the most part of time of the import.
+    :param model: model
+    :param fields: names of fields (values of rows are ready for the database)
+    :param rows: list of tuples
+    :param ignore_conflicts: skip rows, which violate unique constraints
+    :param update_fields: update these fields of the existing row with the same
+    primary key (upsert)
+    :return: number of rows
+    """
+    if not rows:
+        return 0
+
+    quote = connection.ops.quote_name
+    columns = [quote(model._meta.get_field(name).column) for name in fields]
+    sql = "INSERT {}INTO {} ({}) VALUES ({})".format(
+        "OR IGNORE " if ignore_conflicts else "", quote(model._meta.db_table),
+        ", ".join(columns), ", ".join(["%s"] * len(fields)))
+
+    if update_fields:
+        sql += " ON CONFLICT ({}) DO UPDATE SET {}".format(
+            quote(model._meta.pk.column),
+            ", ".join("{0} = excluded.{0}".format(quote(model._meta.get_field(name).column))
+                      for name in update_fields))
+
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
+
+
+def get_next_id(model) -> int:
+    """
+    The next primary key (the table is locked by the transaction: transactions
+    of SQLite begin with <BEGIN IMMEDIATE>). Table with AUTOINCREMENT does not
+    reuse keys of deleted rows: its sequence is taken into account.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX({}) FROM {}".format(
+            connection.ops.quote_name(model._meta.pk.column),
+            connection.ops.quote_name(table)))
+        max_id = cursor.fetchone()[0] or 0
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        sequence = cursor.fetchone()
+    return max(max_id, sequence[0] if sequence else 0) + 1
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def to_decimal(value, field_name: str) -> str:
+    field = Product._meta.get_field(field_name)
+    return connection.ops.adapt_decimalfield_value(
+        Decimal(str(value)).quantize(Decimal(1).scaleb(-field.decimal_places)),
+        field.max_digits, field.decimal_places)
+
+
+class CatalogImporter:
+    """
+    Usage:
+        importer = CatalogImporter(user, batch_size=2000)
+        importer.run(read_records(file, "jsonl"))
+    """
+    # order of values of rows of products (see <build_row>)
+    columns = ["id", *UPDATE_FIELDS, "created_at", "created_by"]
+
+    def __init__(self, created_by, batch_size: int = 2000):
+        self.created_by = created_by
+        self.batch_size = batch_size
+        self.categories = {path: pk for pk, path in get_category_paths().items()}
+        self.category_ids = set(self.categories.values())
+        self.tags = {}
+        for pk, value in ProductTag.objects.order_by("pk").values_list("pk", "value"):
+            self.tags.setdefault(value, pk)
+        self.stats = {"created": 0, "upserted": 0, "skipped": 0, "images_queued": 0,
+                      "categories_created": 0, "tags_created": 0}
+
+    def get_category_id(self, value) -> int | None:
+        if value in (None, ""):
+            return None
+
+        if isinstance(value, int) or str(value).isdigit():
+            if int(value) not in self.category_ids:
+                raise ValueError(f"Category <{value}> does not exist.")
+            return int(value)
+
+        path, parent_id = "", None
+        for title in [part.strip() for part in str(value).split("/") if part.strip()]:
+            path = path + "/" + title if path else title
+            if path not in self.categories:  # rare: category is created once
+                category = Category.objects.create(title=title, parent_id=parent_id)
+                self.categories[path] = category.pk
+                self.category_ids.add(category.pk)
+                self.stats["categories_created"] += 1
+            parent_id = self.categories[path]
+        return parent_id
+
+    def build_row(self, record: dict, created_at: str) -> list:
+        """
+        Validated values of the product in the order of <columns>
+        (ID is None for new product).
+        """
+        title = str(record["title"]).strip()
+        if not title:
+            raise ValueError("Title is empty.")
+        count = int(record.get("count", 0))
+        if not 0 <= count <= 32767:
+            raise ValueError(f"Count <{count}> is out of range.")
+
+        return [
+            int(record["id"]) if record.get("id") not in (None, "") else None,
+            self.get_category_id(record.get("category")),
+            title[:192],
+            title[:192].lower(),
+            str(record.get("description_short", "")),
+            str(record.get("description_full", "")),
+            to_decimal(record.get("price", 0), "price"),
+            count,
+            to_bool(record.get("available", False)),
+            to_bool(record.get("free_delivery", False)),
+            to_decimal(record.get("rating", 0), "rating"),
+            to_bool(record.get("limited_edition", False)),
+            created_at,
+            self.created_by.pk,
+        ]
+
+    def create_missing_tags(self, records: list) -> None:
+        missing = {value for record in records for value in record.get("tags") or []
+                   if value not in self.tags}
+        if missing:
+            created = ProductTag.objects.bulk_create(
+                [ProductTag(value=value) for value in sorted(missing)])
+            for tag in created:
+                self.tags[tag.value] = tag.pk
+            index_tags([tag.pk for tag in created])
+            self.stats["tags_created"] += len(missing)
+
+    def import_batch(self, records: list) -> None:
+        created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows, valid, errors = [], [], []
+        for record in records:
+            try:
+                rows.append(self.build_row(record, created_at))
+                valid.append(record)
+            except (KeyError, ValueError, TypeError, InvalidOperation) as exc:
+                errors.append(f"{record.get('id') or record.get('title')}: "
+                              f"{type(exc).__name__} : {exc}")
+
+        if errors:
+            self.stats["skipped"] += len(errors)
+            write_errors({"ImportError": errors}, "errors_from_import.log")
+
+        with transaction.atomic():
+            upserted = sum(row[0] is not None for row in rows)
+            next_id = max([get_next_id(Product)] + [row[0] + 1 for row in rows
+                                                    if row[0] is not None])
+            for row in rows:
+                if row[0] is None:
+                    row[0] = next_id
+                    next_id += 1
+
+            # fields <created_at>, <created_by> of existing products are kept
+            insert_rows(Product, self.columns, rows, update_fields=UPDATE_FIELDS)
+            self.stats["upserted"] += upserted
+            self.stats["created"] += len(rows) - upserted
+
+            product_ids = [row[0] for row in rows]
+            self.import_specs(product_ids, valid, replace=bool(upserted))
+            self.import_tags(product_ids, valid, replace=bool(upserted))
+            self.queue_images(product_ids, valid)
+            index_products(product_ids)  # trigrams of titles (tags - at creation)
+
+    def import_specs(self, product_ids: list, records: list, replace: bool) -> None:
+        pairs = [(pk, record["specs"]) for pk, record in zip(product_ids, records)
+                 if record.get("specs") is not None]
+        if replace:
+            ProductSpec.objects.filter(product_id__in=[pk for pk, _ in pairs]).delete()
+        insert_rows(ProductSpec, ["product", "parameter", "value"], [
+            (pk, name, str(value))
+            for pk, specs in pairs
+            for name, value in specs.items()
+        ])
+
+    def import_tags(self, product_ids: list, records: list, replace: bool) -> None:
+        self.create_missing_tags(records)
+        through = ProductTag.product.through
+        pairs = [(pk, record["tags"]) for pk, record in zip(product_ids, records)
+                 if record.get("tags") is not None]
+        if replace:
+            through.objects.filter(product_id__in=[pk for pk, _ in pairs]).delete()
+        insert_rows(through, ["product", "producttag"], [
+            (pk, self.tags[value])
+            for pk, values in pairs
+            for value in set(values)
+        ], ignore_conflicts=True)
+
+    def queue_images(self, product_ids: list, records: list) -> None:
+        """
+        Images, which are already attached to the product (the same name of file),
+        are not queued (import of the exported catalog).
+        """
+        pairs = [(pk, record["images"]) for pk, record in zip(product_ids, records)
+                 if record.get("images")]
+        attached = set(ProductImage.objects.filter(
+            product_id__in=[pk for pk, _ in pairs]
+        ).values_list("product_id", "image"))
+
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        self.stats["images_queued"] += insert_rows(
+            ProductImageImport,
+            ["product", "source", "description", "status", "error", "created_at"],
+            [(pk, image["src"], image.get("alt", "")[:128], IMAGE_IMPORT_PENDING, "", now)
+             for pk, images in pairs
+             for image in images
+             if image.get("src") and (pk, image["src"]) not in attached]
+        )
+
+    def run(self, records) -> dict:
+        records = iter(records)
+        while batch := list(islice(records, self.batch_size)):
+            self.import_batch(batch)
+
+        change_version()  # signals are not sent by bulk writes
+        change_preload_version()  # categories and tags of products
+        change_snapshot_version()
+        return self.stats
+
+
+##  Queue of images  ##
+
+def fetch_image(task: ProductImageImport, source_dir: str) -> bytes | None:
+    """
+    Content of the image (None - file is already in the storage).
+    """
+    source = task.source
+    if source.startswith(("http://", "https://")):
+        with urlopen(source, timeout=IMAGE_IMPORT_TIMEOUT) as response:
+            content = response.read(IMAGE_IMPORT_MAX_BYTES + 1)
+    elif not os.path.isabs(source) and default_storage.exists(source):
+        return None
+    else:
+        with open(os.path.join(source_dir, source), "rb") as file:
+            content = file.read(IMAGE_IMPORT_MAX_BYTES + 1)
+
+    if len(content) > IMAGE_IMPORT_MAX_BYTES:
+        raise ValueError(f"Image is larger than {IMAGE_IMPORT_MAX_BYTES} bytes.")
+    return content
+
+
+def attach_image(task: ProductImageImport, content: bytes | None) -> bool:
+    """
+    Create the image of the product and mark the task as done in one transaction.
+    :param content: content of the file (None - file is already in the storage)
+    :return: True - done, False - failed (the error is in the task)
+    """
+    new_name = ""
+    try:
+        with transaction.atomic():
+            image = ProductImage(product_id=task.product_id,
+                                 description=task.description)
+            if content is None:
+                image.image.name = task.source
+                image.save()
+            else:
+                image.save()  # primary key is a part of the path of the file
+                image.image.save(os.path.basename(task.source.split("?")[0])
+                                 or "image.jpg", ContentFile(content), save=False)
+                new_name = image.image.name
+                image.save(update_fields=["image"])
+
+            task.status, task.error = IMAGE_IMPORT_DONE, ""
+            task.save(update_fields=["status", "error"])
+        return True
+
+    except Exception as exc:
+        if new_name:  # the file of the rolled back image
+            default_storage.delete(new_name)
+        task.status = IMAGE_IMPORT_FAILED
+        task.error = f"{type(exc).__name__} : {exc}"[:256]
+        return False
+
+
+def process_image_queue(limit: int = 500, source_dir: str = "", workers: int = 8) -> dict:
+    """
+    Download or copy queued images (in threads), then attach them to products.
+    :return: dictionary {"done": ..., "failed": ...}
+    """
+    tasks = list(ProductImageImport.objects.filter(status=IMAGE_IMPORT_PENDING)
+                 .order_by("id")[:limit])
+
+    def fetch(task):
+        try:
+            return fetch_image(task, source_dir), None
+        except Exception as exc:
+            return None, f"{type(exc).__name__} : {exc}"[:256]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, tasks))
+
+    failed = []
+    try:
+        for task, (content, error) in zip(tasks, results):
+            if error:
+                task.status, task.error = IMAGE_IMPORT_FAILED, error
+                failed.append(task)
+            elif not attach_image(task, content):
+                failed.append(task)
+    finally:  # statuses of attached images are saved with them
+        ProductImageImport.objects.bulk_update(failed, ["status", "error"])
+
+    return {"done": sum(task.status == IMAGE_IMPORT_DONE for task in tasks),
+            "failed": sum(task.status == IMAGE_IMPORT_FAILED for task in tasks)}
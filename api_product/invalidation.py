@@ -0,0 +1,63 @@
+"""
+Caches, which contain data of products, are dropped by one function
+<change_products>. It is called by receivers of signals of Product
+(see signals.py) and by bulk writes, which do not send signals (payment of
+the order, see api_order/views.py).
+
+- the index of suggestions and the snapshot of the catalog - new versions
+  (suggest.py, snapshot.py); cached lists of the catalog have the version of
+  the snapshot in their keys (see <get_catalog_view>);
+- preloaded tags of categories - if categories of products are changed
+  (preload.py);
+- cached cards of the products, lists of banners, limited, popular products
+  and sales, related products of the products and of products, which have
+  them as neighbors (sold out neighbors are not shown).
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+
+from megano_store.settings import CATEGORY_ID, RATING_VALUE
+from .models import ProductNeighbor
+from .preload import change_version as change_preload_version
+from .recommendations import get_related_cache_key
+from .snapshot import change_version as change_snapshot_version
+from .suggest import change_version as change_suggest_version
+
+BANNERS_CACHE_KEY = "banners" + CATEGORY_ID
+LIMITED_CACHE_KEY = "limited"
+POPULAR_CACHE_KEY = "popular" + RATING_VALUE
+SALES_CACHE_KEY = "sales_list"
+
+
+def get_product_cache_key(product_id: int) -> str:
+    return "product" + str(product_id)
+
+
+def change_products(product_ids: list, update_fields=None) -> None:
+    """
+    Drop caches of the products after the commit of changes.
+    :param product_ids: list of ID of changed (deleted) products
+    :param update_fields: changed fields (None - all fields)
+    :return: None
+    """
+    product_ids = list(product_ids)
+
+    change_suggest_version()
+    change_snapshot_version()
+    if update_fields is None or "category" in update_fields:
+        change_preload_version()
+
+    def drop_cached() -> None:
+        related_ids = set(product_ids)
+        related_ids.update(ProductNeighbor.objects.filter(
+            neighbor_id__in=product_ids
+        ).values_list("product_id", flat=True))
+
+        cache.delete_many(
+            [get_product_cache_key(pk) for pk in product_ids] +
+            [get_related_cache_key(pk) for pk in related_ids] +
+            [BANNERS_CACHE_KEY, LIMITED_CACHE_KEY, POPULAR_CACHE_KEY, SALES_CACHE_KEY]
+        )
+
+    transaction.on_commit(drop_cached)
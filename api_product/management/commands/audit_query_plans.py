@@ -0,0 +1,383 @@
+
+import hashlib
+import json
+import re
+import time
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.test import Client, override_settings
+from django.urls import get_resolver, reverse
+from PIL import Image
+
+from api_product.models import Product
+from megano_store.queries import normalize_sql
+from megano_store.settings import ALLOWED_HOSTS
+
+NAMESPACES = ("api_product", "api_order", "api_auth")
+
+AUDIT_USERNAME = "audit_query_plans"
+AUDIT_PASSWORD = "Audit-query-plans-1"
+
+CATALOG_QUERY = {"filter[name]": "", "filter[minPrice]": "0",
+                 "filter[maxPrice]": "1000000", "filter[freeDelivery]": "false",
+                 "filter[available]": "true", "currentPage": "1", "limit": "20",
+                 "sort": "price", "sortType": "inc"}
+
+
+def get_image() -> BytesIO:
+    file = BytesIO()
+    Image.new("RGB", (8, 8), "white").save(file, "PNG")
+    file.name = "audit.png"
+    file.seek(0)
+    return file
+
+
+# Requests of the audit in the order of execution (one scenario of the user):
+# (URL name, method, function(context) -> kwargs of URL or path of the URL,
+#  which cannot be reversed,
+#  function(context) -> query (GET), JSON body or form with files, label of
+#  the variant).
+# Context: sample objects of the database and results of previous requests.
+STEPS = [
+    ("api_product:categories", "GET", None, None, ""),
+    ("api_product:tags", "GET", None,
+     lambda ctx: {"category": ctx["category_id"]}, ""),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: CATALOG_QUERY, "sort=price"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "sort": "rating", "sortType": "dec"}, "sort=rating"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "sort": "reviews", "sortType": "dec"}, "sort=reviews"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "sort": "date", "sortType": "dec"}, "sort=date"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "category": ctx["category_id"],
+                  "tags[]": ctx["tag_ids"]}, "category+tags"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "filter[name]": ctx["word"]}, "search"),
+    ("api_product:catalog", "GET", None,
+     lambda ctx: {**CATALOG_QUERY, "filter[name]": ctx["word"],
+                  "filter[fuzzy]": "true"}, "fuzzy"),
+    ("api_product:banners", "GET", None, None, ""),
+    ("api_product:limited", "GET", None, None, ""),
+    ("api_product:popular", "GET", None, None, ""),
+    ("api_product:sales", "GET", None, lambda ctx: {"currentPage": "1"}, ""),
+    ("api_product:product", "GET",
+     lambda ctx: {"pk": ctx["product_id"]}, None, ""),
+    ("api_product:related", "GET",
+     lambda ctx: {"pk": ctx["product_id"]}, None, ""),
+    ("api_product:suggest", "GET", None,
+     lambda ctx: {"q": ctx["word"][:3]}, ""),
+    ("api_product:product-review", "POST",
+     lambda ctx: {"pk": ctx["product_id"]},
+     lambda ctx: {"text": "Audit of query plans.", "rate": 5}, ""),
+    ("api_order:basket", "POST", None,
+     lambda ctx: {"id": ctx["product_id"], "count": 1}, ""),
+    ("api_order:basket", "GET", None, None, ""),
+    ("api_order:orders", "POST", None,
+     lambda ctx: [{"id": ctx["product_id"], "count": 1}], ""),
+    ("api_order:orders", "GET", None, None, ""),
+    ("api_order:oneorder-with-slash", "GET",
+     lambda ctx: {"pk": ctx["order_id"]}, None, ""),
+    ("api_order:oneorder-less-slash", "POST",
+     lambda ctx: {"pk": ctx["order_id"]},
+     lambda ctx: {"deliveryType": "ordinary", "city": "Moscow",
+                  "address": "Red square, 1", "paymentType": "online"}, ""),
+    ("api_order:payment", "POST",
+     lambda ctx: {"pk": ctx["order_id"]},
+     lambda ctx: {"number": "12345678"}, ""),
+    ("api_order:basket", "DELETE", None,
+     lambda ctx: {"id": ctx["product_id"], "count": 1}, ""),
+    ("api_auth:profile", "GET", None, None, ""),
+    ("api_auth:profile", "POST", None,
+     lambda ctx: {"fullName": "Audit User", "email": "audit@example.com",
+                  "phone": "+70000000000"}, ""),
+    ("api_auth:avatar", "POST", None, lambda ctx: {"avatar": get_image()}, ""),
+    # the change of the password ends the session, so it is the last step of the profile
+    ("api_auth:password", "POST", None,
+     lambda ctx: {"currentPassword": AUDIT_PASSWORD,
+                  "newPassword": AUDIT_PASSWORD + "2"}, ""),
+    ("api_auth:sign-out", "POST", None, None, ""),
+    ("api_auth:sign-inup", "POST", "/api/sign-in",
+     lambda ctx: {"username": AUDIT_USERNAME, "password": AUDIT_PASSWORD + "2"},
+     "sign-in"),
+    ("api_auth:sign-inup", "POST", "/api/sign-up",
+     lambda ctx: {"username": AUDIT_USERNAME + "_new", "password": AUDIT_PASSWORD,
+                  "name": "Audit"}, "sign-up"),
+]
+
+AUDITED_SQL = ("SELECT", "WITH", "UPDATE", "DELETE")
+
+_re_aliases = re.compile(r'"(\w+)"\s+(?:AS\s+)?"?([A-Z]\d+)"?(?=[\s,)]|$)')
+_re_scan = re.compile(r"^SCAN (\w+)$")
+_re_temp_btree = re.compile(r"USE TEMP B-TREE FOR (.+)$")
+_re_automatic = re.compile(r"^(?:SEARCH|SCAN) (\w+) USING AUTOMATIC")
+
+
+class StatementRecorder:
+    """
+    Wrapper of <execute> of all connections (threads of async views too):
+    statements of the current request with their parameters.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.enabled = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.enabled and not many and sql.lstrip().upper().startswith(AUDITED_SQL):
+            self.statements.append((context["connection"].alias, sql, params))
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs) -> None:
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def uninstall(self) -> None:
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+def get_plan(alias: str, sql: str, params) -> list:
+    """
+    :return: list of lines of EXPLAIN QUERY PLAN, indented by depth of the node
+    """
+    with connections[alias].cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        rows = cursor.fetchall()
+
+    depths, plan = {0: -1}, []
+    for node_id, parent_id, _, detail in rows:
+        depths[node_id] = depths.get(parent_id, -1) + 1
+        plan.append("  " * depths[node_id] + detail)
+    return plan
+
+
+def get_issues(plan: list, sql: str, count_rows, min_rows: int) -> list:
+    """
+    :param count_rows: function(table) -> number of rows of the table
+    :param min_rows: full scans of smaller tables are not issues
+    :return: list of issues {"kind", "table", "detail"}
+    """
+    aliases = {alias: table for table, alias in _re_aliases.findall(sql)}
+    issues = []
+
+    for line in plan:
+        detail = line.strip()
+
+        if match := _re_scan.match(detail):
+            table = aliases.get(match[1], match[1])
+            rows = count_rows(table)
+            if rows is not None and rows >= min_rows:
+                issues.append({"kind": "full_scan", "table": table, "rows": rows,
+                               "detail": detail})
+
+        elif match := _re_automatic.match(detail):
+            table = aliases.get(match[1], match[1])
+            issues.append({"kind": "automatic_index", "table": table,
+                           "detail": detail})
+
+        elif _re_temp_btree.search(detail):
+            issues.append({"kind": "temp_btree", "table": None,
+                           "detail": detail})
+
+    return issues
+
+
+def get_issue_key(statement: dict, issue: dict) -> str:
+    digest = hashlib.sha1(statement["sql"].encode("utf-8")).hexdigest()[:12]
+    return f"{issue['kind']}:{issue['table']}:{issue['detail'].strip()}:{digest}"
+
+
+class Command(BaseCommand):
+    help = ("Send requests to every endpoint of API (api_product, api_order, "
+            "api_auth) against the current database, run EXPLAIN QUERY PLAN for "
+            "every executed statement and report full scans of large tables, "
+            "temporary B-trees (sorting without index) and automatic indexes "
+            "(missing indexes) as JSON. All changes of requests are rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="",
+                            help="JSON file of the report (default - stdout)")
+        parser.add_argument("--min-rows", type=int, default=1000,
+                            help="full scans of smaller tables are not reported")
+        parser.add_argument("--baseline", default="",
+                            help="previous report: fail, if new issues are found")
+
+    def get_context(self) -> dict:
+        product = Product.objects.filter(
+            available=True, count__gt=1
+        ).prefetch_related("tags").order_by("pk").first()
+        if product is None:
+            raise CommandError("The database is empty: fill it first "
+                               "(command <generate_catalog>).")
+
+        words = [word for word in product.title_low.split() if len(word) > 3]
+        return {"product_id": product.pk,
+                "category_id": product.category_id,
+                "tag_ids": [tag.pk for tag in product.tags.all()],
+                "word": words[0] if words else product.title_low}
+
+    def send(self, client: Client, step: tuple, ctx: dict) -> tuple:
+        name, method, get_kwargs, get_data, _ = step
+        if isinstance(get_kwargs, str):
+            url = get_kwargs
+        else:
+            url = reverse(name, kwargs=get_kwargs(ctx) if get_kwargs else None)
+        data = get_data(ctx) if get_data else None
+
+        if method == "GET":
+            response = client.get(url, data)
+        elif isinstance(data, dict) and any(hasattr(value, "read")
+                                            for value in data.values()):
+            response = client.post(url, data)  # multipart form
+        else:
+            response = client.generic(method, url, json.dumps(data or {}),
+                                      content_type="application/json")
+
+        if response.streaming:  # queries of the list are executed while it is sent
+            content = b"".join(response.streaming_content)
+        else:
+            content = response.content
+
+        if name == "api_order:orders" and method == "POST" and response.status_code < 300:
+            ctx["order_id"] = json.loads(content)["orderId"]
+        return url, response.status_code
+
+    def handle(self, *args, **options):
+        recorder = StatementRecorder()
+        row_counts = {}
+
+        def count_rows(table: str) -> int | None:
+            if table not in row_counts:
+                with connections["default"].cursor() as cursor:
+                    cursor.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s",
+                        [table]
+                    )
+                    if cursor.fetchone() is None:  # subquery, CTE
+                        row_counts[table] = None
+                    else:
+                        quoted = connections["default"].ops.quote_name(table)
+                        cursor.execute(f"SELECT COUNT(*) FROM {quoted}")
+                        row_counts[table] = cursor.fetchone()[0]
+            return row_counts[table]
+
+        endpoints, statements = [], {}
+
+        # responses are not taken from the cache, sessions are not written to
+        # the database (the audit user is rolled back), host of the test client
+        # is allowed (DEBUG = False)
+        with override_settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+                    "sessions": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+            SESSION_ENGINE="django.contrib.sessions.backends.cache",
+            ALLOWED_HOSTS=["testserver", *ALLOWED_HOSTS],
+        ):
+            for conn in connections.all(initialized_only=True):
+                recorder.install(connection=conn)
+            connection_created.connect(recorder.install)
+
+            # resizing of the avatar is not a part of the request (thread pool),
+            # it would write outside of the rolled back transaction
+            try:
+                with transaction.atomic(), mock.patch("api_auth.views.schedule_avatar"):
+                    ctx = self.get_context()
+                    user = User.objects.create_user(username=AUDIT_USERNAME,
+                                                    password=AUDIT_PASSWORD)
+                    client = Client(HTTP_X_REAL_IP="127.0.0.1")
+                    client.force_login(user)
+
+                    for step in STEPS:
+                        name, method, _, _, label = step
+                        recorder.statements.clear()
+                        recorder.enabled = True
+                        start = time.perf_counter()
+                        try:
+                            # errors of the request roll back its savepoint only
+                            with transaction.atomic():
+                                url, status = self.send(client, step, ctx)
+                        finally:
+                            recorder.enabled = False
+                        duration = round((time.perf_counter() - start) * 1000)
+
+                        endpoint = f"{method} {name}" + (f" [{label}]" if label else "")
+                        if status >= 400:  # next steps need its results
+                            raise CommandError(f"Request <{endpoint}> ({url}) has "
+                                               f"failed with status {status}.")
+                        endpoints.append({"endpoint": endpoint, "url": url,
+                                          "status": status, "ms": duration,
+                                          "queries": len(recorder.statements)})
+
+                        for alias, sql, params in recorder.statements:
+                            key = normalize_sql(sql)
+                            statement = statements.get(key)
+                            if statement is None:
+                                plan = get_plan(alias, sql, params)
+                                statement = statements[key] = {
+                                    "sql": key, "count": 0, "endpoints": [],
+                                    "plan": plan,
+                                    "issues": get_issues(plan, sql, count_rows,
+                                                         options["min_rows"]),
+                                }
+                            statement["count"] += 1
+                            if endpoint not in statement["endpoints"]:
+                                statement["endpoints"].append(endpoint)
+
+                    transaction.set_rollback(True)
+            finally:
+                connection_created.disconnect(recorder.install)
+                recorder.uninstall()
+
+        audited = {step[0] for step in STEPS}
+        not_audited = sorted(
+            f"{namespace}:{pattern.name}"
+            for namespace in NAMESPACES
+            for pattern in get_resolver().namespace_dict[namespace][1].url_patterns
+            if pattern.name and f"{namespace}:{pattern.name}" not in audited
+        )
+
+        with_issues = [statement for statement in statements.values() if statement["issues"]]
+        summary = {"endpoints": len(endpoints), "statements": len(statements),
+                   "statements_with_issues": len(with_issues)}
+        for statement in with_issues:
+            for issue in statement["issues"]:
+                summary[issue["kind"]] = summary.get(issue["kind"], 0) + 1
+
+        report = {"summary": summary, "not_audited": not_audited,
+                  "endpoints": endpoints,
+                  "statements": sorted(statements.values(),
+                                       key=lambda statement: (not statement["issues"],
+                                                              statement["sql"]))}
+        data = json.dumps(report, ensure_ascii=False, indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                file.write(data + "\n")
+        else:
+            self.stdout.write(data)
+
+        if options["baseline"]:
+            with open(options["baseline"], encoding="utf-8") as file:
+                baseline = json.load(file)
+            known = {get_issue_key(statement, issue)
+                     for statement in baseline["statements"]
+                     for issue in statement["issues"]}
+            new = [get_issue_key(statement, issue)
+                   for statement in with_issues for issue in statement["issues"]
+                   if get_issue_key(statement, issue) not in known]
+            if new:
+                raise CommandError("New issues of query plans:\n" + "\n".join(new))
+
+        if options["output"]:
+            self.stdout.write(self.style.SUCCESS(
+                f"Query plans are audited: {summary['endpoints']} requests, "
+                f"{summary['statements']} statements, "
+                f"{summary['statements_with_issues']} with issues"
+            ))
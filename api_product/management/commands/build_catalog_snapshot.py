@@ -0,0 +1,37 @@
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from api_product.snapshot import get_version, write_snapshot
+from megano_store.settings import SNAPSHOT_MAX_AGE, SNAPSHOT_PATH
+
+
+class Command(BaseCommand):
+    help = ("Build the memory-mapped snapshot of the catalog, which is shared by "
+            "workers (api_product/snapshot.py). The new file replaces the old one "
+            "by rename.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default=SNAPSHOT_PATH)
+        parser.add_argument("--loop", type=int, default=0,
+                            help="run as refresh process: pause between checks of "
+                                 "changes of the catalog (seconds), 0 - build once")
+
+    def handle(self, *args, **options):
+        version, built_at = None, None
+        while True:
+            current = get_version()
+            # the snapshot is rebuilt after changes and before it is too old for workers
+            if (built_at is None or current != version
+                    or time.time() - built_at > SNAPSHOT_MAX_AGE / 2):
+                started = time.perf_counter()
+                count = write_snapshot(options["path"])
+                version, built_at = current, time.time()
+                self.stdout.write(self.style.SUCCESS(
+                    f"Snapshot of the catalog is built: {count} products "
+                    f"in {time.perf_counter() - started:.1f} s"
+                ))
+            if not options["loop"]:
+                return
+            time.sleep(options["loop"])
@@ -0,0 +1,30 @@
+
+import sys
+
+from django.core.management.base import BaseCommand
+
+from api_product.catalog_io import iter_catalog, write_records
+
+
+class Command(BaseCommand):
+    help = ("Export products to CSV or JSONL file (format of records - see "
+            "api_product/catalog_io.py). Products are read by chunks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="path of the file, '-' - standard output")
+        parser.add_argument("--format", choices=["csv", "jsonl"],
+                            help="format of the file (by default - by extension)")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or ("csv" if path.endswith(".csv") else "jsonl")
+        records = iter_catalog(options["chunk_size"])
+
+        if path == "-":
+            write_records(sys.stdout, file_format, records)
+            return
+
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            written = write_records(file, file_format, records)
+        self.stdout.write(self.style.SUCCESS(f"Products exported: {written}"))
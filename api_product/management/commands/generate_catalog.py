@@ -0,0 +1,274 @@
+
+import random
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api_auth.models import Profile
+from api_order.models import (Order, OrderItem, OrderStatusLog, ORDER_STATUS_CREATED,
+                              ORDER_STATUS_PENDING, ORDER_STATUS_PAID,
+                              ORDER_STATUS_DELIVERED, ORDER_STATUS_CANCELLED)
+from api_product.models import (Category, Product, ProductImage, ProductSpec,
+                                ProductReview, ProductTag, Sale)
+
+User = get_user_model()
+
+BRANDS = ["Aurora", "Vector", "Neva", "Polar", "Orbit", "Zenit", "Sigma", "Taiga",
+          "Квант", "Сокол", "Восток", "Рубин"]
+NOUNS = ["phone", "laptop", "tablet", "monitor", "keyboard", "mouse", "headphones",
+         "speaker", "camera", "router", "смартфон", "ноутбук", "планшет", "наушники"]
+ADJECTIVES = ["pro", "mini", "max", "lite", "plus", "ultra", "air", "neo",
+              "новый", "компактный"]
+SPECS = ["Color", "Weight", "Warranty", "Material", "Screen", "Battery", "Memory"]
+CITIES = ["Moscow", "Kazan", "Samara", "Omsk", "Tver", "Perm"]
+
+# Statuses of generated orders (weights) and transitions for the log of statuses
+ORDER_STATUSES = {
+    ORDER_STATUS_CREATED: 10,
+    ORDER_STATUS_PENDING: 15,
+    ORDER_STATUS_PAID: 50,
+    ORDER_STATUS_DELIVERED: 15,
+    ORDER_STATUS_CANCELLED: 10,
+}
+ORDER_STATUS_PATHS = {
+    ORDER_STATUS_CREATED: [ORDER_STATUS_CREATED],
+    ORDER_STATUS_PENDING: [ORDER_STATUS_CREATED, ORDER_STATUS_PENDING],
+    ORDER_STATUS_PAID: [ORDER_STATUS_CREATED, ORDER_STATUS_PENDING, ORDER_STATUS_PAID],
+    ORDER_STATUS_DELIVERED: [ORDER_STATUS_CREATED, ORDER_STATUS_PENDING,
+                             ORDER_STATUS_PAID, ORDER_STATUS_DELIVERED],
+    ORDER_STATUS_CANCELLED: [ORDER_STATUS_CREATED, ORDER_STATUS_CANCELLED],
+}
+
+
+class Command(BaseCommand):
+    help = ("Generate a synthetic dataset for load tests and benchmarks: tree of "
+            "categories, products with images, tags, specifications, reviews and "
+            "sales, users and orders. Rows are added by bulk inserts; rollups, "
+            "related products and trigram index are rebuilt at the end. Users are "
+            "named <bench_user_N> and have the same password (option --password).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=12,
+                            help="number of root categories")
+        parser.add_argument("--subcategories", type=int, default=8,
+                            help="number of subcategories of every root category")
+        parser.add_argument("--products", type=int, default=100000)
+        parser.add_argument("--images", type=int, default=2,
+                            help="images per product")
+        parser.add_argument("--specs", type=int, default=4,
+                            help="specifications per product")
+        parser.add_argument("--tags", type=int, default=300)
+        parser.add_argument("--tags-per-product", type=int, default=3)
+        parser.add_argument("--reviews", type=float, default=3,
+                            help="average number of reviews per product")
+        parser.add_argument("--sales", type=float, default=0.05,
+                            help="share of products with sale")
+        parser.add_argument("--users", type=int, default=2000)
+        parser.add_argument("--orders", type=int, default=20000)
+        parser.add_argument("--password", default="password",
+                            help="password of generated users")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+
+        users = self.create_users(options["users"], options["password"])
+        categories = self.create_categories(options["categories"],
+                                            options["subcategories"])
+        products = self.create_products(options["products"], categories, users[0])
+        self.create_images_and_specs(products, options["images"], options["specs"])
+        self.create_tags(products, options["tags"], options["tags_per_product"])
+        self.create_reviews(products, users, options["reviews"])
+        self.create_sales(products, options["sales"])
+        self.create_orders(products, users, options["orders"])
+
+        call_command("rebuild_sales_rollups", stdout=self.stdout)
+        call_command("rebuild_related_products", stdout=self.stdout)
+        call_command("rebuild_trigram_index", stdout=self.stdout)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Dataset is generated: {len(products)} products, {len(users)} users, "
+            f"{options['orders']} orders."
+        ))
+
+    def bulk_create(self, model, objects) -> list:
+        """
+        Insert objects by batches, every batch - one transaction.
+        """
+        created = []
+        for i in range(0, len(objects), self.batch_size):
+            with transaction.atomic():
+                created += model.objects.bulk_create(objects[i:i + self.batch_size])
+        return created
+
+    def create_users(self, count: int, password: str) -> list:
+        password = make_password(password)  # hash is computed once
+        start = User.objects.filter(username__startswith="bench_user_").count()
+
+        users = self.bulk_create(User, [
+            User(username=f"bench_user_{start + i}", password=password,
+                 email=f"bench_user_{start + i}@example.com",
+                 first_name=self.rng.choice(["Ivan", "Anna", "Oleg", "Maria"]),
+                 last_name=self.rng.choice(["Petrov", "Ivanova", "Smirnov", "Orlova"]))
+            for i in range(count)
+        ])
+        # post_save signal is not sent by <bulk_create>
+        self.bulk_create(Profile, [
+            Profile(belong_to_user=user,
+                    phone_number="+7" + "".join(self.rng.choices("0123456789", k=10)))
+            for user in users
+        ])
+        self.stdout.write(f"Users: {len(users)}")
+        return users
+
+    def create_categories(self, count: int, sub_count: int) -> list:
+        roots = self.bulk_create(Category, [
+            Category(title=f"{noun.capitalize()} {i}")
+            for i, noun in enumerate(self.rng.choices(NOUNS, k=count))
+        ])
+        subcategories = self.bulk_create(Category, [
+            Category(parent=root, title=f"{root.title} {adjective}")
+            for root in roots
+            for adjective in self.rng.choices(ADJECTIVES, k=sub_count)
+        ])
+        self.stdout.write(f"Categories: {len(roots) + len(subcategories)}")
+        return subcategories or roots
+
+    def create_products(self, count: int, categories: list, created_by) -> list:
+        products = []
+        for i in range(count):
+            title = " ".join([self.rng.choice(BRANDS), self.rng.choice(NOUNS),
+                              self.rng.choice(ADJECTIVES), str(i)])
+            products.append(Product(
+                category=self.rng.choice(categories),
+                title=title,
+                title_low=title.lower(),  # method <save> is not called
+                description_short=f"Short description of {title}",
+                description_full=f"Full description of {title}. " * 5,
+                price=Decimal(self.rng.randint(100, 200000)) / 100,
+                count=self.rng.randint(0, 500),
+                available=self.rng.random() > 0.1,
+                free_delivery=self.rng.random() > 0.7,
+                rating=Decimal(self.rng.randint(0, 500)) / 100,
+                limited_edition=self.rng.random() > 0.95,
+                created_by=created_by,
+            ))
+        products = self.bulk_create(Product, products)
+        self.stdout.write(f"Products: {len(products)}")
+        return products
+
+    def create_images_and_specs(self, products: list, images: int, specs: int) -> None:
+        # files are not created: names only (nginx serves missing files as 404)
+        self.bulk_create(ProductImage, [
+            ProductImage(product=product,
+                         image=f"products/product_{product.pk}/images/{n}.jpg",
+                         description=f"{product.title} {n}")
+            for product in products
+            for n in range(images)
+        ])
+        self.bulk_create(ProductSpec, [
+            ProductSpec(product=product, parameter=parameter,
+                        value=str(self.rng.randint(1, 1000)))
+            for product in products
+            for parameter in self.rng.sample(SPECS, min(specs, len(SPECS)))
+        ])
+        self.stdout.write(f"Images: {len(products) * images}, "
+                          f"specifications: {len(products) * min(specs, len(SPECS))}")
+
+    def create_tags(self, products: list, count: int, per_product: int) -> None:
+        tags = self.bulk_create(ProductTag, [
+            ProductTag(value=f"{self.rng.choice(ADJECTIVES)}-{i}") for i in range(count)
+        ])
+        if not tags:
+            return
+        through = ProductTag.product.through
+        links = {
+            (tag.pk, product.pk)
+            for product in products
+            for tag in self.rng.sample(tags, min(per_product, len(tags)))
+        }
+        self.bulk_create(through, [
+            through(producttag_id=tag_id, product_id=product_id)
+            for tag_id, product_id in links
+        ])
+        self.stdout.write(f"Tags: {len(tags)}, links with products: {len(links)}")
+
+    def create_reviews(self, products: list, users: list, average: float) -> None:
+        reviews = []
+        for product in products:
+            # skewed distribution: few products have many reviews
+            for _ in range(int(self.rng.expovariate(1 / average)) if average else 0):
+                reviews.append(ProductReview(
+                    product=product,
+                    user=self.rng.choice(users),
+                    text=f"Review of {product.title}",
+                    rate=self.rng.randint(1, 5),
+                ))
+            if len(reviews) >= self.batch_size:
+                self.bulk_create(ProductReview, reviews)
+                reviews = []
+        self.bulk_create(ProductReview, reviews)
+        self.stdout.write("Reviews are created")
+
+    def create_sales(self, products: list, share: float) -> None:
+        sales = self.bulk_create(Sale, [
+            Sale(product=product, price_sale=(product.price * Decimal("0.8")).quantize(
+                Decimal("0.01")))
+            for product in self.rng.sample(products, int(len(products) * share))
+        ])
+        self.stdout.write(f"Sales: {len(sales)}")
+
+    def create_orders(self, products: list, users: list, count: int) -> None:
+        statuses = self.rng.choices(list(ORDER_STATUSES),
+                                    weights=list(ORDER_STATUSES.values()), k=count)
+        # popular products are bought more often
+        cum_weights = list(accumulate(1 / (i + 1) for i in range(len(products))))
+        order_products = self.rng.sample(products, len(products))
+
+        for i in range(0, count, self.batch_size):
+            orders, baskets = [], []
+
+            for status in statuses[i:i + self.batch_size]:
+                basket = {product.pk: (product, self.rng.randint(1, 3))
+                          for product in self.rng.choices(
+                              order_products, cum_weights=cum_weights,
+                              k=self.rng.randint(1, 5))}
+                baskets.append(basket)
+                orders.append(Order(
+                    user=self.rng.choice(users),
+                    status=status,
+                    delivery_type=self.rng.choice(["ordinary", "express"]),
+                    delivery_city=self.rng.choice(CITIES),
+                    delivery_address=f"Street {self.rng.randint(1, 200)}",
+                    payment_type=self.rng.choice(["online", "someone"]),
+                    payment_total_cost=sum(product.price * quantity
+                                           for product, quantity in basket.values()),
+                ))
+
+            with transaction.atomic():
+                orders = Order.objects.bulk_create(orders)
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=product, quantity=quantity,
+                              price=product.price, title=product.title,
+                              image=f"products/product_{product.pk}/images/0.jpg",
+                              image_alt=product.title)
+                    for order, basket in zip(orders, baskets)
+                    for product, quantity in basket.values()
+                ])
+                OrderStatusLog.objects.bulk_create([
+                    OrderStatusLog(order=order, status_from=status_from,
+                                   status_to=status_to, changed_by=order.user)
+                    for order in orders
+                    for status_from, status_to in zip(
+                        [""] + ORDER_STATUS_PATHS[order.status],
+                        ORDER_STATUS_PATHS[order.status])
+                ])
+
+        self.stdout.write(f"Orders: {count}")
@@ -0,0 +1,50 @@
+
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from api_product.catalog_io import CatalogImporter, read_records
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ("Import products from CSV or JSONL file (format of records - see "
+            "api_product/catalog_io.py). Products are upserted by batches, "
+            "images are queued for command <process_image_queue>.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="path of the file, '-' - standard input")
+        parser.add_argument("--format", choices=["csv", "jsonl"],
+                            help="format of the file (by default - by extension)")
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--user", help="username of creator of new products "
+                                           "(by default - the first superuser)")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or ("csv" if path.endswith(".csv") else "jsonl")
+
+        if options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by("pk").first()
+        if user is None:
+            raise CommandError("Creator of products is not found (option --user).")
+
+        importer = CatalogImporter(user, options["batch_size"])
+        start = time.monotonic()
+
+        if path == "-":
+            stats = importer.run(read_records(sys.stdin, file_format))
+        else:
+            with open(path, encoding="utf-8", newline="") as file:
+                stats = importer.run(read_records(file, file_format))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Catalog is imported in {:.1f} s: ".format(time.monotonic() - start)
+            + ", ".join(f"{name.replace('_', ' ')} - {value}"
+                        for name, value in stats.items())
+        ))
@@ -0,0 +1,34 @@
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from api_product.catalog_io import process_image_queue
+
+
+class Command(BaseCommand):
+    help = ("Download or copy images of imported products (queue - model "
+            "ProductImageImport) and attach them to products.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=500,
+                            help="number of images processed at once")
+        parser.add_argument("--source-dir", default="",
+                            help="directory of local files with relative paths")
+        parser.add_argument("--workers", type=int, default=8,
+                            help="number of threads of downloading")
+        parser.add_argument("--loop", type=int, default=0,
+                            help="run as background worker: pause between runs "
+                                 "(seconds), 0 - run once")
+
+    def handle(self, *args, **options):
+        while True:
+            result = process_image_queue(options["limit"], options["source_dir"],
+                                         options["workers"])
+            if result["done"] or result["failed"] or not options["loop"]:
+                self.stdout.write(f"Images are processed: done - {result['done']}, "
+                                  f"failed - {result['failed']}")
+            if not options["loop"]:
+                return
+            if result["done"] + result["failed"] < options["limit"]:
+                time.sleep(options["loop"])
@@ -0,0 +1,30 @@
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api_product.models import Product, ProductTag, ProductTrigram, TagTrigram
+from api_product.trigrams import index_products, index_tags
+
+
+class Command(BaseCommand):
+    help = ("Delete the trigram index of titles of products and values of tags "
+            "(fuzzy search of the catalog) and build it again. Products are indexed "
+            "by batches, every batch - one transaction.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        ProductTrigram.objects.all().delete()
+        TagTrigram.objects.all().delete()
+
+        rows = 0
+        for model, index in ((Product, index_products), (ProductTag, index_tags)):
+            ids = model.objects.order_by("pk").values_list("pk", flat=True)
+            last_id = 0
+            while batch := list(ids.filter(pk__gt=last_id)[:options["batch_size"]]):
+                with transaction.atomic():
+                    rows += index(batch)
+                last_id = batch[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"Trigram index is rebuilt: {rows} rows"))
@@ -159,3 +159,94 @@ class Sale(models.Model):
     def __str__(self):
         return "Sale"
 
+
+
+class ProductNeighbor(models.Model):
+    """
+    Precomputed "frequently bought together" index: <score> - number of paid
+    orders, which contain both <product> and <neighbor>. Only top
+    RELATED_PRODUCTS_KEEP neighbors are kept for every product
+    (see recommendations.py).
+    """
+    class Meta:
+        unique_together = ("product", "neighbor")
+        indexes = [
+            models.Index(fields=["product", "-score"],
+                         name="neighbor_product_score_idx"),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE,
+                                related_name="neighbors")
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    score = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Product {self.neighbor_id} is bought with product {self.product_id}"
+
+
+class ProductTrigram(models.Model):
+    """
+    Trigram index of titles of products: one row per distinct trigram of product
+    (see trigrams.py, fuzzy search of the catalog).
+    Unique index <trigram, product> is used by search, index of <product> - by
+    updates of the index.
+    """
+    class Meta:
+        unique_together = ("trigram", "product")
+
+    trigram = models.CharField(max_length=3)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE,
+                                related_name="trigrams")
+
+    def __str__(self):
+        return f"Trigram <{self.trigram}> of product {self.product_id}"
+
+
+class TagTrigram(models.Model):
+    """
+    Trigram index of values of tags, the same as ProductTrigram (see trigrams.py).
+    """
+    class Meta:
+        unique_together = ("trigram", "tag")
+
+    trigram = models.CharField(max_length=3)
+    tag = models.ForeignKey(ProductTag, on_delete=models.CASCADE,
+                            related_name="trigrams")
+
+    def __str__(self):
+        return f"Trigram <{self.trigram}> of tag {self.tag_id}"
+
+
+IMAGE_IMPORT_PENDING = "pending"
+IMAGE_IMPORT_DONE = "done"
+IMAGE_IMPORT_FAILED = "failed"
+
+IMAGE_IMPORT_STATUS_CHOICES = [
+    (IMAGE_IMPORT_PENDING, "Pending"),
+    (IMAGE_IMPORT_DONE, "Done"),
+    (IMAGE_IMPORT_FAILED, "Failed"),
+]
+
+
+class ProductImageImport(models.Model):
+    """
+    Queue of images of imported products (see catalog_io.py): files are copied
+    or downloaded by command <process_image_queue>, not by the import.
+    <source> - URL or path of the file (relative to MEDIA_ROOT or absolute).
+    """
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="image_import_status_idx"),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE,
+                                related_name="image_imports")
+    source = models.CharField(max_length=512)
+    description = models.CharField(max_length=128, blank=True, default="")
+    status = models.CharField(max_length=8, default=IMAGE_IMPORT_PENDING,
+                              choices=IMAGE_IMPORT_STATUS_CHOICES)
+    error = models.CharField(max_length=256, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Image <{self.source}> for product {self.product_id}"
@@ -0,0 +1,95 @@
+"""
+Catalog data, which is loaded once in the master process of gunicorn
+(see megano_store/gunicorn_hooks.py) before workers are forked.
+Workers share these pages copy-on-write: data is stored as ready JSON
+of responses (one <bytes> object for response), so reading it does not
+touch many objects and does not rebuild or unpickle anything.
+Data is used during PRELOAD_TTL seconds (the same time as cache of categories
+and tags), then views read cache and DB as usual.
+
+Changes of categories and tags (signals, import of the catalog) delete their
+cache and change the version in the cache. Workers check the version once per
+PRELOAD_CHECK_INTERVAL seconds and drop preloaded data, which is built for
+another version.
+"""
+
+import json
+import time
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from megano_store.settings import PRELOAD_CHECK_INTERVAL, PRELOAD_TTL
+from .models import Category
+
+VERSION_CACHE_KEY = "preload_version"
+
+_preloaded = {}  # {name: JSON of response (bytes)}
+_loaded_at = 0.0
+_checked_at = 0.0
+_version = None
+
+
+def to_json(data) -> bytes:
+    """
+    Encode data the same way as JsonResponse does.
+    """
+    return json.dumps(data, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def get_version():
+    return cache.get(VERSION_CACHE_KEY)
+
+
+def store_preloaded(payloads: dict, version) -> None:
+    """
+    Replace preloaded data.
+    :param payloads: dictionary {name: data for JSON}
+    :param version: version, which is read before data (see <get_version>)
+    :return: None
+    """
+    global _loaded_at, _checked_at, _version
+    _preloaded.clear()
+    _preloaded.update({name: to_json(data) for name, data in payloads.items()})
+    _loaded_at = _checked_at = time.monotonic()
+    _version = version
+
+
+async def get_preloaded(name: str) -> bytes | None:
+    """
+    Get preloaded JSON of response, if it is not older than PRELOAD_TTL
+    and categories and tags are not changed after preloading.
+    :param name: name of data (see <store_preloaded>)
+    :return: bytes or None
+    """
+    global _checked_at
+    if not _preloaded:
+        return None
+
+    now = time.monotonic()
+    if now - _loaded_at > PRELOAD_TTL:
+        return None
+
+    if now - _checked_at >= PRELOAD_CHECK_INTERVAL:
+        _checked_at = now
+        if await cache.aget(VERSION_CACHE_KEY) != _version:
+            _preloaded.clear()
+            return None
+
+    return _preloaded.get(name)
+
+
+def _invalidate() -> None:
+    cache.delete_many(["rootcategories", "subcategories", "alltags"] +
+                      ["tagsfor" + str(pk)
+                       for pk in Category.objects.values_list("pk", flat=True)])
+    cache.set(VERSION_CACHE_KEY, time.time_ns(), None)
+
+
+def change_version() -> None:
+    """
+    Cached and preloaded categories and tags of all processes are dropped after
+    the commit of changes.
+    """
+    transaction.on_commit(_invalidate)
@@ -0,0 +1,90 @@
+
+from collections import Counter, defaultdict
+from itertools import permutations
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from megano_store.settings import RELATED_PRODUCTS_KEEP
+from megano_store.utils import add_increments
+from .models import ProductNeighbor
+
+# "Frequently bought together" is computed from co-occurrence of products
+# in paid orders. The index (model ProductNeighbor) is updated incrementally
+# by every paid order (see api_order/signals.py) and can be rebuilt
+# from the history of orders by command <rebuild_related_products>.
+
+
+def get_related_cache_key(product_id: int) -> str:
+    return "related" + str(product_id)
+
+
+def trim_neighbors(product_ids: list) -> None:
+    """
+    Keep only top RELATED_PRODUCTS_KEEP neighbors of products (one DELETE
+    for all products).
+    :param product_ids: list of ID of products
+    :return: None
+    """
+    extra = ProductNeighbor.objects.filter(product_id__in=product_ids).annotate(
+        position=Window(RowNumber(), partition_by=F("product_id"),
+                        order_by=[F("score").desc(), F("neighbor_id")])
+    ).filter(position__gt=RELATED_PRODUCTS_KEEP).values("pk")
+
+    ProductNeighbor.objects.filter(pk__in=extra).delete()
+
+
+def record_co_purchase(product_ids: list) -> None:
+    """
+    Add one paid order to the index: increase score of every pair of its products
+    (one upsert for all pairs, see <add_increments>). Extra neighbors are deleted
+    after the commit, the transaction of the payment does not wait for it.
+    :param product_ids: list of ID of products of the order
+    :return: None
+    """
+    product_ids = list(set(product_ids))
+
+    if len(product_ids) < 2:
+        return
+
+    add_increments(ProductNeighbor, ["product", "neighbor"], {
+        pair: {"score": 1} for pair in permutations(product_ids, 2)
+    })
+
+    def finish():
+        trim_neighbors(product_ids)
+        cache.delete_many([get_related_cache_key(pk) for pk in product_ids])
+
+    transaction.on_commit(finish)
+
+
+def rebuild_neighbors(baskets, batch_size: int = 1000) -> int:
+    """
+    Delete the index and compute it again.
+    :param baskets: iterable of lists of ID of products (one list - one paid order),
+      it is consumed once, so it can be a generator reading orders by chunks
+    :param batch_size: size of batch for <bulk_create>
+    :return: number of created rows
+    """
+    scores = defaultdict(Counter)
+
+    for basket in baskets:
+        for product_id, neighbor_id in permutations(set(basket), 2):
+            scores[product_id][neighbor_id] += 1
+
+    neighbors = []
+    for product_id, counter in scores.items():
+        top = sorted(counter.items(), key=lambda item: (-item[1], item[0]))
+        for neighbor_id, score in top[:RELATED_PRODUCTS_KEEP]:
+            neighbors.append(ProductNeighbor(product_id=product_id,
+                                             neighbor_id=neighbor_id, score=score))
+
+    with transaction.atomic():
+        ProductNeighbor.objects.all().delete()
+        ProductNeighbor.objects.bulk_create(neighbors, batch_size=batch_size)
+
+    cache.delete_many([get_related_cache_key(pk) for pk in scores])
+
+    return len(neighbors)
@@ -0,0 +1,70 @@
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .invalidation import change_products
+from .models import (Category, CategoryImage, Product, ProductImage, ProductReview,
+                     ProductTag)
+from .preload import change_version as change_preload_version
+from .snapshot import change_version as change_snapshot_version
+from .suggest import change_version
+from .trigrams import index_products, index_tags
+
+
+@receiver(post_save, sender=Product)
+def update_product_caches(sender, instance, update_fields=None, **kwargs):
+    change_products([instance.pk], update_fields)
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_caches(sender, instance, **kwargs):
+    change_products([instance.pk])
+
+
+@receiver(post_save, sender=ProductTag)
+@receiver(post_delete, sender=ProductTag)
+def update_suggest_index(sender, **kwargs):
+    change_version()
+
+
+@receiver(m2m_changed, sender=ProductTag.product.through)
+def update_suggest_tags(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        change_version()
+        change_snapshot_version()
+        change_preload_version()
+
+
+# cards of the snapshot have images, tags and number of reviews
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+@receiver(post_save, sender=ProductTag)
+@receiver(post_delete, sender=ProductTag)
+def update_catalog_snapshot(sender, **kwargs):
+    change_snapshot_version()
+
+
+# tree of categories, tags of categories (see preload.py)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=CategoryImage)
+@receiver(post_delete, sender=CategoryImage)
+@receiver(post_save, sender=ProductTag)
+@receiver(post_delete, sender=ProductTag)
+def update_preloaded_categories(sender, **kwargs):
+    change_preload_version()
+
+
+@receiver(post_save, sender=Product)
+def update_product_trigrams(sender, instance, update_fields=None, **kwargs):
+    # e.g. <save(update_fields=["rating"])> of reviews does not change the title
+    if update_fields is None or {"title", "title_low"} & set(update_fields):
+        index_products([instance.pk])
+
+
+@receiver(post_save, sender=ProductTag)
+def update_tag_trigrams(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or "value" in update_fields:
+        index_tags([instance.pk])
@@ -0,0 +1,292 @@
+"""
+Memory-mapped snapshot of the catalog, which is shared by all workers.
+
+The file SNAPSHOT_PATH is built by command <build_catalog_snapshot> (refresh
+process) and replaced by rename, so readers never see a partial file. Workers
+map it read-only: pages of the file are shared by all processes (page cache),
+columns are read without copying (memoryview of the mapping).
+
+Layout (little-endian, every part is aligned to 8 bytes):
+- HEADER_SIZE bytes: magic, JSON {"count", "built_at", "columns": {name:
+  [offset, typecode, length]}, "regions": {name: [offset, size]}};
+- columns of products (ordered by ID): "id", "price", "rating", "reviews",
+  "category" (0 - without category), "flags" (FLAG_*), "tag_offsets" +
+  "tag_ids" (tags of the row i: tag_ids[tag_offsets[i]:tag_offsets[i + 1]]),
+  "title_offsets" + "card_offsets" (offsets in regions, count + 1 values);
+- "order_<sort>" - rows sorted by price, rating, reviews and date (ascending),
+  so the catalog is filtered in the requested order without sorting;
+- region "titles" - <title_low> of products separated by zero bytes (the search
+  is one scan of the region), region "cards" - encoded JSON of products
+  (see <format_product_to_dict>), they are sent as is.
+
+The catalog view answers from the snapshot, if it is fresh (SNAPSHOT_MAX_AGE),
+fuzzy search and unknown sorts are answered by the database. Changes of
+products set the version in the cache, the refresh process rebuilds the
+snapshot, when the version is changed.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Prefetch
+
+from megano_store.routers import read_only_db
+from megano_store.settings import (SNAPSHOT_CHECK_INTERVAL, SNAPSHOT_MAX_AGE,
+                                   SNAPSHOT_PATH, STREAM_CHUNK_SIZE)
+from megano_store.streaming import encode
+from megano_store.utils import format_product_to_dict, write_errors
+from .models import Product, ProductImage
+
+MAGIC = b"MGSNAP01"
+HEADER_SIZE = 4096
+VERSION_CACHE_KEY = "snapshot_version"
+
+FLAG_AVAILABLE = 1
+FLAG_FREE_DELIVERY = 2
+
+SORTS = {"price": "price", "rating": "rating", "reviews": "reviews", "date": "date"}
+
+_lock = threading.Lock()
+_state = {"snapshot": None, "checked_at": 0.0, "stat": None}
+
+
+def align(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class CatalogSnapshot:
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"File <{path}> is not a snapshot of the catalog.")
+        header = json.loads(self.mm[len(MAGIC):HEADER_SIZE].rstrip(b" "))
+
+        self.count = header["count"]
+        self.built_at = header["built_at"]
+        view = memoryview(self.mm)
+        self.columns = {
+            name: view[offset:offset + length * array(typecode).itemsize].cast(typecode)
+            for name, (offset, typecode, length) in header["columns"].items()
+        }
+        self.regions = {name: (offset, size)
+                        for name, (offset, size) in header["regions"].items()}
+
+    def __len__(self):
+        return self.count
+
+    def find_titles(self, search: str) -> set:
+        """
+        :param search: lower-cased text
+        :return: set of rows, which titles contain the text
+        """
+        offset, size = self.regions["titles"]
+        title_offsets = self.columns["title_offsets"]
+        needle = search.encode("utf-8")
+        rows = set()
+
+        position = self.mm.find(needle, offset, offset + size)
+        while position != -1:
+            row = bisect_right(title_offsets, position - offset) - 1
+            rows.add(row)
+            # the next title
+            position = self.mm.find(needle, offset + title_offsets[row + 1],
+                                    offset + size)
+        return rows
+
+    def select(self, category: str | None, available: bool, free_delivery: bool,
+               price_min: int, price_max: int, tags: list, search: str,
+               sort_item: str, sort_mode: str) -> list | None:
+        """
+        Filter the catalog as the catalog view does.
+        :return: list of rows in the order of the response, None - the query is
+            not supported (unknown sort, search without exact matches)
+        """
+        if sort_item not in SORTS:
+            return None
+
+        matches = self.find_titles(search) if search else None
+        if matches is not None and not matches:
+            return None  # fuzzy search of the database
+
+        order = self.columns["order_" + SORTS[sort_item]]
+        if sort_mode == "dec":
+            order = reversed(order)
+
+        category_id = int(category) if category is not None else None
+        flags_required = ((FLAG_AVAILABLE if available else 0)
+                          | (FLAG_FREE_DELIVERY if free_delivery else 0))
+        tag_ids = set(map(int, tags))
+
+        prices, categories, flags = (self.columns["price"], self.columns["category"],
+                                     self.columns["flags"])
+        tag_offsets, product_tags = self.columns["tag_offsets"], self.columns["tag_ids"]
+
+        rows = []
+        for row in order:
+            if (flags[row] & flags_required != flags_required
+                    or not price_min < prices[row] <= price_max
+                    or category_id is not None and categories[row] != category_id
+                    or matches is not None and row not in matches):
+                continue
+            if tag_ids and tag_ids.isdisjoint(
+                    product_tags[tag_offsets[row]:tag_offsets[row + 1]]):
+                continue
+            rows.append(row)
+
+        if search and not rows:
+            return None
+        return rows
+
+    def iter_cards(self, rows: list):
+        """
+        :return: iterator of encoded JSON of products
+        """
+        offset = self.regions["cards"][0]
+        card_offsets = self.columns["card_offsets"]
+        for row in rows:
+            yield self.mm[offset + card_offsets[row]:offset + card_offsets[row + 1]]
+
+
+def get_snapshot() -> CatalogSnapshot | None:
+    """
+    Snapshot of this process, the file is checked once per SNAPSHOT_CHECK_INTERVAL
+    seconds and mapped again, when it is replaced.
+    :return: CatalogSnapshot or None (there is no fresh snapshot)
+    """
+    now = time.monotonic()
+    if now - _state["checked_at"] >= SNAPSHOT_CHECK_INTERVAL:
+        with _lock:
+            _state["checked_at"] = now
+            try:
+                stat = os.stat(SNAPSHOT_PATH)
+                key = (stat.st_ino, stat.st_mtime_ns)
+                if key != _state["stat"]:
+                    # the old mapping is kept by responses, which are being sent
+                    _state.update(snapshot=CatalogSnapshot(SNAPSHOT_PATH), stat=key)
+            except FileNotFoundError:
+                _state.update(snapshot=None, stat=None)
+            except (OSError, ValueError) as exc:
+                _state.update(snapshot=None, stat=None)
+                write_errors({"SnapshotError": f"{type(exc).__name__} : {exc}"},
+                             "errors_from_snapshot.log")
+
+    snapshot = _state["snapshot"]
+    if snapshot is None or time.time() - snapshot.built_at > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot
+
+
+def write_snapshot(path: str) -> int:
+    """
+    Read the catalog and write the snapshot to the temporary file, which
+    replaces the file <path>.
+    :return: number of products
+    """
+    ids, prices, ratings = array("q"), array("d"), array("d")
+    reviews, categories, flags, dates = array("L"), array("q"), array("B"), array("d")
+    tag_offsets, tag_ids = array("L", [0]), array("q")
+    title_offsets, card_offsets = array("Q", [0]), array("Q", [0])
+    titles = bytearray()
+
+    directory = os.path.dirname(path)
+    with tempfile.TemporaryFile() as cards, read_only_db():
+        products = Product.objects.annotate(
+            reviews_count=Count("reviews")
+        ).prefetch_related(
+            Prefetch("images",
+                     queryset=ProductImage.objects.only("product_id", "image",
+                                                        "description")),
+            "tags"
+        ).order_by("pk")
+
+        for product in products.iterator(chunk_size=STREAM_CHUNK_SIZE):
+            ids.append(product.pk)
+            prices.append(float(product.price))
+            ratings.append(float(product.rating))
+            reviews.append(product.reviews_count)
+            categories.append(product.category_id or 0)
+            flags.append((FLAG_AVAILABLE if product.available else 0)
+                         | (FLAG_FREE_DELIVERY if product.free_delivery else 0))
+            dates.append(product.created_at.timestamp())
+
+            tag_ids.extend(tag.pk for tag in product.tags.all())
+            tag_offsets.append(len(tag_ids))
+
+            titles += product.title_low.encode("utf-8") + b"\0"
+            title_offsets.append(len(titles))
+
+            card_offsets.append(card_offsets[-1] + cards.write(
+                encode(format_product_to_dict(product))
+            ))
+
+        rows = range(len(ids))
+        columns = {
+            "id": ids, "price": prices, "rating": ratings, "reviews": reviews,
+            "category": categories, "flags": flags, "tag_offsets": tag_offsets,
+            "tag_ids": tag_ids, "title_offsets": title_offsets,
+            "card_offsets": card_offsets,
+        }
+        # ties are ordered by ID
+        for name, values in (("price", prices), ("rating", ratings),
+                             ("reviews", reviews), ("date", dates)):
+            columns["order_" + name] = array("L", sorted(rows, key=values.__getitem__))
+
+        header = {"count": len(ids), "built_at": time.time(),
+                  "columns": {}, "regions": {}}
+        offset = HEADER_SIZE
+        for name, values in columns.items():
+            header["columns"][name] = [offset, values.typecode, len(values)]
+            offset = align(offset + len(values) * values.itemsize)
+        header["regions"]["titles"] = [offset, len(titles)]
+        offset = align(offset + len(titles))
+        header["regions"]["cards"] = [offset, card_offsets[-1]]
+
+        head = MAGIC + json.dumps(header).encode("utf-8")
+        if len(head) > HEADER_SIZE:
+            raise ValueError("Header of the snapshot is too large.")
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(head.ljust(HEADER_SIZE, b" "))
+                for values in list(columns.values()) + [titles]:
+                    data = values.tobytes() if isinstance(values, array) else values
+                    file.write(data + b"\0" * (align(len(data)) - len(data)))
+                cards.seek(0)
+                shutil.copyfileobj(cards, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)  # readers see the old or the new file
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    return len(ids)
+
+
+def get_version():
+    return cache.get(VERSION_CACHE_KEY)
+
+
+async def aget_version():
+    return await cache.aget(VERSION_CACHE_KEY)
+
+
+def change_version() -> None:
+    """
+    The snapshot is rebuilt by the refresh process after the commit of changes.
+    """
+    transaction.on_commit(lambda: cache.set(VERSION_CACHE_KEY, time.time_ns(), None))
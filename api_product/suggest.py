@@ -0,0 +1,172 @@
+"""
+Suggestions of the search box (endpoint search/suggest?q=), they are answered
+from memory of the process, not from the database.
+
+<PrefixIndex> - flattened trie of lower-cased keys:
+- keys of products are suffixes of <title_low> from the start of every word
+  ("apple iphone 13" -> "apple iphone 13", "iphone 13", "13"), so the query
+  matches the start of any word; keys of tags are their values;
+- every prefix up to SUGGEST_PREFIX_DEPTH characters (node of the trie) keeps
+  top SUGGEST_LIMIT items, items are ranked by rating of product
+  (tags - by number of products);
+- longer prefixes are found by binary search in the sorted list of keys.
+
+The index is built once per process (in the master process of gunicorn before
+fork, see megano_store/gunicorn_hooks.py) and rebuilt in the background thread,
+when changes of products and tags (signals, import of the catalog) have changed
+the version in the cache. The version is checked once per SUGGEST_CHECK_INTERVAL
+seconds, the old index answers until the new one is ready.
+"""
+
+import heapq
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import Count
+
+from megano_store.routers import read_only_db
+from megano_store.settings import (SUGGEST_CHECK_INTERVAL, SUGGEST_KEY_LENGTH,
+                                   SUGGEST_LIMIT, SUGGEST_PREFIX_DEPTH)
+from megano_store.utils import write_errors
+from .models import Product, ProductTag
+
+VERSION_CACHE_KEY = "suggest_version"
+MAX_CHAR = "\U0010ffff"
+
+_re_word = re.compile(r"\w+")
+_re_spaces = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_state = {"index": None, "checked_at": 0.0, "building": False}
+
+
+class PrefixIndex:
+
+    def __init__(self, items: list, keys):
+        """
+        :param items: ranked items (the best first), tuples (id, title)
+        :param keys: iterable of (key, position of item in <items>)
+        """
+        self.items = items
+        entries = sorted(set(keys))
+        self.keys = [key for key, _ in entries]
+        self.positions = array("L", [position for _, position in entries])
+
+        top = {}
+        for key, position in sorted(entries, key=lambda entry: entry[1]):
+            for length in range(1, min(len(key), SUGGEST_PREFIX_DEPTH) + 1):
+                node = top.setdefault(key[:length], [])
+                if len(node) < SUGGEST_LIMIT and position not in node:
+                    node.append(position)
+        self.top = {prefix: tuple(node) for prefix, node in top.items()}
+
+    def __len__(self):
+        return len(self.items)
+
+    def search(self, prefix: str, limit: int = SUGGEST_LIMIT) -> list:
+        """
+        :param prefix: lower-cased query
+        :return: list of items (id, title)
+        """
+        if len(prefix) <= SUGGEST_PREFIX_DEPTH:
+            positions = self.top.get(prefix, ())[:limit]
+        else:
+            start = bisect_left(self.keys, prefix)
+            end = bisect_left(self.keys, prefix + MAX_CHAR, start)
+            positions = heapq.nsmallest(limit, set(self.positions[start:end]))
+        return [self.items[position] for position in positions]
+
+
+def get_title_keys(title_low: str) -> list:
+    return [title_low[match.start():][:SUGGEST_KEY_LENGTH]
+            for match in _re_word.finditer(title_low)]
+
+
+def build_index() -> dict:
+    """
+    Read products and tags and build indexes.
+    :return: dictionary {"products": PrefixIndex, "tags": PrefixIndex, "version": ...}
+    """
+    version = cache.get(VERSION_CACHE_KEY)  # changes after it - the next rebuild
+
+    with read_only_db():
+        products = Product.objects.order_by("-rating", "pk").values_list(
+            "pk", "title", "title_low"
+        )
+        items, keys = [], []
+        for position, (pk, title, title_low) in enumerate(products.iterator(2000)):
+            items.append((pk, title))
+            keys += [(key, position) for key in get_title_keys(title_low)]
+        product_index = PrefixIndex(items, keys)
+
+        tags = ProductTag.objects.annotate(products=Count("product")).order_by(
+            "-products", "pk"
+        ).values_list("pk", "value")
+        items = list(tags)
+        tag_index = PrefixIndex(items, [(value.lower()[:SUGGEST_KEY_LENGTH], position)
+                                        for position, (_, value) in enumerate(items)])
+
+    return {"products": product_index, "tags": tag_index, "version": version}
+
+
+def load_index() -> None:
+    """
+    Build the index in this process (master process of gunicorn before fork).
+    """
+    index = build_index()
+    with _lock:
+        _state.update(index=index, checked_at=time.monotonic())
+
+
+def _rebuild() -> None:
+    try:
+        index = build_index()
+        with _lock:
+            _state["index"] = index
+    except Exception as exc:  # the old index is used
+        write_errors({"SuggestIndexError": f"{type(exc).__name__} : {exc}"},
+                     "errors_from_suggest.log")
+    finally:
+        _state["building"] = False
+        connections.close_all()  # connections of this thread
+
+
+async def get_index() -> dict:
+    """
+    Current index of the process, the rebuild is started if the version is changed.
+    """
+    index = _state["index"]
+    if index is None:
+        await sync_to_async(load_index)()
+        return _state["index"]
+
+    now = time.monotonic()
+    if now - _state["checked_at"] < SUGGEST_CHECK_INTERVAL:
+        return index
+    _state["checked_at"] = now
+
+    if await cache.aget(VERSION_CACHE_KEY) != index["version"]:
+        with _lock:
+            if _state["building"]:
+                return index
+            _state["building"] = True
+        threading.Thread(target=_rebuild, name="suggest-index", daemon=True).start()
+    return index
+
+
+def normalize_query(query: str) -> str:
+    return _re_spaces.sub(" ", query.strip().lower())[:SUGGEST_KEY_LENGTH]
+
+
+def change_version() -> None:
+    """
+    Indexes of all processes are rebuilt after the commit of changes.
+    """
+    transaction.on_commit(lambda: cache.set(VERSION_CACHE_KEY, time.time_ns(), None))
+
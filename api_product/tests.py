@@ -1,3 +1,245 @@
-# from django.test import TestCase
+import json
+import os
+import tempfile
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import AsyncClient, TestCase
+from django.urls import reverse
+
+from megano_store.queries import query_budget
+from megano_store.settings import QUERY_BUDGETS
+from megano_store.testing import test_settings
+from .models import (Category, Product, ProductImage, ProductNeighbor, ProductReview,
+                     ProductSpec, ProductTag, Sale)
+from .invalidation import change_products
+from .recommendations import record_co_purchase
+from .snapshot import write_snapshot
+
+User = get_user_model()
+
+CATALOG_QUERY = {"filter[name]": "", "filter[minPrice]": "0",
+                 "filter[maxPrice]": "1000000", "filter[freeDelivery]": "false",
+                 "filter[available]": "false", "currentPage": "1", "limit": "20",
+                 "sort": "price", "sortType": "inc"}
+
+
+@test_settings
+class CatalogTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="seller", password="Secret-123")
+        cls.root = Category.objects.create(title="Electronics")
+        cls.categories = [Category.objects.create(parent=cls.root, title=title)
+                          for title in ("Phones", "Laptops")]
+        cls.tags = [ProductTag.objects.create(value=value)
+                    for value in ("new", "gaming")]
+
+        # prices, ratings and numbers of reviews are distinct: every sort has
+        # the only order
+        cls.products = []
+        for i in range(6):
+            product = Product.objects.create(
+                category=cls.categories[i % 2], title=f"Model {i} X{i % 3}",
+                description_short=f"Short {i}", price=Decimal(1000 - 100 * i),
+                rating=Decimal(i) / 2, count=5, available=i != 4,
+                free_delivery=i % 3 == 0, limited_edition=i < 2,
+                created_by=cls.user
+            )
+            ProductImage.objects.create(product=product, description=f"Image {i}")
+            ProductSpec.objects.create(product=product, parameter="Color",
+                                       value="black")
+            ProductReview.objects.bulk_create(
+                ProductReview(product=product, user=cls.user, rate=5)
+                for _ in range(i)
+            )
+            product.tags.add(cls.tags[i % 2])
+            cls.products.append(product)
+
+        today = date.today()
+        Sale.objects.create(product=cls.products[0], price_sale=Decimal(900),
+                            date_from=today - timedelta(days=1),
+                            date_to=today + timedelta(days=1))
+
+    def setUp(self):
+        cache.clear()
+
+    def get_catalog(self, **query) -> list:
+        response = self.client.get(reverse("api_product:catalog"),
+                                   {**CATALOG_QUERY, **query})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.getvalue())
+
+
+class CatalogSnapshotTest(CatalogTestCase):
+
+    QUERIES = [
+        {},
+        {"sort": "price", "sortType": "dec"},
+        {"sort": "rating", "sortType": "dec"},
+        {"sort": "reviews", "sortType": "dec"},
+        {"sort": "date", "sortType": "inc"},
+        {"filter[available]": "true", "filter[freeDelivery]": "true"},
+        {"filter[minPrice]": "500", "filter[maxPrice]": "900"},
+        {"tags[]": ["TAG"]},
+        {"filter[name]": "x1"},
+        {"currentPage": "2", "limit": "4"},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "catalog.snapshot")
+
+        # the snapshot of the process is checked again at every request and is
+        # not kept by the next tests
+        for patcher in (mock.patch("api_product.snapshot.SNAPSHOT_PATH", self.path),
+                        mock.patch("api_product.snapshot.SNAPSHOT_CHECK_INTERVAL", 0),
+                        mock.patch.dict("api_product.snapshot._state")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_queries(self) -> list:
+        queries = [{**query, "tags[]": [str(self.tags[1].pk)]}
+                   if query.get("tags[]") == ["TAG"] else query
+                   for query in self.QUERIES]
+        return queries + [{"category": str(category.pk)} for category in self.categories]
+
+    def test_snapshot_matches_database(self):
+        expected = [self.get_catalog(**query) for query in self.get_queries()]
+
+        self.assertEqual(write_snapshot(self.path), len(self.products))
+        cache.clear()
+
+        with query_budget(0, "catalog snapshot"):
+            for query, items in zip(self.get_queries(), expected):
+                with self.subTest(query=query):
+                    self.assertEqual(self.get_catalog(**query), items)
+
+    def test_database_answers_fuzzy_search(self):
+        write_snapshot(self.path)
+
+        with query_budget(QUERY_BUDGETS["api_product:catalog"]) as recorder:
+            items = self.get_catalog(**{"filter[name]": "modell"})
+
+        self.assertTrue(len(recorder))
+        self.assertTrue(items["items"])
+
+
+class ProductCachesTest(CatalogTestCase):
+
+    def get_ids(self, name: str, **kwargs) -> list:
+        response = self.client.get(reverse(name, kwargs=kwargs))
+        return [item["id"] for item in response.json()]
+
+    def test_bulk_update_drops_caches(self):
+        sold_out, other = self.products[:2]
+        with self.captureOnCommitCallbacks(execute=True):
+            record_co_purchase([sold_out.pk, other.pk])
+
+        self.assertEqual(self.get_ids("api_product:limited"), [sold_out.pk, other.pk])
+        self.assertEqual(self.get_ids("api_product:related", pk=other.pk), [sold_out.pk])
+        catalog = self.get_catalog()["items"]
+
+        # the payment writes products by <bulk_update>, signals are not sent
+        Product.objects.filter(pk=sold_out.pk).update(count=0, available=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            change_products([sold_out.pk], ["count", "available"])
+
+        self.assertEqual(self.get_ids("api_product:limited"), [other.pk])
+        self.assertEqual(self.get_ids("api_product:related", pk=other.pk), [])
+        card = self.client.get(reverse("api_product:product", kwargs={"pk": sold_out.pk}))
+        self.assertEqual(card.json()["count"], 0)
+        self.assertNotEqual(self.get_catalog()["items"], catalog)
+
+
+class RelatedProductsTest(CatalogTestCase):
+
+    @mock.patch("api_product.recommendations.RELATED_PRODUCTS_KEEP", 2)
+    def test_top_neighbors_are_kept(self):
+        ids = [product.pk for product in self.products]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record_co_purchase(ids[:4])
+            record_co_purchase(ids[:3])
+            record_co_purchase([ids[0], ids[2]])
+
+        neighbors = {}
+        for row in ProductNeighbor.objects.order_by("-score", "neighbor_id"):
+            neighbors.setdefault(row.product_id, []).append((row.neighbor_id, row.score))
+
+        self.assertEqual(neighbors, {
+            ids[0]: [(ids[2], 3), (ids[1], 2)],
+            ids[1]: [(ids[0], 2), (ids[2], 2)],
+            ids[2]: [(ids[0], 3), (ids[1], 2)],
+            ids[3]: [(ids[0], 1), (ids[1], 1)],
+        })
+
+
+class FuzzySearchTest(CatalogTestCase):
+
+    def test_misspelled_tag(self):
+        items = self.get_catalog(**{"filter[name]": "gamink"})["items"]
+
+        self.assertEqual({item["id"] for item in items},
+                         {product.pk for product in self.products[1::2]})
+
+
+class QueryBudgetTest(CatalogTestCase):
+
+    def assert_budget(self, name: str, *args):
+        with query_budget(QUERY_BUDGETS[name], name):
+            response = self.client.get(*args)
+            response.getvalue()  # streamed lists are read from the database here
+        self.assertEqual(response.status_code, 200)
+
+    def test_views_of_catalog(self):
+        product_id = self.products[0].pk
+
+        self.assert_budget("api_product:categories", reverse("api_product:categories"))
+        self.assert_budget("api_product:tags", reverse("api_product:tags"),
+                           {"category": self.categories[0].pk})
+        self.assert_budget("api_product:banners", reverse("api_product:banners"))
+        self.assert_budget("api_product:limited", reverse("api_product:limited"))
+        self.assert_budget("api_product:popular", reverse("api_product:popular"))
+        self.assert_budget("api_product:sales", reverse("api_product:sales"),
+                           {"currentPage": "1"})
+        self.assert_budget("api_product:product",
+                           reverse("api_product:product", kwargs={"pk": product_id}))
+        self.assert_budget("api_product:related",
+                           reverse("api_product:related", kwargs={"pk": product_id}))
+
+    def test_catalog(self):
+        for query in ({}, {"sort": "reviews", "sortType": "dec"},
+                      {"category": str(self.categories[0].pk)},
+                      {"tags[]": [str(tag.pk) for tag in self.tags]},
+                      {"filter[name]": "model 1"}, {"filter[name]": "modell"},
+                      {"filter[name]": "gamink"}):
+            self.assert_budget("api_product:catalog", reverse("api_product:catalog"),
+                               {**CATALOG_QUERY, **query})
+
+    def test_streamed_queries_are_recorded(self):
+        # queries of the streamed list are executed after the view has returned
+        with mock.patch("megano_store.metrics.record_request") as record_request:
+            response = self.client.get(reverse("api_product:catalog"), CATALOG_QUERY)
+            record_request.assert_not_called()
+            response.getvalue()
+
+        record_request.assert_called_once()
+        self.assertGreater(record_request.call_args.args[2].queries, 0)
+
+    async def test_streamed_queries_are_recorded_under_asgi(self):
+        with mock.patch("megano_store.metrics.record_request") as record_request:
+            response = await AsyncClient().get(reverse("api_product:catalog"),
+                                               CATALOG_QUERY)
+            record_request.assert_not_called()
+            self.assertTrue(response.is_async)
+            [chunk async for chunk in response.streaming_content]
+
+        record_request.assert_called_once()
+        self.assertGreater(record_request.call_args.args[2].queries, 0)
@@ -0,0 +1,167 @@
+"""
+Typo-tolerant (fuzzy) search of the catalog by trigram index.
+
+Trigrams of <title_low> of products are stored in the table of ProductTrigram
+(one row per distinct trigram of product), trigrams of values of tags - in the
+table of TagTrigram. Every word is padded by spaces
+("кот" -> " ко", "кот", "от "), so the start and the end of the word have
+their own trigrams; "ё" is the same as "е". Trigrams "  к" of pg_trgm
+(the first letter) are not stored: they are the most frequent ones, every query
+would read a large part of the index.
+
+Similarity - share of trigrams of the query, which are found in the text.
+Search among products of the filtered catalog (filters are applied before
+the limit of candidates):
+- products, which have at least FUZZY_MIN_SIMILARITY of trigrams of the query
+  (one GROUP BY query by the unique index <trigram, product>, the table of
+  products is not scanned);
+- tags, which are similar to the query (the same query by the index of tags),
+  add their products with similarity of the tag, the most similar tags first
+  (products of all tags are read by one query);
+up to FUZZY_CANDIDATES products are ranked by similarity.
+
+The index is updated by signals (api_product/signals.py) and by the import of
+the catalog, command <rebuild_trigram_index> builds it for the whole catalog.
+"""
+
+import re
+from math import ceil
+
+from django.db import connection
+from django.db.models import Count, F, QuerySet, Window
+from django.db.models.functions import RowNumber
+
+from megano_store.settings import FUZZY_CANDIDATES, FUZZY_MIN_SIMILARITY
+from .models import Product, ProductTag, ProductTrigram, TagTrigram
+
+_re_word = re.compile(r"\w+")
+
+
+def get_trigrams(text: str) -> set:
+    trigrams = set()
+    for word in _re_word.findall(text.lower().replace("ё", "е")):
+        padded = " " + word + " "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def insert_trigrams(model, field: str, rows: list) -> None:
+    """
+    Rows are inserted by one <executemany> (see <insert_rows> of catalog_io.py).
+    :param rows: list of tuples (trigram, ID)
+    """
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO {} ({}, {}) VALUES (%s, %s)".format(
+                quote(model._meta.db_table),
+                quote(model._meta.get_field("trigram").column),
+                quote(model._meta.get_field(field).column)),
+            rows
+        )
+
+
+def index_products(product_ids: list) -> int:
+    """
+    Compute trigrams of products again (call it inside the transaction of
+    changes of products).
+    :param product_ids: list of ID of products
+    :return: number of rows of the index
+    """
+    if not product_ids:
+        return 0
+
+    titles = Product.objects.filter(pk__in=product_ids).values_list("pk", "title_low")
+
+    ProductTrigram.objects.filter(product_id__in=product_ids).delete()
+
+    rows = [(trigram, product_id) for product_id, title_low in titles
+            for trigram in get_trigrams(title_low)]
+    insert_trigrams(ProductTrigram, "product", rows)
+    return len(rows)
+
+
+def index_tags(tag_ids: list) -> int:
+    """
+    Compute trigrams of tags again (call it inside the transaction of changes).
+    :param tag_ids: list of ID of tags
+    :return: number of rows of the index
+    """
+    if not tag_ids:
+        return 0
+
+    values = ProductTag.objects.filter(pk__in=tag_ids).values_list("pk", "value")
+
+    TagTrigram.objects.filter(tag_id__in=tag_ids).delete()
+
+    rows = [(trigram, tag_id) for tag_id, value in values
+            for trigram in get_trigrams(value)]
+    insert_trigrams(TagTrigram, "tag", rows)
+    return len(rows)
+
+
+async def search_similar(query: str, products: QuerySet) -> list:
+    """
+    Products, which are similar to the query (misspelled title or tag).
+    :param query: text of the search
+    :param products: filtered queryset of products (category, price, tags, ...)
+    :return: list of tuples (ID of product, similarity), the most similar first
+    """
+    trigrams = get_trigrams(query)
+    if not trigrams:
+        return []
+
+    min_common = ceil(len(trigrams) * FUZZY_MIN_SIMILARITY)
+    # the subquery of the whole catalog would be read into a temporary table
+    in_catalog = ({"product_id__in": products.values("pk")}
+                  if products.query.has_filters() else {})
+
+    candidates = ProductTrigram.objects.filter(
+        trigram__in=trigrams, **in_catalog
+    ).values("product_id").annotate(
+        common=Count("pk")
+    ).filter(
+        common__gte=min_common
+    ).order_by("-common", "product_id").values_list("product_id", "common")
+
+    similar = {product_id: common / len(trigrams)
+               async for product_id, common in candidates[:FUZZY_CANDIDATES]}
+
+    tags = TagTrigram.objects.filter(
+        trigram__in=trigrams
+    ).values("tag_id").annotate(
+        common=Count("pk")
+    ).filter(
+        common__gte=min_common
+    ).order_by("-common", "tag_id").values_list("tag_id", "common")
+
+    tag_common = {tag_id: common async for tag_id, common in tags}
+    if tag_common:
+        # products of all similar tags by one query, up to FUZZY_CANDIDATES
+        # products of every tag
+        rows = ProductTag.product.through.objects.filter(
+            producttag_id__in=list(tag_common), **in_catalog
+        ).annotate(
+            position=Window(RowNumber(), partition_by=F("producttag_id"),
+                            order_by=F("pk").asc())
+        ).filter(
+            position__lte=FUZZY_CANDIDATES
+        ).values_list("producttag_id", "product_id")
+
+        products_of_tags = {}
+        async for tag_id, product_id in rows:
+            products_of_tags.setdefault(tag_id, []).append(product_id)
+
+        # the most similar tags first, till the limit of candidates is reached
+        tagged = set()
+        for tag_id, common in tag_common.items():
+            for product_id in products_of_tags.get(tag_id, [])[
+                    :FUZZY_CANDIDATES - len(tagged)]:
+                tagged.add(product_id)
+                similar[product_id] = max(similar.get(product_id, 0),
+                                          common / len(trigrams))
+
+            if len(tagged) >= FUZZY_CANDIDATES:
+                break
+
+    return sorted(similar.items(), key=lambda item: (-item[1], item[0]))[:FUZZY_CANDIDATES]
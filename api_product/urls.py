@@ -18,4 +18,6 @@ urlpatterns = [
     path("product/<int:pk>/", views.get_product_view, name="product"),
     path("product/<int:pk>/reviews", views.write_review_view,
          name="product-review"),
+    path("product/<int:pk>/related", views.get_related_view, name="related"),
+    path("search/suggest", views.get_suggest_view, name="suggest"),
 ]
@@ -1,29 +1,49 @@
 
 from math import ceil
+import hashlib
 import json
 
-from django.core.cache import cache
-from django.db.models import Count, Prefetch
-from django.http import HttpRequest, JsonResponse
+from asgiref.sync import sync_to_async
+from django.db.models import Case, Count, Prefetch, Value, When
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
 
+from megano_store.caching import aget_or_build
+from megano_store.ratelimit import rate_limit
+from megano_store.routers import use_read_only_db
 from megano_store.settings import (DEBUG, CATEGORY_ID, RATING_VALUE,
                                    PRODUCT_LIMIT, PAGE_ITEM_LIMIT)
+from megano_store.streaming import (acache_json_list, get_cached_json_list,
+                                    stream_encoded_list, stream_json_list)
 from megano_store.utils import (apply_exception_handler, get_user_fullname,
-                                format_queryset_to_list, format_instance_to_dict)
-from .models import (Category, Product, ProductImage, ProductTag, ProductReview, Sale)
-
-
-def get_categories(sub=True) -> list:
+                                format_queryset_to_list, format_product_to_dict,
+                                format_instance_to_dict)
+from .models import (Category, Product, ProductImage, ProductTag, ProductReview, Sale,
+                     ProductNeighbor)
+from .invalidation import (BANNERS_CACHE_KEY, LIMITED_CACHE_KEY, POPULAR_CACHE_KEY,
+                           SALES_CACHE_KEY, get_product_cache_key)
+from .preload import get_preloaded
+from .recommendations import get_related_cache_key
+from .snapshot import aget_version as aget_snapshot_version, get_snapshot
+from .suggest import get_index, normalize_query
+from .trigrams import search_similar
+
+# Read-only views are asynchronous (async ORM and cache calls): under ASGI server
+# (see server_config/gunicorn_asgi.conf.py) a slow read does not hold a worker.
+# Lazy queries are not allowed in them, so everything must be prefetched.
+# Cached data is served stale after its timeout, while it is rebuilt in the
+# background (see megano_store/caching.py).
+
+
+async def get_categories(sub=True) -> list:
     """
     Get from cache or DB: root categories or subcategories (the same table)
     :param sub: if True - get subcategories else - root categories
     :return: list of dictionary
     """
     cache_key = "subcategories" if sub else "rootcategories"
-    categories_list = cache.get(cache_key)
 
-    if categories_list is None:
+    async def build() -> list:
 
         if sub:
             categories = Category.objects.exclude(parent=None)
@@ -34,8 +54,9 @@ def get_categories(sub=True) -> list:
 
         categories_list = []
 
-        for category in categories:
-            first_image = category.images.first()
+        async for category in categories:
+            images = category.images.all()  # prefetched, <first()> makes a query
+            first_image = images[0] if images else None
             image_data = {"src": "", "alt": ""}
 
             if first_image:
@@ -52,22 +73,19 @@ def get_categories(sub=True) -> list:
 
             categories_list.append(category_dict)
 
-        if not DEBUG:
-            cache.set(cache_key, categories_list, 7200)
+        return categories_list
 
-    return categories_list
+    return await aget_or_build(cache_key, build, 7200)
 
 
-@apply_exception_handler
-def get_categories_view(request: HttpRequest) -> JsonResponse:
+async def get_categories_tree() -> list:
     """
     Invoke func <get_categories> then compose gotten root categories and subcategories
     to list of dictionary for frontend.
-    :param request: HttpRequest
-    :return: list of dictionary into JsonResponse
+    :return: list of dictionary
     """
-    categories_root = get_categories(sub=False)
-    categories_sub = get_categories()
+    categories_root = await get_categories(sub=False)
+    categories_sub = await get_categories()
 
     for category_root in categories_root:
         for category_sub in categories_sub:
@@ -76,10 +94,28 @@ def get_categories_view(request: HttpRequest) -> JsonResponse:
                     category_sub.pop("parent_id", None)
                     category_root["subcategories"].append(category_sub)
 
+    return categories_root
+
+
+@apply_exception_handler
+@use_read_only_db
+async def get_categories_view(request: HttpRequest) -> HttpResponse:
+    """
+    Get tree of categories: preloaded in the master process of gunicorn
+    (see preload.py) or composed by function <get_categories_tree>.
+    :param request: HttpRequest
+    :return: list of dictionary into JsonResponse
+    """
+    content = await get_preloaded("categories")
+    if content is not None:
+        return HttpResponse(content, content_type="application/json", status=200)
+
+    categories_root = await get_categories_tree()
+
     return JsonResponse(categories_root, safe=False, status=200)
 
 
-def get_tags(category_id="") -> list:
+async def get_tags(category_id="") -> list:
     """
     Get tags for products of all categories or only selected categories
     (product availability is not taken into account), then create list from them
@@ -87,9 +123,8 @@ def get_tags(category_id="") -> list:
     :return: list of tags
     """
     cache_key = "alltags" if category_id=="" else "tagsfor" + category_id
-    tags_list = cache.get(cache_key)
 
-    if tags_list is None:
+    async def build() -> list:
 
         tags_list = []
         if category_id:
@@ -98,34 +133,40 @@ def get_tags(category_id="") -> list:
             tags = ProductTag.objects.all()
         tags = tags.distinct()
 
-        for tag in tags:
+        async for tag in tags:
             tags_list.append({"id": tag.pk, "name": tag.value})
 
-        if not DEBUG:
-            cache.set(cache_key, tags_list, 7200)
+        return tags_list
 
-    return tags_list
+    return await aget_or_build(cache_key, build, 7200)
 
 
 @apply_exception_handler
-def get_tags_view(request: HttpRequest) -> JsonResponse:
+@use_read_only_db
+async def get_tags_view(request: HttpRequest) -> HttpResponse:
     """
     Extract all tags (for all categories) or
     tags for selected categories (see function <get_tags> above).
+    Tags preloaded in the master process of gunicorn are used first
+    (see preload.py).
     :param request: HttpRequest
     :return: list of tags
     """
+    category_id = request.GET.get("category", "")
+
+    content = await get_preloaded("tags" + category_id)
+    if content is not None:
+        return HttpResponse(content, content_type="application/json", status=200)
 
     if "category" in request.GET:
-        category_id = request.GET.get("category")
-        tags_list = get_tags(category_id=category_id)
+        tags_list = await get_tags(category_id=category_id)
     else:
-        tags_list = get_tags()
+        tags_list = await get_tags()
 
     return JsonResponse(tags_list, safe=False, status=200)
 
 
-def get_product_list(cache_key: str, **kwargs) -> list:
+async def get_product_list(cache_key: str, **kwargs) -> list:
     """
     To form QuerySet for section "banners", "limited", "popular" and pass it
     to function <format_queryset_to_list> (plus cache)
@@ -133,130 +174,144 @@ def get_product_list(cache_key: str, **kwargs) -> list:
     :param kwargs: keyword parameters for query filter
     :return: list of dictionaries
     """
-    data = cache.get(cache_key)
-
-    if data is None:
+    async def build() -> list:
 
         qs = Product.objects.filter(**kwargs, available=True)[:PRODUCT_LIMIT]
 
         pref_images = Prefetch("images",
-                            queryset=ProductImage.objects.only("image", "description"))
+                            queryset=ProductImage.objects.only("product_id", "image", "description"))
 
         qs = qs.prefetch_related(pref_images, "tags")
 
         products = qs.annotate(reviews_count=Count("reviews"))
+        products = [product async for product in products]
 
-        data = format_queryset_to_list(products)  # see utils.py
+        return format_queryset_to_list(products)  # see utils.py
 
-        if not DEBUG:
-            cache.set(cache_key, data, 3600)
-
-    return data
+    return await aget_or_build(cache_key, build, 3600)
 
 
 @apply_exception_handler
-def get_banners_view(request: HttpRequest) -> JsonResponse:
+@use_read_only_db
+async def get_banners_view(request: HttpRequest) -> JsonResponse:
     """
     Make cache key and get bunners for homepage
     (see function <get_product_list> above).
     :param request: HttpRequest
     :return: JsonResponse (list of products)
     """
-    cache_key = "banners" + CATEGORY_ID
-    data = get_product_list(cache_key, category_id=int(CATEGORY_ID))
+    data = await get_product_list(BANNERS_CACHE_KEY, category_id=int(CATEGORY_ID))
 
     return JsonResponse(data, safe=False, status=200)
 
 
 @apply_exception_handler
-def get_limited_view(request: HttpRequest) -> JsonResponse:
+@use_read_only_db
+async def get_limited_view(request: HttpRequest) -> JsonResponse:
     """
     Make cache key and get limited products for homepage
     (see function <get_product_list> above).
     :param request: HttpRequest
     :return: JsonResponse (list of products)
     """
-    cache_key = "limited"
-    data = get_product_list(cache_key, limited_edition=True)
+    data = await get_product_list(LIMITED_CACHE_KEY, limited_edition=True)
 
     return JsonResponse(data, safe=False, status=200)
 
 
 @apply_exception_handler
-def get_popular_view(request: HttpRequest) -> JsonResponse:
+@use_read_only_db
+async def get_popular_view(request: HttpRequest) -> JsonResponse:
     """
     Make cache key and get popular products for homepage
     (see function <get_product_list> above).
     :param request: HttpRequest
     :return: JsonResponse (list of products)
     """
-    cache_key = "popular" + RATING_VALUE
-    data = get_product_list(cache_key, rating__gt=int(RATING_VALUE))
+    data = await get_product_list(POPULAR_CACHE_KEY, rating__gt=int(RATING_VALUE))
 
     return JsonResponse(data, safe=False, status=200)
 
 
+def format_sale_to_dict(sale: Sale) -> dict:
+    """
+    Format sale of product (product and its images are prefetched).
+    :param sale: instance of Sale
+    :return: dictionary
+    """
+    prod = sale.product
+
+    images_list = []
+    for item in prod.images.all():
+        images_list.append({"src": item.image.url if item.image else "",
+                            "alt": item.description})
+    return {
+        "id": prod.pk,
+        "price": prod.price,
+        "salePrice": sale.price_sale,
+        "dateFrom": sale.date_from,
+        "dateTo": sale.date_to,
+        "title": prod.title,
+        "images": images_list,
+    }
+
+
 @apply_exception_handler
-def get_sales_view(request: HttpRequest) -> JsonResponse:
+@use_read_only_db
+async def get_sales_view(request: HttpRequest) -> HttpResponse:
     """
     Get products for sale.
+    The list is streamed by chunks of rows (see megano_store/streaming.py).
     :param request: HttpRequest
-    :return: JsonResponse (list of products and pages)
+    :return: HttpResponse or StreamingHttpResponse (list of products and pages)
     """
     page_current = int(request.GET.get("currentPage"))
 
-    cache_key = "sales"
-    data = cache.get(cache_key)
-
-    if data is None:
-        qs = Sale.objects.all().select_related("product")
+    def get_pages(count: int) -> dict:
+        return {"currentPage": page_current, "lastPage": ceil(count / PAGE_ITEM_LIMIT)}
 
-        pref_images = Prefetch(
-            "product__images",
-            queryset=ProductImage.objects.only("image", "description")
-        )
-        qs = qs.prefetch_related(pref_images)
+    cache_key = SALES_CACHE_KEY
+    qs = Sale.objects.all().select_related("product").order_by("pk")
 
-        data = []
-        for sale in qs:
-            prod = sale.product
+    pref_images = Prefetch(
+        "product__images",
+        queryset=ProductImage.objects.only("product_id", "image", "description")
+    )
+    qs = qs.prefetch_related(pref_images)
 
-            images_list = []
-            for item in prod.images.all():
-                images_list.append({"src": item.image.url if item.image else "",
-                                    "alt": item.description})
-            data.append({
-                "id": prod.pk,
-                "price": prod.price,
-                "salePrice": sale.price_sale,
-                "dateFrom": sale.date_from,
-                "dateTo": sale.date_to,
-                "title": prod.title,
-                "images": images_list,
-            })
-        if not DEBUG:
-            cache.set(cache_key, data, 7200)
+    async def refresh() -> None:
+        await acache_json_list(qs.all(), format_sale_to_dict, cache_key, 7200)
 
-    count = len(data)
-    page_last = ceil(count / PAGE_ITEM_LIMIT)
+    response = await get_cached_json_list(cache_key, get_pages, refresh)
 
-    products = {"items": data, "currentPage": page_current, "lastPage": page_last}
+    if response is None:
+        response = stream_json_list(request, qs, format_sale_to_dict, get_pages,
+                                    cache_key=None if DEBUG else cache_key, timeout=7200)
 
-    return JsonResponse(products, status=200)
+    return response
 
 
 @apply_exception_handler
-def get_catalog_view(request: HttpRequest) -> JsonResponse:
+@rate_limit("catalog")
+@use_read_only_db
+async def get_catalog_view(request: HttpRequest) -> HttpResponse:
     """
     Get full catalog or filter and sort catalog of products.
     Data for filter and sort is taken from <query string>.
+    Search is fuzzy (similar titles and tags, see trigrams.py), if it is requested
+    by <filter[fuzzy]> or nothing contains the query (misspelled title), found
+    products are sorted by similarity.
+    The list is streamed by chunks of rows (see megano_store/streaming.py).
+    Other queries are answered by the shared memory-mapped snapshot of the catalog
+    without the database, if it is fresh (see snapshot.py).
     :param request: HttpRequest
-    :return: JsonResponse
+    :return: HttpResponse or StreamingHttpResponse
     """
     category = request.GET.get("category")
     search = request.GET.get("filter[name]").strip().lower()
     available = request.GET.get("filter[available]")
     free_delivery = request.GET.get("filter[freeDelivery]")
+    fuzzy = request.GET.get("filter[fuzzy]", "")
     price_min = request.GET.get("filter[minPrice]")
     price_max = request.GET.get("filter[maxPrice]")
     sort_item = request.GET.get("sort")
@@ -265,14 +320,28 @@ def get_catalog_view(request: HttpRequest) -> JsonResponse:
     page_current = int(request.GET.get("currentPage"))
     item_limit = int(request.GET.get("limit"))
 
-    cache_key = "".join([search, available, free_delivery, price_min, price_max,
-                         sort_item, sort_mode, "".join(sorted(tags))])
-    if category is not None:
-        cache_key = cache_key + category
+    def get_pages(count: int) -> dict:
+        return {"currentPage": page_current, "lastPage": ceil(count / item_limit)}
+
+    snapshot = get_snapshot() if fuzzy != "true" else None
+    if snapshot is not None:
+        # filtering of the whole catalog does not block the event loop
+        rows = await sync_to_async(snapshot.select, thread_sensitive=False)(
+            category, available == "true", free_delivery == "true",
+            int(price_min), int(price_max), tags, search, sort_item, sort_mode
+        )
+        if rows is not None:
+            return stream_encoded_list(request, snapshot.iter_cards(rows), get_pages)
 
-    data = cache.get(cache_key)
+    # values are separated (<tags[]=2> and <category=2> are different keys),
+    # the text of the search is not a valid key of memcached; lists of the old
+    # version of the catalog are not read (see invalidation.py)
+    query = json.dumps([search, available, free_delivery, fuzzy, price_min, price_max,
+                        sort_item, sort_mode, sorted(tags), category,
+                        await aget_snapshot_version()])
+    cache_key = "catalog" + hashlib.md5(query.encode("utf-8")).hexdigest()
 
-    if data is None:
+    async def get_queryset():
 
         qs = Product.objects.all()
 
@@ -285,67 +354,145 @@ def get_catalog_view(request: HttpRequest) -> JsonResponse:
         if free_delivery == "true":
             qs = qs.filter(free_delivery=True)
 
-        if search:
-            qs = qs.filter(title_low__contains=search)
-
         if tags:
             qs = qs.filter(tags__id__in=list(map(int, tags)))
 
         qs = qs.filter(price__gt=int(price_min), price__lte=int(price_max))
 
-        qs = qs.annotate(reviews_count=Count("reviews"))
+        similar = []
+        if search:
+            exact = qs.filter(title_low__contains=search)
+            if fuzzy == "true" or not await exact.aexists():
+                similar = await search_similar(search, qs)
+                qs = qs.filter(pk__in=[pk for pk, _ in similar])
+            else:
+                qs = exact
+
+        # reviews are joined once per matched tag: they are counted distinct
+        qs = qs.annotate(reviews_count=Count("reviews", distinct=True))
 
-        if sort_item == "reviews":
-            sort_item = "reviews_count"
-        elif sort_item == "date":
-            sort_item = "created_at"
+        order = sort_item
+        if order == "reviews":
+            order = "reviews_count"
+        elif order == "date":
+            order = "created_at"
 
         if sort_mode == "dec":
-            sort_item = "-" + sort_item
+            order = "-" + order
 
-        qs = qs.order_by(sort_item)
-        qs = qs.distinct()
+        if similar:
+            qs = qs.order_by(Case(*[When(pk=pk, then=Value(position))
+                                    for position, (pk, _) in enumerate(similar)]))
+        else:
+            qs = qs.order_by(order)
+        # rows are unique without DISTINCT: <reviews_count> groups them by ID
+        # of product (DISTINCT was one more temporary B-tree of the whole result)
 
         pref_images = Prefetch(
             "images",
-            queryset=ProductImage.objects.only("image", "description")
+            queryset=ProductImage.objects.only("product_id", "image", "description")
         )
-        qs = qs.prefetch_related(pref_images, "tags")
+        return qs.prefetch_related(pref_images, "tags")
 
-        data = format_queryset_to_list(qs)  # see utils.py
+    async def refresh() -> None:
+        await acache_json_list(await get_queryset(), format_product_to_dict,
+                               cache_key, 3600)
 
-        if not DEBUG:
-            cache.set(cache_key, data, 3600)
+    response = await get_cached_json_list(cache_key, get_pages, refresh)
 
-    count = len(data)
-    page_last = ceil(count / item_limit)
+    if response is None:
+        response = stream_json_list(request, await get_queryset(),
+                                    format_product_to_dict, get_pages,
+                                    cache_key=None if DEBUG else cache_key, timeout=3600)
 
-    products = {"items": data, "currentPage": page_current, "lastPage": page_last}
-
-    return JsonResponse(products, status=200)
+    return response
 
 
 @apply_exception_handler
-def get_product_view(request: HttpRequest, **kwargs) -> JsonResponse:
+@use_read_only_db
+async def get_product_view(request: HttpRequest, **kwargs) -> JsonResponse:
     """
     Get FULL description of product (invoke function <format_queryset_to_dict>.
     :param request: HttpRequest
     :param kwargs: <pk> of product from urlpattern
     :return: JsonResponse
     """
-    cache_key = "product" + str(kwargs["pk"])
-    data = cache.get(cache_key)
+    cache_key = get_product_cache_key(kwargs["pk"])
+
+    async def build() -> dict:
+
+        # authors of reviews are prefetched too: lazy queries are not allowed
+        # in async view (see function <format_instance_to_dict>)
+        product = await Product.objects.prefetch_related(
+            "images", "tags", "specs", "reviews__user"
+        ).aget(id=kwargs["pk"])
+
+        return format_instance_to_dict(product)  # see utils.py
+
+    data = await aget_or_build(cache_key, build, 3600)
+
+    return JsonResponse(data, status=200)
+
+
+@apply_exception_handler
+@use_read_only_db
+async def get_related_view(request: HttpRequest, **kwargs) -> JsonResponse:
+    """
+    Get products, which are frequently bought together with product
+    (precomputed index, see recommendations.py).
+    :param request: HttpRequest
+    :param kwargs: <pk> of product from urlpattern
+    :return: JsonResponse (list of products, SHORT description)
+    """
+    cache_key = get_related_cache_key(kwargs["pk"])
 
-    if data is None:
+    async def build() -> list:
 
-        product = Product.objects.prefetch_related(
-            "images", "tags", "specs", "reviews"
-        ).get(id=kwargs["pk"])
+        neighbor_ids = [
+            neighbor_id async for neighbor_id in
+            # sold out neighbors are skipped before the limit: in-stock ones take
+            # their places
+            ProductNeighbor.objects.filter(product_id=kwargs["pk"],
+                                           neighbor__available=True)
+            .order_by("-score", "neighbor_id")
+            .values_list("neighbor_id", flat=True)[:PRODUCT_LIMIT]
+        ]
 
-        data = format_instance_to_dict(product)  # see utils.py
+        qs = Product.objects.filter(id__in=neighbor_ids, available=True)
+
+        pref_images = Prefetch("images",
+                            queryset=ProductImage.objects.only("product_id", "image", "description"))
+
+        qs = qs.prefetch_related(pref_images, "tags")
+
+        products = qs.annotate(reviews_count=Count("reviews"))
+        products = sorted([product async for product in products],
+                          key=lambda prod: neighbor_ids.index(prod.pk))
+
+        return format_queryset_to_list(products)  # see utils.py
+
+    data = await aget_or_build(cache_key, build, 3600)
+
+    return JsonResponse(data, safe=False, status=200)
+
+
+@apply_exception_handler
+async def get_suggest_view(request: HttpRequest) -> JsonResponse:
+    """
+    Suggestions of the search box: products, which titles have a word starting
+    with the query, and tags (in-memory index, see suggest.py).
+    :param request: HttpRequest (<q> of query string)
+    :return: JsonResponse
+    """
+    query = normalize_query(request.GET.get("q", ""))
+    data = {"products": [], "tags": []}
 
-        if not DEBUG:
-            cache.set(cache_key, data, 3600)
+    if query:
+        index = await get_index()
+        data["products"] = [{"id": pk, "title": title}
+                            for pk, title in index["products"].search(query)]
+        data["tags"] = [{"id": pk, "name": value}
+                        for pk, value in index["tags"].search(query)]
 
     return JsonResponse(data, status=200)
 
@@ -360,7 +507,7 @@ def write_review_view(request: HttpRequest, **kwargs) -> JsonResponse:
     """
     def get_reviews(prod: Product) -> list:
 
-        reviews = prod.reviews.all()
+        reviews = prod.reviews.select_related("user")
         reviews_list = []
 
         if reviews:
@@ -378,8 +525,8 @@ def write_review_view(request: HttpRequest, **kwargs) -> JsonResponse:
 
                 rate_sum += item.rate
 
-            prod.rating = rate_sum / reviews.count()
-            prod.save()
+            prod.rating = rate_sum / len(reviews)
+            prod.save(update_fields=["rating"])
 
         return reviews_list
 
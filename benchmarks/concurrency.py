@@ -0,0 +1,212 @@
+"""
+Throughput of concurrent connections: current sync deployment (gunicorn sync
+workers, megano_store.wsgi) against ASGI deployment (gunicorn with uvicorn
+workers, megano_store.asgi, async views of api_product).
+
+For every mode gunicorn is started on 127.0.0.1 with the same number of workers
+as in server_config/*.conf.py, then <connections> keep-alive connections send
+requests to the read-only endpoints during <seconds>. The database and settings
+of the project (.env) are used, so run it on a copy with realistic data
+(see command <generate_catalog>).
+
+Usage (from the directory of the project, gunicorn and uvicorn are installed):
+    python benchmarks/concurrency.py --connections 50 --seconds 20
+    python benchmarks/concurrency.py --mode asgi --json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+MODES = {
+    "sync": {"app": "megano_store.wsgi:application", "worker_class": "sync"},
+    "asgi": {"app": "megano_store.asgi:application",
+             "worker_class": "uvicorn.workers.UvicornWorker"},
+}
+
+CATALOG_QUERY = ("filter[name]=&filter[minPrice]=0&filter[maxPrice]=1000000"
+                 "&filter[freeDelivery]=false&filter[available]=true"
+                 "&currentPage=1&sort=price&sortType=inc&limit=20")
+
+DEFAULT_PATHS = [
+    "/api/categories/",
+    "/api/tags/",
+    "/api/banners/",
+    "/api/products/popular/",
+    "/api/products/limited/",
+    "/api/sales/?currentPage=1",
+    "/api/catalog/?" + CATALOG_QUERY,
+    "/api/product/1/",
+]
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode: str, port: int, workers: int) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers),
+        "--worker-class", MODES[mode]["worker_class"],
+        "--log-level", "warning",
+        MODES[mode]["app"],
+    ]
+    env = {**os.environ, "N_RATE_LIMIT": "0"}  # one client sends all requests
+    return subprocess.Popen(command, cwd=BASE_DIR, env=env, start_new_session=True)
+
+
+def wait_for_server(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} has not started.")
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait(timeout=30)
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple:
+    """
+    Read one HTTP/1.1 response (Content-Length or chunked body).
+    :return: status code and flag "connection is kept alive"
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return status, headers.get("connection", "").lower() != "close"
+
+
+async def connection_loop(port: int, paths: list, deadline: float,
+                          latencies: list, errors: list) -> None:
+    # sync workers of gunicorn do not support keep-alive: the connection
+    # is opened again after <Connection: close>, as a browser does
+    writer = None
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+            path = random.choice(paths)
+            request = (f"GET {path} HTTP/1.1\r\nHost: localhost\r\n"
+                       f"Connection: keep-alive\r\n\r\n")
+            writer.write(request.encode())
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+    except (ConnectionError, asyncio.IncompleteReadError):
+        errors.append("connection")
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(port: int, paths: list, connections: int, seconds: float) -> dict:
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(
+        connection_loop(port, paths, deadline, latencies, errors)
+        for _ in range(connections)
+    ))
+    latencies.sort()
+
+    def percentile(percent):
+        if not latencies:
+            return 0
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return round(latencies[index] * 1000, 2)
+
+    return {
+        "requests": len(latencies),
+        "requests_per_sec": round(len(latencies) / seconds, 1),
+        "errors": len(errors),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else 0,
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(MODES), action="append",
+                        help="deployment to measure (default - all)")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3,
+                        help="seconds of load before measurement (fill the cache)")
+    parser.add_argument("--path", action="append",
+                        help="path to request (default - read-only endpoints)")
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args = parser.parse_args()
+
+    paths = args.path or DEFAULT_PATHS
+    reports = []
+
+    for mode in args.mode or MODES:
+        port = get_free_port()
+        process = start_server(mode, port, args.workers)
+        try:
+            wait_for_server(port)
+            asyncio.run(run_load(port, paths, args.connections, args.warmup))
+            report = asyncio.run(run_load(port, paths, args.connections, args.seconds))
+        finally:
+            stop_server(process)
+        reports.append({"mode": mode, "workers": args.workers,
+                        "connections": args.connections, **report})
+
+    if args.json:
+        print(json.dumps(reports, indent=4))
+        return
+
+    print(f"{'mode':<6} {'requests':>9} {'req/s':>9} {'errors':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for report in reports:
+        print(f"{report['mode']:<6} {report['requests']:>9} "
+              f"{report['requests_per_sec']:>9} {report['errors']:>7} "
+              f"{report['p50_ms']:>8} {report['p95_ms']:>8} {report['p99_ms']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Startup and memory of gunicorn workers: without preloading (every worker
+imports Django and all apps itself) against server_config/gunicorn.conf.py
+(preload_app and hooks of megano_store/gunicorn_hooks.py).
+
+For every mode it measures:
+- time from the start of gunicorn to the first successful response;
+- latency of the first request to every endpoint (cold worker);
+- memory of workers after <requests> requests: RSS, PSS and USS (private pages)
+  from /proc/<pid>/smaps_rollup (Linux only).
+
+Usage (from the directory of the project, gunicorn is installed):
+    python benchmarks/gunicorn_startup.py
+    python benchmarks/gunicorn_startup.py --mode preload --json
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+CONFIG = BASE_DIR / "server_config" / "gunicorn.conf.py"
+
+MODES = {
+    "cold": [],
+    "preload": ["--config", str(CONFIG)],
+}
+
+PATHS = [
+    "/api/categories/",
+    "/api/tags/",
+    "/api/banners/",
+    "/api/products/popular/",
+    "/api/products/limited/",
+]
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(port: int, path: str) -> float:
+    start = time.perf_counter()
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=30) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+
+def get_workers(master_pid: int) -> list:
+    path = Path(f"/proc/{master_pid}/task/{master_pid}/children")
+    return [int(pid) for pid in path.read_text().split()]
+
+
+def get_memory(pid: int) -> dict:
+    """
+    Memory of process in KiB: RSS, PSS and USS (Private_Clean + Private_Dirty).
+    """
+    values = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        name, value = line.split(":", 1)
+        values[name] = int(value.split()[0])
+    return {"rss_kb": values["Rss"], "pss_kb": values["Pss"],
+            "uss_kb": values["Private_Clean"] + values["Private_Dirty"]}
+
+
+def run_mode(mode: str, args) -> dict:
+    port = get_free_port()
+    command = [
+        sys.executable, "-m", "gunicorn", *MODES[mode],
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--access-logfile", "/dev/null",
+        "--error-logfile", "-",
+        "megano_store.wsgi:application",
+    ]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BASE_DIR, start_new_session=True)
+
+    try:
+        while True:
+            try:
+                request(port, PATHS[0])
+                break
+            except OSError:
+                if time.perf_counter() - started > 60:
+                    raise RuntimeError("gunicorn has not started in 60 s")
+                time.sleep(0.05)
+        first_response = time.perf_counter() - started
+
+        # every worker gets its first requests (connections are not kept alive)
+        first_latencies = {
+            path: round(max(request(port, path) for _ in range(args.workers)) * 1000, 2)
+            for path in PATHS
+        }
+        for i in range(args.requests):
+            request(port, PATHS[i % len(PATHS)])
+
+        workers = [get_memory(pid) for pid in get_workers(process.pid)]
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+
+    return {
+        "mode": mode,
+        "first_response_s": round(first_response, 3),
+        "first_request_ms": first_latencies,
+        "workers": len(workers),
+        "avg_rss_kb": sum(w["rss_kb"] for w in workers) // max(len(workers), 1),
+        "avg_pss_kb": sum(w["pss_kb"] for w in workers) // max(len(workers), 1),
+        "avg_uss_kb": sum(w["uss_kb"] for w in workers) // max(len(workers), 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(MODES), action="append",
+                        help="mode to measure (default - all)")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=300,
+                        help="requests before measurement of memory")
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args = parser.parse_args()
+
+    reports = [run_mode(mode, args) for mode in args.mode or MODES]
+
+    if args.json:
+        print(json.dumps(reports, indent=4))
+        return
+
+    print(f"{'mode':<8} {'first response s':>17} {'RSS KiB':>9} "
+          f"{'PSS KiB':>9} {'USS KiB':>9}   first request ms (slowest worker)")
+    for report in reports:
+        print(f"{report['mode']:<8} {report['first_response_s']:>17} "
+              f"{report['avg_rss_kb']:>9} {report['avg_pss_kb']:>9} "
+              f"{report['avg_uss_kb']:>9}   {report['first_request_ms']}")
+
+
+if __name__ == "__main__":
+    main()
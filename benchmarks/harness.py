@@ -0,0 +1,394 @@
+"""
+Benchmark of the real URL patterns of the project: mix of scenarios
+(home page blocks, catalog with filters and sort, product detail, basket,
+order with payment) is sent in-process (django.test.Client, default) or to
+a running server (option --target, e.g. local gunicorn).
+
+For every URL name it reports p50/p95/p99 latency and queries per request
+(queries are counted in-process only: all database aliases). Requests are
+sent one by one, so latency is not affected by queueing
+(see concurrency.py for throughput).
+
+The database of the project is used: generate data first, e.g.
+    python manage.py generate_catalog --products 100000
+Users <bench_user_N> of this command are used for orders.
+
+Results are saved to benchmarks/results/*.json (option --save) and can be
+compared with a saved run (option --compare), regressions are marked.
+
+Rate limits (megano_store/ratelimit.py) are disabled in-process, start the
+server with N_RATE_LIMIT=0 for option --target.
+
+Usage (from the directory of the project):
+    python benchmarks/harness.py --iterations 500 --save
+    python benchmarks/harness.py --target http://127.0.0.1:8000 --iterations 500
+    python benchmarks/harness.py --save --compare benchmarks/results/<file>.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import secrets
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from http.client import HTTPConnection
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = BASE_DIR / "benchmarks" / "results"
+
+sys.path.insert(0, str(BASE_DIR))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "megano_store.settings")
+os.environ.setdefault("N_RATE_LIMIT", "0")  # one client sends all requests
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connections  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.urls import resolve, reverse  # noqa: E402
+
+from api_order.models import Order  # noqa: E402
+from api_product.models import Category, Product, ProductTag  # noqa: E402
+
+SCENARIOS = {  # name: weight
+    "home": 20,
+    "catalog": 35,
+    "product": 25,
+    "basket": 12,
+    "order": 8,
+}
+SORTS = ["price", "rating", "reviews", "date"]
+
+
+class QueryCounter:
+    """
+    Wrapper of all database connections (it is installed once and is not removed:
+    context manager <execute_wrapper> would remove wrappers of the project,
+    which are added to connections opened during the request).
+    """
+    active = False
+    count = 0
+
+    @classmethod
+    def wrapper(cls, execute, sql, params, many, context):
+        if cls.active:
+            cls.count += 1
+        return execute(sql, params, many, context)
+
+    @classmethod
+    def install(cls, sender=None, connection=None, **kwargs) -> None:
+        for conn in [connection] if connection else connections.all():
+            if cls.wrapper not in conn.execute_wrappers:
+                conn.execute_wrappers.append(cls.wrapper)
+
+
+connection_created.connect(QueryCounter.install)
+
+
+class InProcessClient:
+    """
+    Requests through django.test.Client (CSRF checks are disabled),
+    SQL queries of all database aliases are counted.
+    """
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method: str, path: str, data=None) -> tuple:
+        body = json.dumps(data) if data is not None else ""
+
+        QueryCounter.count = 0
+        QueryCounter.active = True
+        start = time.perf_counter()
+        try:
+            response = self.client.generic(method, path, body,
+                                           content_type="application/json")
+            # queries of streaming response are executed while it is read
+            content = (b"".join(response.streaming_content) if response.streaming
+                       else response.content)
+        finally:
+            elapsed = time.perf_counter() - start
+            QueryCounter.active = False
+
+        return response.status_code, content, elapsed, QueryCounter.count
+
+
+class HttpClient:
+    """
+    Requests to a running server through one keep-alive connection, cookies
+    (session) are kept, CSRF token is generated by the client (cookie and header).
+    """
+    def __init__(self, target: str):
+        url = urlsplit(target)
+        self.host, self.port = url.hostname, url.port or 80
+        self.connection = None
+        self.cookies = {"csrftoken": secrets.token_hex(16)}
+
+    def request(self, method: str, path: str, data=None) -> tuple:
+        if self.connection is None:
+            self.connection = HTTPConnection(self.host, self.port, timeout=60)
+
+        # token is rotated by Django at login, so it is taken from the cookie
+        headers = {
+            "Content-Type": "application/json",
+            "X-CSRFToken": self.cookies["csrftoken"],
+            "Cookie": "; ".join(f"{name}={value}" for name, value in self.cookies.items()),
+        }
+        body = json.dumps(data) if data is not None else None
+
+        start = time.perf_counter()
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        elapsed = time.perf_counter() - start
+
+        for cookie in response.headers.get_all("Set-Cookie") or []:
+            name, value = cookie.split(";", 1)[0].split("=", 1)
+            self.cookies[name.strip()] = value
+        if response.headers.get("Connection", "").lower() == "close":
+            self.connection.close()
+            self.connection = None
+
+        return response.status, content, elapsed, None
+
+
+class Harness:
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.make_client = ((lambda: HttpClient(args.target)) if args.target
+                            else InProcessClient)
+        self.samples = {}
+        self.recording = False
+
+        products = Product.objects.filter(available=True, count__gt=0)
+        self.product_ids = list(products.order_by("?").values_list("pk", flat=True)[:5000])
+        self.category_ids = list(Category.objects.filter(parent__isnull=False)
+                                 .values_list("pk", flat=True))
+        self.tag_ids = list(ProductTag.objects.values_list("pk", flat=True)[:500])
+        titles = products.values_list("title_low", flat=True)[:2000]
+        self.words = sorted({word for title in titles for word in title.split()
+                             if not word.isdigit()})
+        if not self.product_ids:
+            raise SystemExit("No available products: run command <generate_catalog>.")
+
+        QueryCounter.install()
+        self.anonymous = self.make_client()
+        self.customer = self.make_client()
+        # pattern <sign-(?:in|up)> can not be reversed
+        status, *_ = self.customer.request("POST", "/api/sign-in",
+                                           {"username": args.username,
+                                            "password": args.password})
+        if status != 200:
+            raise SystemExit(f"User <{args.username}> can not sign in (status {status}).")
+
+    def call(self, client, method: str, path: str, data=None):
+        status, content, elapsed, queries = client.request(method, path, data)
+
+        if self.recording:
+            name = resolve(path.split("?", 1)[0]).view_name
+            sample = self.samples.setdefault(name, {"latencies": [], "queries": [],
+                                                    "errors": 0})
+            sample["latencies"].append(elapsed)
+            if queries is not None:
+                sample["queries"].append(queries)
+            if status >= 400:
+                sample["errors"] += 1
+        return status, content
+
+    def home(self) -> None:
+        for name in ("categories", "banners", "popular", "limited", "tags"):
+            self.call(self.anonymous, "GET", reverse("api_product:" + name))
+
+    def catalog(self) -> None:
+        query = {
+            "filter[name]": self.rng.choice(self.words + [""] * len(self.words)),
+            "filter[minPrice]": 0,
+            "filter[maxPrice]": self.rng.choice([500, 1000, 2000]),
+            "filter[freeDelivery]": self.rng.choice(["true", "false"]),
+            "filter[available]": self.rng.choice(["true", "false"]),
+            "currentPage": self.rng.randint(1, 3),
+            "sort": self.rng.choice(SORTS),
+            "sortType": self.rng.choice(["inc", "dec"]),
+            "limit": 20,
+        }
+        if self.category_ids and self.rng.random() < 0.5:
+            query["category"] = self.rng.choice(self.category_ids)
+        if self.tag_ids and self.rng.random() < 0.2:
+            query["tags[]"] = self.rng.choice(self.tag_ids)
+        self.call(self.anonymous, "GET", reverse("api_product:catalog") + "?" + urlencode(query))
+
+    def product(self) -> None:
+        pk = self.rng.choice(self.product_ids)
+        self.call(self.anonymous, "GET", reverse("api_product:product", kwargs={"pk": pk}))
+        self.call(self.anonymous, "GET", reverse("api_product:related", kwargs={"pk": pk}))
+
+    def basket(self) -> None:
+        path = reverse("api_order:basket")
+        pks = self.rng.sample(self.product_ids, min(3, len(self.product_ids)))
+        for pk in pks:
+            self.call(self.anonymous, "POST", path, {"id": pk, "count": 1})
+        self.call(self.anonymous, "GET", path)
+        self.call(self.anonymous, "DELETE", path, {"id": pks[0], "count": 1})
+
+    def order(self) -> None:
+        basket = [{"id": pk, "count": 1}
+                  for pk in self.rng.sample(self.product_ids, min(2, len(self.product_ids)))]
+        for item in basket:
+            self.call(self.customer, "POST", reverse("api_order:basket"), item)
+
+        status, content = self.call(self.customer, "POST", reverse("api_order:orders"), basket)
+        if status >= 400:
+            return
+        pk = json.loads(content)["orderId"]
+
+        self.call(self.customer, "POST",
+                  reverse("api_order:oneorder-with-slash", kwargs={"pk": pk}),
+                  {"deliveryType": "ordinary", "city": "Moscow", "address": "Street 1",
+                   "paymentType": "online"})
+        self.call(self.customer, "POST", reverse("api_order:payment", kwargs={"pk": pk}),
+                  {"number": "12345672"})
+        self.call(self.customer, "GET", reverse("api_order:orders"))
+
+    def run(self, iterations: int, recording: bool) -> None:
+        self.recording = recording
+        names = self.rng.choices(list(SCENARIOS), weights=list(SCENARIOS.values()),
+                                 k=iterations)
+        for name in names:
+            getattr(self, name)()
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(samples: dict) -> dict:
+    results = {}
+    for name, sample in sorted(samples.items()):
+        latencies = sample["latencies"]
+        results[name] = {
+            "requests": len(latencies),
+            "errors": sample["errors"],
+            "p50_ms": round(statistics.median(latencies) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "queries_avg": (round(statistics.mean(sample["queries"]), 2)
+                            if sample["queries"] else None),
+            "queries_max": max(sample["queries"]) if sample["queries"] else None,
+        }
+    return results
+
+
+def get_meta(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "target": args.target or "in-process",
+        "iterations": args.iterations,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "dataset": {"products": Product.objects.count(),
+                    "categories": Category.objects.count(),
+                    "orders": Order.objects.count()},
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Print changes against the baseline run.
+    :return: list of regressions (p95 is slower more than <threshold> percents
+             or more queries per request)
+    """
+    regressions = []
+    print(f"\nAgainst {baseline['meta']['commit']} ({baseline['meta']['time']}):")
+    print(f"{'url name':<32} {'p50 %':>8} {'p95 %':>8} {'queries':>15}")
+
+    for name, row in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<32} {'new':>8}")
+            continue
+        p50 = (row["p50_ms"] / base["p50_ms"] - 1) * 100 if base["p50_ms"] else 0
+        p95 = (row["p95_ms"] / base["p95_ms"] - 1) * 100 if base["p95_ms"] else 0
+        queries = f"{base['queries_avg']} -> {row['queries_avg']}"
+        mark = ""
+        if p95 > threshold or (row["queries_avg"] or 0) > (base["queries_avg"] or 0):
+            mark = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<32} {p50:>+8.1f} {p95:>+8.1f} {queries:>15}{mark}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--target", help="URL of running server (default - in-process)")
+    parser.add_argument("--iterations", type=int, default=300,
+                        help="number of scenarios to run")
+    parser.add_argument("--warmup", type=int, default=30,
+                        help="scenarios before measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--username", default="bench_user_0")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="clear the cache of the project before the run")
+    parser.add_argument("--save", nargs="?", const="", metavar="PATH",
+                        help="save results (default - benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", metavar="PATH", help="saved run to compare with")
+    parser.add_argument("--threshold", type=float, default=20,
+                        help="slowdown of p95 (percents), which is a regression")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="exit with code 1, if there are regressions")
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args = parser.parse_args()
+
+    if args.clear_cache:
+        cache.clear()
+
+    harness = Harness(args)
+    harness.run(args.warmup, recording=False)
+    harness.run(args.iterations, recording=True)
+    report = {"meta": get_meta(args), "results": summarize(harness.samples)}
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(f"{'url name':<32} {'requests':>9} {'errors':>7} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'p99 ms':>9} {'queries':>8}")
+        for name, row in report["results"].items():
+            print(f"{name:<32} {row['requests']:>9} {row['errors']:>7} "
+                  f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9} "
+                  f"{str(row['queries_avg']):>8}")
+
+    if args.save is not None:
+        path = Path(args.save or RESULTS_DIR / (
+            datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(report, indent=4))
+        print(f"\nResults are saved: {path}", file=sys.stderr)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(report["results"], baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Read/write contention benchmark of SQLite: default setup of Django
+(rollback journal, deferred transactions) against the setup of backend
+<megano_store.sqlite_backend> (WAL, synchronous=NORMAL, busy timeout,
+BEGIN IMMEDIATE, ...).
+
+Readers imitate catalog requests (range query with sort), writers imitate
+checkout (read count of product, update it, insert order row - in one
+transaction). Every process works <seconds>, the temporary database is
+created from scratch for every profile, so results are reproducible.
+
+Usage (from the directory of the project):
+    python benchmarks/sqlite_contention.py --readers 6 --writers 3 --seconds 10
+    python benchmarks/sqlite_contention.py --json > result.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from megano_store.sqlite_backend.base import (DEFAULT_PRAGMAS,  # noqa: E402
+                                              DEFAULT_TRANSACTION_MODE, apply_pragmas)
+
+PROFILES = {
+    # python sqlite3 / Django defaults: timeout 5 s, journal_mode DELETE, BEGIN
+    "default": {"pragmas": {}, "timeout": 5.0, "begin": "BEGIN"},
+    "tuned": {"pragmas": DEFAULT_PRAGMAS,
+              "timeout": DEFAULT_PRAGMAS["busy_timeout"] / 1000,
+              "begin": "BEGIN " + DEFAULT_TRANSACTION_MODE},
+}
+
+
+def connect(path: str, profile: dict) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=profile["timeout"], isolation_level=None)
+    apply_pragmas(conn, profile["pragmas"])
+    return conn
+
+
+def create_database(path: str, rows: int, profile: dict) -> None:
+    conn = connect(path, profile)
+    conn.executescript("""
+        CREATE TABLE product (id INTEGER PRIMARY KEY, price REAL, count INTEGER,
+                              rating REAL, title TEXT);
+        CREATE INDEX product_price ON product (price);
+        CREATE TABLE purchase (id INTEGER PRIMARY KEY, product_id INTEGER,
+                               quantity INTEGER, created_at REAL);
+    """)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO product (price, count, rating, title) VALUES (?, ?, ?, ?)",
+        ((random.uniform(1, 1000), 1000, random.uniform(0, 5), f"product {i}")
+         for i in range(rows))
+    )
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def reader(path: str, profile: dict, seconds: float, results) -> None:
+    conn = connect(path, profile)
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        price = random.uniform(1, 900)
+        start = time.perf_counter()
+        try:
+            conn.execute(
+                "SELECT id, title, price, rating FROM product "
+                "WHERE price BETWEEN ? AND ? ORDER BY rating DESC LIMIT 20",
+                (price, price + 100)
+            ).fetchall()
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put(("read", latencies, errors))
+
+
+def writer(path: str, profile: dict, seconds: float, rows: int, results) -> None:
+    conn = connect(path, profile)
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        product_id = random.randint(1, rows)
+        start = time.perf_counter()
+        try:
+            conn.execute(profile["begin"])
+            count, = conn.execute("SELECT count FROM product WHERE id = ?",
+                                  (product_id,)).fetchone()
+            conn.execute("UPDATE product SET count = ? WHERE id = ?",
+                         (max(count - 1, 0), product_id))
+            conn.execute("INSERT INTO purchase (product_id, quantity, created_at) "
+                         "VALUES (?, 1, ?)", (product_id, time.time()))
+            conn.execute("COMMIT")
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            # <database is locked> - the same error, which became HTTP 500
+            errors += 1
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+    results.put(("write", latencies, errors))
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run_profile(name: str, args) -> dict:
+    profile = PROFILES[name]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.sqlite3")
+        random.seed(args.seed)
+        create_database(path, args.rows, profile)
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=reader,
+                                    args=(path, profile, args.seconds, results))
+            for _ in range(args.readers)
+        ] + [
+            multiprocessing.Process(target=writer,
+                                    args=(path, profile, args.seconds, args.rows,
+                                          results))
+            for _ in range(args.writers)
+        ]
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    report = {"profile": name}
+    for kind in ("read", "write"):
+        latencies = [value for item in collected if item[0] == kind
+                     for value in item[1]]
+        report[kind] = {
+            "ops_per_sec": round(len(latencies) / args.seconds, 1),
+            "errors": sum(item[2] for item in collected if item[0] == kind),
+            "p50_ms": round(statistics.median(latencies) * 1000, 3) if latencies else 0,
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--readers", type=int, default=6)
+    parser.add_argument("--writers", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append",
+                        help="profile to run (default - all)")
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args = parser.parse_args()
+
+    reports = [run_profile(name, args) for name in (args.profile or PROFILES)]
+
+    if args.json:
+        print(json.dumps(reports, indent=4))
+        return
+
+    print(f"readers={args.readers} writers={args.writers} "
+          f"seconds={args.seconds} rows={args.rows}")
+    print(f"{'profile':<8} {'kind':<6} {'ops/s':>10} {'errors':>7} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for report in reports:
+        for kind in ("read", "write"):
+            row = report[kind]
+            print(f"{report['profile']:<8} {kind:<6} {row['ops_per_sec']:>10} "
+                  f"{row['errors']:>7} {row['p50_ms']:>9} {row['p95_ms']:>9} "
+                  f"{row['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
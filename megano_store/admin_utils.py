@@ -0,0 +1,61 @@
+"""
+Tools for admin pages of large tables (cost of the page is bounded by its size).
+
+- <EstimatedCountPaginator>: number of rows of the whole table is estimated
+  by the max primary key (search by index), filtered lists are counted
+  up to ADMIN_COUNT_LIMIT rows;
+- <PrefixSearchMixin>: search by prefix as range of indexed field
+  (<field >= term AND field < term + max character>), so the index is used
+  instead of <LIKE '%term%'> scan of the table.
+"""
+
+from django.core.paginator import Paginator
+from django.db.models import Max, Q
+from django.utils.functional import cached_property
+
+from megano_store.settings import ADMIN_COUNT_LIMIT
+
+MAX_CHAR = "\U0010ffff"
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Use it with <show_full_result_count = False> of ModelAdmin, otherwise
+    the whole table is counted by ChangeList.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+
+        if not queryset.query.where:
+            # rows can be deleted: the last pages can be empty
+            return queryset.aggregate(max_pk=Max("pk"))["max_pk"] or 0
+
+        return queryset.values("pk")[:ADMIN_COUNT_LIMIT].count()
+
+
+class PrefixSearchMixin:
+    """
+    Mixin for ModelAdmin, attribute <prefix_search_fields> - names of
+    indexed fields, which are compared with the search term, lower-cased if
+    <prefix_search_lower> is True (fields like <Product.title_low>).
+    Digits are searched as primary key too.
+    Attribute <search_fields> is required by admin to show the search box.
+    """
+    prefix_search_fields = ()
+    prefix_search_lower = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        if self.prefix_search_lower:
+            term = term.lower()
+
+        condition = Q(pk=int(term)) if term.isdigit() else Q()
+        for field in self.prefix_search_fields:
+            condition |= Q(**{f"{field}__gte": term, f"{field}__lt": term + MAX_CHAR})
+
+        return queryset.filter(condition), False
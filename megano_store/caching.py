@@ -0,0 +1,155 @@
+"""
+Stale-while-revalidate entries of the cache (read-only views of api_product).
+
+An entry is stored as <Entry(expires_at, value)> with the timeout of the cache
+<timeout> + CACHE_STALE_TIME:
+- till <expires_at> (soft expiry, <timeout> seconds after the build) the value
+  is fresh;
+- after it the stale value is returned at once and the refresh is scheduled:
+  the lock "refresh:<key>" (<cache.add>, shared by all workers) lets one
+  request refresh the entry, the refresh is run by the thread pool of the
+  process, the response is not delayed;
+- only after the hard expiry (or deletion of the entry) the request waits for
+  the build of the value.
+So popular entries are rebuilt before they expire and requests do not see
+the latency of the cold rebuild. The lock is not atomic for the file based
+cache (the check and the write are two operations): two workers can refresh
+one entry at the same time rarely, it is harmless.
+
+The lock is released after the successful refresh; after the failed one it
+expires in CACHE_REFRESH_LOCK_TIMEOUT seconds (the database is not hammered by
+retries), the stale value is served meanwhile. Refreshes are counted by metric
+<megano_cache_refreshes_total> (see metrics.py).
+"""
+
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.db import connections
+
+from megano_store.metrics import get_labels, inc_counter
+from megano_store.routers import read_only_db
+from megano_store.settings import (DEBUG, CACHE_REFRESH_LOCK_TIMEOUT,
+                                   CACHE_REFRESH_WORKERS, CACHE_STALE_TIME)
+from megano_store.utils import write_errors
+
+LOCK_PREFIX = "refresh:"
+
+# values of the cache, which are not <Entry> (written before), are misses
+Entry = namedtuple("Entry", ["expires_at", "value"])
+
+_lock = threading.Lock()
+_executor = None
+
+
+def set_entry(cache_key: str, value, timeout: int) -> None:
+    cache.set(cache_key, Entry(time.time() + timeout, value), timeout + CACHE_STALE_TIME)
+
+
+async def aset_entry(cache_key: str, value, timeout: int) -> None:
+    await cache.aset(cache_key, Entry(time.time() + timeout, value),
+                     timeout + CACHE_STALE_TIME)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool of the process, it is created at the first refresh. The master
+    process of gunicorn can create it too (stale entries during the warm-up,
+    see gunicorn_hooks.py): the master waits for its refreshes before fork
+    (<shutdown_executor>), the forked worker creates its own pool
+    (<_reset_after_fork>), threads of the parent do not exist in the child.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS,
+                                           thread_name_prefix="cache-refresh")
+    return _executor
+
+
+def shutdown_executor() -> None:
+    """
+    Wait for the scheduled refreshes (their locks are released) and drop the
+    thread pool of the process.
+    """
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _reset_after_fork() -> None:
+    global _executor, _lock
+    _executor = None
+    _lock = threading.Lock()  # it could be held by a thread of the parent
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def run_refresh(cache_key: str, refresh) -> None:
+    """
+    Task of the thread pool: the coroutine runs in the event loop of this thread.
+    :param refresh: coroutine function, which writes the entry
+    """
+    try:
+        with read_only_db():
+            async_to_sync(refresh)()
+    except Exception as exc:
+        inc_counter("megano_cache_refreshes_total", get_labels(result="error"))
+        write_errors({"CacheRefreshError": f"{type(exc).__name__} : {exc}",
+                      "cache_key": cache_key}, "errors_from_cache.log")
+    else:
+        inc_counter("megano_cache_refreshes_total", get_labels(result="ok"))
+        cache.delete(LOCK_PREFIX + cache_key)
+    finally:
+        connections.close_all()  # connections of this thread
+
+
+async def schedule_refresh(cache_key: str, refresh) -> None:
+    if await cache.aadd(LOCK_PREFIX + cache_key, 1, CACHE_REFRESH_LOCK_TIMEOUT):
+        get_executor().submit(run_refresh, cache_key, refresh)
+
+
+async def aget_entry(cache_key: str, refresh):
+    """
+    Value of the entry, the stale value schedules the refresh
+    (see the top of the module).
+    :param refresh: coroutine function, which writes the entry again
+        (None - the stale value is returned without the refresh)
+    :return: value or None (there is no entry)
+    """
+    entry = await cache.aget(cache_key)
+    if not isinstance(entry, Entry):
+        return None
+
+    if refresh is not None and time.time() >= entry.expires_at:
+        await schedule_refresh(cache_key, refresh)
+    return entry.value
+
+
+async def aget_or_build(cache_key: str, build, timeout: int):
+    """
+    Get the value from the cache or build it (the value is not cached, if DEBUG).
+    :param build: coroutine function without arguments, which returns the value
+    :param timeout: seconds, while the value is fresh
+    :return: value
+    """
+    async def refresh():
+        await aset_entry(cache_key, await build(), timeout)
+
+    value = await aget_entry(cache_key, refresh)
+
+    if value is None:
+        value = await build()
+
+        if not DEBUG:
+            await aset_entry(cache_key, value, timeout)
+
+    return value
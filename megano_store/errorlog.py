@@ -0,0 +1,167 @@
+"""
+Non-blocking log of errors (see function <write_errors> in utils.py).
+
+Request thread only puts the record into the bounded queue (it never waits:
+if the queue is full, the record is dropped and counted by metric
+<megano_error_log_dropped_total>). Background thread (QueueListener) writes
+records to files of DEBUG_DIR:
+- one JSON object per line (one <write> per record in append mode, so lines
+  of several gunicorn workers are not interleaved);
+- files are rotated by logrotate (server_config/megano_errors.logrotate), not
+  by workers: rotation of one file by several processes is not safe. Every
+  worker reopens the file, which is renamed (<WatchedFileHandler>);
+- repeated errors (the same file and the same errors) are written once
+  per ERROR_LOG_SAMPLE_WINDOW seconds, next record has field <repeated> -
+  number of skipped records.
+The listener is started lazily in every process (threads do not survive fork
+of gunicorn workers) and is stopped at exit with writing of the queue.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from os.path import join as join_path
+
+from megano_store.metrics import get_labels, inc_counter
+from megano_store.settings import (DEBUG_DIR, ERROR_LOG_SAMPLE_WINDOW,
+                                   ERROR_LOG_QUEUE_SIZE)
+
+_logger = logging.getLogger("megano_store.errors")
+_logger.propagate = False
+_logger.setLevel(logging.ERROR)
+
+_lock = threading.Lock()
+_state = {"pid": None, "listener": None}
+
+
+class JsonLineFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "pid": record.process,
+            "errors": record.errors,
+        }
+        if getattr(record, "repeated", 0):
+            data["repeated"] = record.repeated
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RepeatedErrorFilter(logging.Filter):
+    """
+    Skip records, which repeat the record written less than <window> seconds ago.
+    It works in the thread of the listener only, so no locks are needed.
+    """
+    def __init__(self, window: float):
+        super().__init__()
+        self.window = window
+        self.seen = {}  # {signature: [time of written record, skipped records]}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        signature = record.log_file + json.dumps(record.errors, sort_keys=True,
+                                                 default=str)
+        seen = self.seen.get(signature)
+
+        if seen and record.created - seen[0] < self.window:
+            seen[1] += 1
+            return False
+
+        record.repeated = seen[1] if seen else 0
+        self.seen[signature] = [record.created, 0]
+
+        if len(self.seen) > 10000:  # forget old signatures
+            self.seen = {key: value for key, value in self.seen.items()
+                         if record.created - value[0] < self.window}
+        return True
+
+
+class FileDispatchHandler(logging.Handler):
+    """
+    Write record to the file, which is named in <record.log_file>.
+    """
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+        self.addFilter(RepeatedErrorFilter(ERROR_LOG_SAMPLE_WINDOW))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        handler = self.handlers.get(record.log_file)
+
+        if handler is None:
+            handler = logging.handlers.WatchedFileHandler(
+                join_path(DEBUG_DIR, record.log_file),
+                encoding="utf-8",
+                delay=True,
+            )
+            handler.setFormatter(JsonLineFormatter())
+            self.handlers[record.log_file] = handler
+
+        handler.handle(record)
+
+    def close(self) -> None:
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # message is not formatted in the request thread
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc_counter("megano_error_log_dropped_total",
+                        get_labels(file=record.log_file))
+
+
+def _stop_listener() -> None:
+    listener = _state["listener"]
+    if listener is not None and _state["pid"] == os.getpid():
+        listener.stop()  # remaining records are written
+        for handler in listener.handlers:
+            handler.close()
+        _state["listener"] = None
+
+
+def _start_listener() -> None:
+    """
+    Start the listener in the current process (once per process).
+    """
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+
+        log_queue = queue.Queue(maxsize=ERROR_LOG_QUEUE_SIZE)
+        listener = logging.handlers.QueueListener(
+            log_queue, FileDispatchHandler(), respect_handler_level=False
+        )
+        listener.start()
+
+        for handler in list(_logger.handlers):  # handler of the parent process
+            _logger.removeHandler(handler)
+        _logger.addHandler(NonBlockingQueueHandler(log_queue))
+
+        _state.update(pid=os.getpid(), listener=listener)
+
+    atexit.register(_stop_listener)
+
+
+def log_errors(errors: dict, file_name: str) -> None:
+    """
+    Put errors into the queue of the log (the thread does not wait for writing).
+    :param errors: dictionary of errors
+    :param file_name: name of log file into DEBUG_DIR
+    :return: None
+    """
+    if _state["pid"] != os.getpid():
+        _start_listener()
+
+    _logger.error("errors", extra={"errors": errors, "log_file": file_name})
@@ -0,0 +1,94 @@
+"""
+Hooks of gunicorn (see server_config/gunicorn.conf.py, preload_app = True).
+
+Master process imports the application once, then <warm_up_master>:
+- imports all models and URL patterns (resolver is populated);
+- loads tree of categories and tags into memory (api_product/preload.py)
+  and primes cache of home page sections (refreshes of stale entries, which
+  are scheduled by it, are finished before fork, see caching.py);
+- builds index of suggestions of the search box (api_product/suggest.py);
+- closes DB connections (a SQLite connection must not be used across fork);
+- freezes objects for garbage collector, so workers do not write to the
+  shared pages during collection.
+Workers are forked with all of this already in memory (copy-on-write).
+"""
+
+import gc
+import time
+
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.db import connections
+from django.urls import get_resolver
+
+from api_product.invalidation import (BANNERS_CACHE_KEY, LIMITED_CACHE_KEY,
+                                      POPULAR_CACHE_KEY)
+from api_product.models import Category
+from api_product.preload import get_version, store_preloaded
+from api_product.suggest import load_index
+from megano_store.caching import shutdown_executor
+from megano_store.settings import CATEGORY_ID, RATING_VALUE
+
+_inherited_handles = []  # see <reset_worker>
+
+
+async def build_preloaded() -> dict:
+    """
+    Compose data for preloading and fill cache of home page sections.
+    :return: dictionary {name: data}
+    """
+    from api_product.views import get_categories_tree, get_product_list, get_tags
+
+    payloads = {"categories": await get_categories_tree(), "tags": await get_tags()}
+
+    async for category_id in Category.objects.values_list("pk", flat=True):
+        payloads["tags" + str(category_id)] = await get_tags(str(category_id))
+
+    await get_product_list(BANNERS_CACHE_KEY, category_id=int(CATEGORY_ID))
+    await get_product_list(LIMITED_CACHE_KEY, limited_edition=True)
+    await get_product_list(POPULAR_CACHE_KEY, rating__gt=int(RATING_VALUE))
+
+    return payloads
+
+
+def warm_up_master(server) -> None:
+    """
+    Hook <on_starting>: it is invoked in the master process before fork.
+    """
+    started = time.perf_counter()
+
+    models_count = len(apps.get_models())
+    resolver = get_resolver()
+    resolver.reverse_dict  # populate URL resolver (lazy)
+
+    try:
+        version = get_version()  # changes during the build - the next version
+        store_preloaded(async_to_sync(build_preloaded)(), version)
+        load_index()
+    except Exception as exc:  # workers will read cache and DB as usual
+        server.log.warning("Catalog is not preloaded: %s: %s",
+                           type(exc).__name__, exc)
+    finally:
+        shutdown_executor()  # refreshes of stale entries, which the build has read
+        connections.close_all()
+
+    gc.collect()
+    gc.freeze()
+
+    server.log.info("Preloaded %s models, %s URL patterns in %.3f s",
+                    models_count, len(resolver.url_patterns),
+                    time.perf_counter() - started)
+
+
+def reset_worker(server, worker) -> None:
+    """
+    Hook <post_fork>: it is invoked in the worker after fork.
+    Connections of the master are closed before fork. If something has opened
+    a connection after that, the worker does not use it and does not close it:
+    closing of inherited SQLite handle could checkpoint and remove WAL file,
+    which the master still uses. The handle is only kept from garbage collector.
+    """
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is not None:
+            _inherited_handles.append(conn.connection)
+            conn.connection = None
@@ -0,0 +1,107 @@
+"""
+Delivery of media files (files are sent by nginx, not by Django).
+
+- URL of media file has version - hash of the content (<?v=...>), so nginx sends
+  versioned files with far-future <Cache-Control: immutable> (see config
+  server_config/leowan_su(for_nginx)), and the new file gets the new URL.
+  Hash is computed once per version of the file (name, size, time of change).
+- Files with prefixes MEDIA_PROTECTED_PREFIXES (avatars of users) are not
+  available by /media/: their URLs are MEDIA_PROTECTED_URL + name, view
+  <protected_media_view> checks the access and returns header
+  X-Accel-Redirect (internal location of nginx sends the file).
+  In DEBUG mode (without nginx) the file is sent by Django.
+"""
+
+import hashlib
+import mimetypes
+import os
+import posixpath
+from functools import lru_cache
+from urllib.parse import quote, urljoin
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound
+from django.utils._os import safe_join
+
+from megano_store.settings import (MEDIA_ACCEL_REDIRECT, MEDIA_ACCEL_REDIRECT_LOCATION,
+                                   MEDIA_MAX_AGE, MEDIA_PROTECTED_PREFIXES,
+                                   MEDIA_PROTECTED_URL)
+
+
+@lru_cache(maxsize=20000)
+def get_file_hash(path: str, size: int, mtime_ns: int) -> str:
+    """
+    Hash of the content of the file (size and time are parts of the key of cache).
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def is_protected(name: str) -> bool:
+    return name.startswith(MEDIA_PROTECTED_PREFIXES)
+
+
+class HashedMediaStorage(FileSystemStorage):
+    """
+    Storage of media files, URL of existing file has version of its content.
+    """
+
+    def get_version(self, name: str) -> str:
+        try:
+            path = self.path(name)
+            stat = os.stat(path)
+        except (OSError, ValueError):  # file is absent (URL without version)
+            return ""
+        return get_file_hash(path, stat.st_size, stat.st_mtime_ns)
+
+    def url(self, name):
+        if not name:
+            return super().url(name)
+
+        if is_protected(name):
+            url = urljoin("/" + MEDIA_PROTECTED_URL, name)
+        else:
+            url = super().url(name)
+
+        version = self.get_version(name)
+        return f"{url}?v={version}" if version else url
+
+
+def can_access(request, name: str) -> bool:
+    """
+    Avatar is available for its owner and staff only.
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return False
+    return user.is_staff or name.startswith(f"users/user_{user.pk}/")
+
+
+def protected_media_view(request, name: str) -> HttpResponse:
+    """
+    Django checks the access only, nginx sends the file (X-Accel-Redirect).
+    Response is cached by the browser only (<private>), versioned URL is immutable.
+    """
+    if (posixpath.normpath(name) != name  # "../" of another user
+            or not is_protected(name) or not can_access(request, name)):
+        return HttpResponseNotFound()
+
+    path = safe_join(default_storage.location, name)
+
+    if MEDIA_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=mimetypes.guess_type(name)[0]
+                                or "application/octet-stream")
+        response["X-Accel-Redirect"] = MEDIA_ACCEL_REDIRECT_LOCATION + quote(name)
+    elif os.path.isfile(path):
+        response = FileResponse(open(path, "rb"))
+    else:
+        return HttpResponseNotFound()
+
+    if request.GET.get("v"):
+        response["Cache-Control"] = f"private, max-age={MEDIA_MAX_AGE}, immutable"
+    else:
+        response["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,316 @@
+"""
+Metrics of requests in the text format of Prometheus (endpoint /metrics).
+
+Middleware <MetricsMiddleware> records for every request, by name of resolved
+URL ("api_product:catalog", "api_order:orders", ...):
+- wall time of the request;
+- number and time of SQL queries (wrapper of all database connections, it is
+  installed at creation of connection, so read-only alias and threads of async
+  views are counted too);
+- hits and misses of the cache (backend <InstrumentedFileBasedCache>).
+
+Values are accumulated in the memory of the process and are added to the shared
+SQLite file METRICS_DB_PATH once per METRICS_FLUSH_INTERVAL seconds (one
+transaction with UPSERT), so histograms are summed across gunicorn workers.
+The file is written by the background thread of the process: requests (and the
+event loop of async workers) do not wait for the disk.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotFound
+
+from megano_store.settings import (METRICS_DB_PATH, METRICS_FLUSH_INTERVAL,
+                                   METRICS_ALLOWED_IPS)
+from megano_store.streamcontext import keep_context
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+HISTOGRAMS = {
+    "megano_request_duration_seconds": ("Wall time of request.", DURATION_BUCKETS),
+    "megano_sql_queries": ("Number of SQL queries per request.", QUERY_BUCKETS),
+    "megano_sql_duration_seconds": ("Time of SQL queries per request.", DURATION_BUCKETS),
+}
+
+COUNTERS = {
+    "megano_requests_total": "Requests by status code.",
+    "megano_cache_hits_total": "Hits of the cache.",
+    "megano_cache_misses_total": "Misses of the cache.",
+    "megano_rate_limited_total": "Requests rejected by rate limits (see ratelimit.py).",
+    "megano_cache_refreshes_total": "Background refreshes of stale entries (see caching.py).",
+    "megano_error_log_dropped_total": "Records of the log of errors dropped by the full queue.",
+}
+
+_current = ContextVar("metrics_request", default=None)
+
+_lock = threading.Lock()
+_state = {"pid": None, "stop": None}
+_pending = defaultdict(float)  # {(name, labels, le): value}
+
+
+class RequestStats:
+    __slots__ = ("queries", "sql_time", "cache_hits", "cache_misses")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.sql_time += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def install_sql_wrapper(sender, connection, **kwargs) -> None:
+    if _sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_sql_wrapper)
+
+
+class InstrumentedFileBasedCache(FileBasedCache):
+    """
+    File based cache, which counts hits and misses of the current request.
+    """
+    _missing = object()
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._missing, version)
+        stats = _current.get()
+
+        if value is self._missing:
+            if stats is not None:
+                stats.cache_misses += 1
+            return default
+
+        if stats is not None:
+            stats.cache_hits += 1
+        return value
+
+
+def get_labels(**labels) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def inc_counter(name: str, labels: str, value: float = 1) -> None:
+    with _lock:
+        _pending[(name, labels, "")] += value
+
+
+def observe(name: str, labels: str, value: float) -> None:
+    """
+    Add the value into the histogram <name>: bucket, sum and count.
+    """
+    buckets = HISTOGRAMS[name][1]
+    le = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+
+    with _lock:
+        _pending[(name, labels, le)] += 1
+        _pending[(name + "_sum", labels, "")] += value
+        _pending[(name + "_count", labels, "")] += 1
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(METRICS_DB_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS metric ("
+                 "name TEXT, labels TEXT, le TEXT, value REAL, "
+                 "PRIMARY KEY (name, labels, le))")
+    return conn
+
+
+def flush() -> None:
+    """
+    Add values of this process to the shared file of metrics.
+    """
+    with _lock:
+        items = list(_pending.items())
+        _pending.clear()
+
+    if not items:
+        return
+
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO metric (name, labels, le, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (name, labels, le) DO UPDATE SET value = value + excluded.value",
+            ((name, labels, le, value) for (name, labels, le), value in items)
+        )
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        with _lock:  # values are kept till the next flush
+            for key, value in items:
+                _pending[key] += value
+    finally:
+        conn.close()
+
+
+def _run_writer(stop: threading.Event) -> None:
+    while not stop.wait(METRICS_FLUSH_INTERVAL):
+        flush()
+
+
+def _stop_writer() -> None:
+    if _state["pid"] == os.getpid():
+        _state["stop"].set()
+        flush()
+
+
+def check_process() -> None:
+    """
+    Values, which are inherited from the master process of gunicorn, are dropped
+    at the first request of the worker, and the writer of the worker is started
+    (threads do not survive fork).
+    """
+    if _state["pid"] == os.getpid():
+        return
+
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+
+        _pending.clear()
+        stop = threading.Event()
+        threading.Thread(target=_run_writer, args=(stop,), name="metrics-writer",
+                         daemon=True).start()
+        _state.update(pid=os.getpid(), stop=stop)
+
+    atexit.register(_stop_writer)
+
+
+def record_request(request, response, stats: RequestStats, duration: float) -> None:
+    check_process()
+    match = request.resolver_match
+    view = match.view_name if match else "unresolved"
+    labels = get_labels(view=view)
+
+    observe("megano_request_duration_seconds", labels, duration)
+    observe("megano_sql_queries", labels, stats.queries)
+    observe("megano_sql_duration_seconds", labels, stats.sql_time)
+    inc_counter("megano_requests_total",
+                get_labels(view=view, status=response.status_code))
+    if stats.cache_hits:
+        inc_counter("megano_cache_hits_total", labels, stats.cache_hits)
+    if stats.cache_misses:
+        inc_counter("megano_cache_misses_total", labels, stats.cache_misses)
+
+
+class MetricsMiddleware:
+    """
+    It must be the first middleware, so the whole request is measured.
+    Streamed responses are recorded, when the body is sent: their queries are
+    executed after the view has returned (see streamcontext.py).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        return self.finish(request, response, stats, start)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        return self.finish(request, response, stats, start)
+
+    @staticmethod
+    def finish(request, response, stats: RequestStats, start: float):
+        def record():
+            record_request(request, response, stats, time.perf_counter() - start)
+
+        if response.streaming:
+            return keep_context(response, _current, stats, record)
+
+        record()
+        return response
+
+
+def render_metrics() -> str:
+    conn = connect()
+    try:
+        rows = conn.execute("SELECT name, labels, le, value FROM metric").fetchall()
+    finally:
+        conn.close()
+
+    values = defaultdict(dict)  # {name: {labels: value or {le: value}}}
+    for name, labels, le, value in rows:
+        if le:
+            values[name].setdefault(labels, {})[le] = value
+        else:
+            values[name][labels] = value
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        lines += [f"{name}{{{labels}}} {value:g}"
+                  for labels, value in sorted(values[name].items())]
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for labels, counts in sorted(values[name].items()):
+            total = 0
+            for le in [str(bound) for bound in buckets] + ["+Inf"]:
+                total += counts.get(le, 0)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {total:g}')
+            lines.append(f"{name}_sum{{{labels}}} {values[name + '_sum'][labels]:g}")
+            lines.append(f"{name}_count{{{labels}}} {values[name + '_count'][labels]:g}")
+
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request) -> HttpResponse:
+    """
+    Metrics of all workers. Only local requests are allowed (requests through
+    nginx have header X-Forwarded-For).
+    """
+    if (request.META.get("REMOTE_ADDR") not in METRICS_ALLOWED_IPS
+            or "HTTP_X_FORWARDED_FOR" in request.META):
+        return HttpResponseNotFound()
+
+    flush()
+    return HttpResponse(render_metrics(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,316 @@
+"""
+Inspector of SQL queries for development and tests (N+1 queries).
+
+Executed queries are grouped by normalized statement (literals and lists of
+parameters are replaced) and call site (the first frame of the project code).
+A group, which is repeated QUERY_REPEAT_THRESHOLD times or more during one
+request, is an N+1 pattern: it is written with the stack trace to the file
+'errors_from_queries.log' (see write_errors in utils.py).
+
+Budgets of queries:
+- QUERY_BUDGETS ({URL name: max number of queries}) are checked by middleware
+  <QueryInspectorMiddleware> for every request;
+- <query_budget> - context manager for tests and scripts.
+If setting QUERY_INSPECTOR_RAISE is True (tests), N+1 patterns and exceeded
+budgets raise QueryBudgetExceeded, so the test client fails the test.
+
+The middleware is added to MIDDLEWARE only if QUERY_INSPECTOR_ENABLED is True
+(DEBUG by default).
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import AsyncToSync, iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from megano_store.streamcontext import keep_context
+from megano_store.utils import write_errors
+
+BASE_DIR = str(Path(__file__).resolve().parent.parent)
+ASGIREF_SYNC = os.path.join("asgiref", "sync.py")
+
+_current = ContextVar("query_recorder", default=None)
+
+_re_strings = re.compile(r"'(?:[^']|'')*'")
+_re_numbers = re.compile(r"\b\d+(?:\.\d+)?\b")
+_re_lists = re.compile(r"\((?:\s*(?:%s|\?|N)\s*,)+\s*(?:%s|\?|N)\s*\)")
+_re_spaces = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    SELECT ... WHERE id IN (1, 2, 3) AND title = 'a'
+    -> SELECT ... WHERE id IN (...) AND title = S
+    """
+    sql = _re_strings.sub("S", sql)
+    sql = _re_numbers.sub("N", sql)
+    sql = _re_lists.sub("(...)", sql)
+    return _re_spaces.sub(" ", sql).strip()
+
+
+def is_project_frame(frame: traceback.FrameSummary) -> bool:
+    # wrappers of connections (this module, metrics.py) are not call sites
+    return (frame.filename.startswith(BASE_DIR) and frame.filename != __file__
+            and "site-packages" not in frame.filename
+            and frame.name != "_sql_wrapper")
+
+
+def get_task_frames(task: asyncio.Task) -> list:
+    """
+    Frames of the suspended task: chain of awaited coroutines
+    (Task.get_stack returns only one frame for suspended coroutine).
+    """
+    frames, coro = [], task.get_coro()
+    while coro is not None:
+        frame = (getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None)
+                 or getattr(coro, "gi_frame", None))
+        if frame is not None:
+            frames.append((frame, frame.f_lineno))
+        coro = (getattr(coro, "cr_await", None) or getattr(coro, "ag_await", None)
+                or getattr(coro, "gi_yieldfrom", None))
+    return list(traceback.StackSummary.extract(frames))
+
+
+def get_loop_tasks() -> list:
+    """
+    Tasks of event loops, which are started by async_to_sync from the current
+    thread (async view under WSGI: Django calls it through async_to_sync).
+    """
+    thread = threading.current_thread()
+    tasks = []
+    for loop, executor in list(AsyncToSync.loop_thread_executors.items()):
+        if getattr(executor, "_work_thread", None) is thread:
+            tasks += [task for task in asyncio.all_tasks(loop) if not task.done()]
+    # nested async_to_sync creates a new task in the same loop: order of creation
+    # ("Task-<N>") is the order of calls
+    return sorted(tasks, key=lambda task: int(task.get_name().rpartition("-")[2])
+                  if task.get_name().startswith("Task-") else 0)
+
+
+def get_project_stack(task: asyncio.Task = None) -> list:
+    """
+    Frames of the project code (packages and this module are skipped).
+    Queries of async views are executed in a thread (sync_to_async), which
+    does not have frames of the view: they are taken from suspended tasks
+    (the task of the request under ASGI, tasks of loops of async_to_sync under
+    WSGI) and joined with frames after the boundary of asgiref.
+    """
+    frames = traceback.extract_stack()[:-1]
+    boundary = max((i for i, frame in enumerate(frames)
+                    if frame.filename.endswith(ASGIREF_SYNC)), default=None)
+
+    if boundary is not None:
+        tasks = get_loop_tasks() or ([task] if task is not None else [])
+        if tasks:
+            frames = [frame for task in tasks
+                      for frame in get_task_frames(task)] + frames[boundary + 1:]
+
+    return [frame for frame in frames if is_project_frame(frame)]
+
+
+class QueryRecorder:
+
+    def __init__(self, task: asyncio.Task = None, parent=None):
+        self.queries = []  # [(normalized sql, call site, duration, stack)]
+        self.task = task  # task of async request
+        self.parent = parent  # recorder of the outer block, it gets queries too
+
+    def __len__(self):
+        return len(self.queries)
+
+    def add(self, sql: str, duration: float) -> None:
+        stack = get_project_stack(self.task)
+        call_site = f"{stack[-1].filename}:{stack[-1].lineno}" if stack else "unknown"
+        query = (normalize_sql(sql), call_site, duration, stack)
+
+        recorder = self
+        while recorder is not None:
+            recorder.queries.append(query)
+            recorder = recorder.parent
+
+    def get_repeated(self, threshold: int) -> list:
+        """
+        Groups of queries, which are repeated <threshold> times or more.
+        :return: list of dictionaries (sorted by number of queries)
+        """
+        groups = {}
+        for sql, call_site, duration, stack in self.queries:
+            group = groups.setdefault((sql, call_site), {
+                "sql": sql,
+                "call_site": call_site,
+                "count": 0,
+                "duration_ms": 0.0,
+                "stack": [f"{frame.filename}:{frame.lineno} in {frame.name}: "
+                          f"{frame.line}" for frame in stack],
+            })
+            group["count"] += 1
+            group["duration_ms"] += duration * 1000
+
+        repeated = [group for group in groups.values() if group["count"] >= threshold]
+        return sorted(repeated, key=lambda group: group["count"], reverse=True)
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    recorder = _current.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.add(sql, time.perf_counter() - start)
+
+
+@receiver(connection_created)
+def install_sql_wrapper(sender, connection, **kwargs) -> None:
+    if _sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_sql_wrapper)
+
+
+def install_on_open_connections() -> None:
+    """
+    Connections, which were opened before import of this module, are not
+    sent by signal <connection_created>.
+    """
+    from django.db import connections
+
+    for conn in connections.all(initialized_only=True):
+        install_sql_wrapper(None, conn)
+
+
+@contextmanager
+def record_queries():
+    """
+    Record queries of all database aliases (threads of async views too).
+    Usage:
+        with record_queries() as recorder:
+            ...
+        recorder.get_repeated(threshold=5)
+    """
+    install_on_open_connections()
+    parent = _current.get()  # e.g. <query_budget> of the test around the middleware
+    try:
+        recorder = QueryRecorder(asyncio.current_task(), parent)
+    except RuntimeError:  # no event loop
+        recorder = QueryRecorder(parent=parent)
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+
+
+def check_queries(recorder: QueryRecorder, name: str, budget: int = None,
+                  threshold: int = None, raise_error: bool = None) -> dict:
+    """
+    Find N+1 patterns and check the budget, write the report to the file
+    'errors_from_queries.log' and raise QueryBudgetExceeded if it is required.
+    :param recorder: recorded queries
+    :param name: URL name or name of checked code
+    :param budget: max number of queries (None - not checked)
+    :param threshold: min number of repeats of N+1 pattern
+    :param raise_error: raise exception (None - setting QUERY_INSPECTOR_RAISE)
+    :return: report (empty dictionary - no problems)
+    """
+    threshold = threshold or settings.QUERY_REPEAT_THRESHOLD
+    if raise_error is None:
+        raise_error = settings.QUERY_INSPECTOR_RAISE
+    report = {}
+
+    repeated = recorder.get_repeated(threshold)
+    if repeated:
+        report["NPlusOne"] = repeated
+    if budget is not None and len(recorder) > budget:
+        report["QueryBudget"] = f"{len(recorder)} queries, budget - {budget}"
+
+    if report:
+        report = {"name": name, "queries": len(recorder), **report}
+        write_errors(report, "errors_from_queries.log")
+
+        if raise_error:
+            raise QueryBudgetExceeded(
+                f"{name}: {report.get('QueryBudget', '')} " +
+                "; ".join(f"{group['count']} x {group['sql'][:120]} at "
+                          f"{group['call_site']}" for group in repeated)
+            )
+    return report
+
+
+@contextmanager
+def query_budget(budget: int, name: str = "query_budget", threshold: int = None):
+    """
+    Raise QueryBudgetExceeded, if the code in the block executes more than
+    <budget> queries or N+1 queries.
+    Usage in tests:
+        with query_budget(5):
+            self.client.get(reverse("api_product:catalog"), query)
+    """
+    with record_queries() as recorder:
+        yield recorder
+
+    check_queries(recorder, name, budget, threshold, raise_error=True)
+
+
+class QueryInspectorMiddleware:
+    """
+    Check queries of every request: N+1 patterns and QUERY_BUDGETS.
+    Response has header <X-Query-Count>. Streamed responses are checked, when
+    the body is sent (see streamcontext.py), their headers are already sent
+    and do not have the header.
+    The middleware must be the last one: under ASGI its task awaits async view
+    directly and keeps frames of the view (see get_project_stack), under WSGI
+    async views are called through async_to_sync in the thread of the request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install_on_open_connections()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        with record_queries() as recorder:
+            response = self.get_response(request)
+
+        return self.check_response(request, response, recorder)
+
+    async def __acall__(self, request):
+        with record_queries() as recorder:
+            response = await self.get_response(request)
+
+        return self.check_response(request, response, recorder)
+
+    @staticmethod
+    def check_response(request, response, recorder: QueryRecorder):
+        match = request.resolver_match
+        name = match.view_name if match else request.path
+
+        def check():
+            check_queries(recorder, name, settings.QUERY_BUDGETS.get(name))
+
+        if response.streaming:
+            return keep_context(response, _current, recorder, check)
+
+        check()
+        response["X-Query-Count"] = str(len(recorder))
+        return response
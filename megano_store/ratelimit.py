@@ -0,0 +1,145 @@
+"""
+Rate limiting of expensive endpoints (check of password, filters of the catalog).
+
+Decorator <rate_limit(scope)> checks token buckets of the request before the view:
+- RATE_LIMITS[scope] - size of bucket <limit> (burst of requests), it is refilled
+  by <limit> tokens per <period> seconds, and <keys> of the client:
+  "ip" - address of the client (header of nginx RATE_LIMIT_IP_HEADER),
+  "user" - ID of the logged in user (IP of anonymous user),
+  "username" - name from JSON body of the login (credential stuffing by many IP);
+- every request takes one token of every bucket, the request is rejected with
+  status 429 and header <Retry-After>, if any bucket is empty;
+- buckets are stored in the shared cache (all workers), the rejection reads the
+  cache only: the database, password hashers and the session table are not touched
+  (ID of the user is read from the cached session).
+Buckets are read and written without lock, so concurrent requests of the same
+client can take one token twice: the limit is approximate.
+
+Rejections are counted by metric <megano_rate_limited_total> (see metrics.py).
+Limits are not checked, if RATE_LIMIT_ENABLED is False (benchmarks).
+"""
+
+import functools
+import hashlib
+import json
+import time
+from math import ceil
+
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from megano_store.metrics import get_labels, inc_counter
+from megano_store.settings import RATE_LIMIT_ENABLED, RATE_LIMIT_IP_HEADER, RATE_LIMITS
+
+
+def get_ip(request) -> str:
+    return (request.META.get(RATE_LIMIT_IP_HEADER)
+            or request.META.get("REMOTE_ADDR") or "unknown")
+
+
+def get_username(request) -> str | None:
+    try:
+        username = json.loads(request.body).get("username")
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(username, str) or not username.strip():
+        return None
+    return username.strip().lower()
+
+
+def get_bucket_keys(request, scope: str, user_id) -> list:
+    """
+    :param user_id: ID of the user from the session (None - anonymous)
+    :return: list of keys of the cache
+    """
+    keys = []
+    for kind in RATE_LIMITS[scope]["keys"]:
+        if kind == "ip":
+            value = get_ip(request)
+        elif kind == "user":
+            value = f"user{user_id}" if user_id is not None else get_ip(request)
+        elif kind == "username":
+            value = get_username(request)
+        else:
+            raise ValueError(f"Unknown key <{kind}> of rate limit <{scope}>.")
+
+        if value is not None:
+            # names of users and IPv6 are not valid keys of memcached
+            digest = hashlib.md5(value.encode("utf-8")).hexdigest()
+            keys.append(f"ratelimit:{scope}:{kind}:{digest}")
+    return keys
+
+
+def take_tokens(buckets: dict, keys: list, scope: str) -> tuple:
+    """
+    Refill buckets by the time passed and take one token of every bucket.
+    :param buckets: values of the cache {key: (tokens, time)}
+    :return: (updated buckets or None - rejected, seconds to wait)
+    """
+    limit, period = RATE_LIMITS[scope]["limit"], RATE_LIMITS[scope]["period"]
+    rate = limit / period  # tokens per second
+    now = time.time()
+    updated = {}
+
+    for key in keys:
+        tokens, updated_at = buckets.get(key, (limit, now))
+        tokens = min(limit, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            return None, ceil((1 - tokens) / rate)
+        updated[key] = (tokens - 1, now)
+    return updated, 0
+
+
+def reject(scope: str, retry_after: int) -> JsonResponse:
+    inc_counter("megano_rate_limited_total", get_labels(scope=scope))
+    response = JsonResponse({"RateLimitError": "Too many requests, "
+                                               f"retry after {retry_after} s."},
+                            status=429)
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def rate_limit(scope: str):
+    """
+    This decorator is used for views (see the top of the module).
+    Synchronous and asynchronous views are supported.
+    :param scope: name of the limit in RATE_LIMITS
+    :return: decorator
+    """
+    timeout = RATE_LIMITS[scope]["period"]
+
+    def decorator(func):
+        if not RATE_LIMIT_ENABLED:
+            return func
+
+        if iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(request, *args, **kwargs):
+                user_id = await request.session.aget(SESSION_KEY)
+                keys = get_bucket_keys(request, scope, user_id)
+                updated, retry_after = take_tokens(await cache.aget_many(keys),
+                                                   keys, scope)
+                if updated is None:
+                    return reject(scope, retry_after)
+
+                await cache.aset_many(updated, timeout)
+                return await func(request, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(request, *args, **kwargs):
+            keys = get_bucket_keys(request, scope, request.session.get(SESSION_KEY))
+            updated, retry_after = take_tokens(cache.get_many(keys), keys, scope)
+            if updated is None:
+                return reject(scope, retry_after)
+
+            cache.set_many(updated, timeout)
+            return func(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
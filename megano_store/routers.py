@@ -0,0 +1,91 @@
+"""
+Routing of read queries to the read-only database alias.
+
+Queries of catalog views (api_product) and admin list pages are sent to
+DATABASE_READ_ONLY_ALIAS (the same SQLite file, opened with <mode=ro>),
+so they do not share the connection with writes of checkout and reviews.
+Writes and everything inside <transaction.atomic> block go to the primary alias.
+"""
+
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from megano_store.settings import DATABASE_READ_ONLY_ALIAS
+
+_read_only = ContextVar("read_only_db", default=False)
+
+
+@contextmanager
+def read_only_db():
+    """
+    Context manager: read queries inside it go to the read-only alias.
+    """
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def use_read_only_db(func):
+    """
+    This decorator is used for read-only views (see <read_only_db> above).
+    Synchronous and asynchronous views are supported (context variable is copied
+    to the thread of <sync_to_async>, where queries are executed).
+    :param func: function from <views.py>
+    :return:
+    """
+    if iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with read_only_db():
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with read_only_db():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class ReadOnlyChangeListMixin:
+    """
+    Mixin for ModelAdmin: GET requests of list page read from the read-only alias.
+    Response is rendered inside the context manager, because querysets of
+    TemplateResponse are evaluated at rendering.
+    """
+    def changelist_view(self, request, extra_context=None):
+        if request.method != "GET":
+            return super().changelist_view(request, extra_context=extra_context)
+
+        with read_only_db():
+            response = super().changelist_view(request, extra_context=extra_context)
+            if hasattr(response, "render"):
+                response.render()
+        return response
+
+
+class CatalogReadRouter:
+
+    def db_for_read(self, model, **hints):
+        if (_read_only.get()
+                and not connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DATABASE_READ_ONLY_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # both aliases are the same database
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
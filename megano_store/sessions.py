@@ -0,0 +1,202 @@
+"""
+Engine of sessions: cached sessions with write-behind persistence
+(setting SESSION_ENGINE = "megano_store.sessions").
+
+Session (the cart of anonymous user - SESSION_KEY_CART) is read from and written
+to the cache SESSION_CACHE_ALIAS, request does not write to the database:
+- key of saved session is put into the queue of this process, background thread
+  writes queued sessions to the table <django_session> once per
+  SESSION_PERSIST_INTERVAL seconds (one transaction with UPSERT), so several
+  writes of the same session during the interval are one write to the database;
+- data is taken from the cache at the moment of writing (the last version of
+  all workers), sessions, which are not in the cache (deleted at logout),
+  are not written;
+- saving of unchanged data (views set <session.modified> for the same cart)
+  is skipped;
+- the database is read only if the session is not in the cache.
+Deletion of session (logout, cycle of key at login) is written immediately.
+Sessions, which are saved less than SESSION_PERSIST_INTERVAL seconds before
+crash of the process, are kept in the cache only.
+
+Expired sessions are deleted by batches (command <purge_expired_sessions>,
+<clearsessions> of Django uses the same function).
+"""
+
+import atexit
+import os
+import threading
+from itertools import count
+
+from asgiref.sync import sync_to_async
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import DatabaseError, connections, transaction
+from django.utils import timezone
+
+from megano_store.settings import SESSION_PERSIST_INTERVAL, SESSION_PURGE_BATCH_SIZE
+from megano_store.utils import write_errors
+
+_lock = threading.Lock()
+_state = {"pid": None, "stop": None}
+_pending = {}  # {session key: expire date}
+
+
+class SessionFileCache(FileBasedCache):
+    """
+    File based cache for sessions: FileBasedCache lists all files of the
+    directory at every write to check MAX_ENTRIES, this one checks it once
+    per CULL_EVERY writes.
+    """
+    CULL_EVERY = 100
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._writes = count()
+
+    def _cull(self):
+        if next(self._writes) % self.CULL_EVERY == 0:
+            super()._cull()
+
+
+class SessionStore(CachedDBStore):
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._saved_state = None  # serialized data, which is in the cache
+
+    def load(self):
+        data = super().load()
+        self._saved_state = self.serializer().dumps(data)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+
+        data = self._get_session(no_load=must_create)
+        state = self.serializer().dumps(data)
+        if not must_create and state == self._saved_state:
+            return
+
+        if must_create:
+            if not self._cache.add(self.cache_key, data, self.get_expiry_age()):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+
+        self._saved_state = state
+        schedule_persist(self.session_key, self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        with _lock:
+            _pending.pop(session_key or self.session_key, None)
+        super().delete(session_key)
+
+    async def aload(self):
+        return await sync_to_async(self.load)()
+
+    async def asave(self, must_create=False):
+        await sync_to_async(self.save)(must_create)
+
+    async def adelete(self, session_key=None):
+        await sync_to_async(self.delete)(session_key)
+
+    @classmethod
+    def clear_expired(cls):
+        delete_expired_sessions()
+
+
+def persist_sessions() -> int:
+    """
+    Write queued sessions of this process to the database.
+    :return: number of written sessions
+    """
+    with _lock:
+        items = dict(_pending)
+        _pending.clear()
+
+    if not items:
+        return 0
+
+    store = SessionStore()
+    model = store.model
+    cached = store._cache.get_many([store.cache_key_prefix + key for key in items])
+    sessions = [
+        model(session_key=key, expire_date=expire_date,
+              session_data=store.encode(cached[store.cache_key_prefix + key]))
+        for key, expire_date in items.items()
+        if store.cache_key_prefix + key in cached
+    ]
+
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(sessions, update_conflicts=True,
+                                      unique_fields=["session_key"],
+                                      update_fields=["session_data", "expire_date"])
+    except DatabaseError as exc:
+        with _lock:  # keys are kept till the next attempt
+            for key, expire_date in items.items():
+                _pending.setdefault(key, expire_date)
+        write_errors({"SessionPersistError": f"{type(exc).__name__} : {exc}",
+                      "sessions": len(items)}, "errors_from_sessions.log")
+        return 0
+    return len(sessions)
+
+
+def _run_writer(stop: threading.Event) -> None:
+    while not stop.wait(SESSION_PERSIST_INTERVAL):
+        persist_sessions()
+        connections.close_all()  # connections of this thread
+
+
+def _stop_writer() -> None:
+    if _state["pid"] == os.getpid():
+        _state["stop"].set()
+        persist_sessions()
+
+
+def _start_writer() -> None:
+    """
+    Start the background writer in the current process (once per process:
+    threads do not survive fork of gunicorn workers).
+    """
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+
+        _pending.clear()  # keys of the parent process are written by it
+        stop = threading.Event()
+        threading.Thread(target=_run_writer, args=(stop,), name="session-writer",
+                         daemon=True).start()
+        _state.update(pid=os.getpid(), stop=stop)
+
+    atexit.register(_stop_writer)
+
+
+def schedule_persist(session_key: str, expire_date) -> None:
+    if _state["pid"] != os.getpid():
+        _start_writer()
+
+    with _lock:
+        _pending[session_key] = expire_date
+
+
+def delete_expired_sessions(batch_size: int = SESSION_PURGE_BATCH_SIZE) -> int:
+    """
+    Delete expired sessions by batches, every batch - one short transaction,
+    so writes of checkout are not blocked by one long DELETE.
+    :param batch_size: number of sessions deleted by one query
+    :return: number of deleted sessions
+    """
+    model = SessionStore.get_model_class()
+    now = timezone.now()
+    deleted = 0
+
+    while True:
+        expired = model.objects.filter(expire_date__lt=now).values("pk")[:batch_size]
+        with transaction.atomic():
+            batch, _ = model.objects.filter(pk__in=expired).delete()
+        deleted += batch
+        if batch < batch_size:
+            return deleted
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'megano_store.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +59,33 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Inspector of SQL queries (megano_store/queries.py): N+1 patterns (queries, which
+# are repeated QUERY_REPEAT_THRESHOLD times at the same place of code) and budgets
+# of queries per URL name are written to 'errors_from_queries.log';
+# QUERY_INSPECTOR_RAISE - raise exception instead (tests).
+QUERY_INSPECTOR_ENABLED = DEBUG or getenv("N_QUERY_INSPECTOR") == "1"
+QUERY_INSPECTOR_RAISE = getenv("N_QUERY_INSPECTOR") == "1"
+QUERY_REPEAT_THRESHOLD = 5
+QUERY_BUDGETS = {
+    "api_product:categories": 4,
+    "api_product:tags": 2,
+    "api_product:banners": 4,
+    "api_product:limited": 4,
+    "api_product:popular": 4,
+    "api_product:sales": 5,
+    "api_product:catalog": 7,  # fuzzy search by similar tags
+    "api_product:product": 8,
+    "api_product:related": 5,
+    "api_order:basket": 8,
+    "api_order:orders": 12,
+    "api_order:oneorder-with-slash": 10,
+    "api_order:oneorder-less-slash": 10,
+    "api_order:payment": 17,
+}
+
+if QUERY_INSPECTOR_ENABLED:  # the last one: it is called directly before the view
+    MIDDLEWARE.append('megano_store.queries.QueryInspectorMiddleware')
+
 ROOT_URLCONF = 'megano_store.urls'
 
 TEMPLATES = [
@@ -85,13 +113,43 @@ WSGI_APPLICATION = 'megano_store.wsgi.application'
 DB_DIR = BASE_DIR / "DB"
 DB_DIR.mkdir(exist_ok=True)
 
+# Backend <megano_store.sqlite_backend> applies PRAGMAs (WAL, busy timeout, ...)
+# on connect and uses <BEGIN IMMEDIATE> for transactions (see its module).
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'megano_store.sqlite_backend',
         'NAME': DB_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'pragmas': {
+                'busy_timeout': 20000,
+            },
+        },
+    },
+    # The same file, opened read-only (catalog views and admin list pages,
+    # see megano_store/routers.py). In WAL mode readers do not wait for writers.
+    'catalog_ro': {
+        'ENGINE': 'megano_store.sqlite_backend',
+        'NAME': f"file:{DB_DIR / 'db.sqlite3'}?mode=ro",
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pragmas': {
+                'busy_timeout': 20000,
+            },
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
 
+DATABASE_READ_ONLY_ALIAS = "catalog_ro"
+
+DATABASE_ROUTERS = ["megano_store.routers.CatalogReadRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -136,6 +194,21 @@ STATIC_URL = "static/"
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "media/"
 
+# URLs of media files have version of the content, nginx sends them with
+# far-future Cache-Control (see megano_store/media.py)
+STORAGES = {
+    "default": {"BACKEND": "megano_store.media.HashedMediaStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+MEDIA_MAX_AGE = 365 * 24 * 3600  # seconds
+
+# Avatars are sent through Django (access check) and nginx (X-Accel-Redirect
+# to the internal location)
+MEDIA_PROTECTED_PREFIXES = ("users/",)
+MEDIA_PROTECTED_URL = "protected-media/"
+MEDIA_ACCEL_REDIRECT = not DEBUG
+MEDIA_ACCEL_REDIRECT_LOCATION = "/internal-media/"
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -148,23 +221,85 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 DEBUG_DIR = BASE_DIR / "debug"
 DEBUG_DIR.mkdir(exist_ok=True)
 
+# Log files of errors (megano_store/errorlog.py, they are rotated by logrotate,
+# see server_config/megano_errors.logrotate): window of sampling of repeated
+# errors (seconds), size of the queue (records are dropped, when it is full)
+ERROR_LOG_SAMPLE_WINDOW = 60
+ERROR_LOG_QUEUE_SIZE = 10000
+
+
+##  Metrics (megano_store/metrics.py, endpoint /metrics)  ##
+# Shared file of all workers, values of process are added to it once per interval (seconds)
+METRICS_DB_PATH = DEBUG_DIR / "metrics.sqlite3"
+METRICS_FLUSH_INTERVAL = 5
+METRICS_ALLOWED_IPS = ("127.0.0.1", "::1", "")  # "" - unix socket of gunicorn
+
 
 ##  Cache  ##
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "BACKEND": "megano_store.metrics.InstrumentedFileBasedCache",
         "LOCATION": "/var/tmp/django_cache/megano/",
     },
+    "sessions": {
+        "BACKEND": "megano_store.sessions.SessionFileCache",
+        "LOCATION": "/var/tmp/django_cache/megano_sessions/",
+        "OPTIONS": {"MAX_ENTRIES": 200000},
+    },
 }
 
+# Stale-while-revalidate (megano_store/caching.py): after its timeout the entry
+# is served during CACHE_STALE_TIME seconds more, while one worker refreshes it
+# in the background. The lock of the refresh expires after the timeout (seconds),
+# if the refresh has failed; number of threads of refreshes per process.
+CACHE_STALE_TIME = 3600
+CACHE_REFRESH_LOCK_TIMEOUT = 300
+CACHE_REFRESH_WORKERS = 2
+
 
 ##  Session  ##
 SESSION_KEY_CART = "cart"
 
+# Cached sessions with write-behind persistence (megano_store/sessions.py):
+# sessions are written to the database once per interval (seconds)
+SESSION_ENGINE = "megano_store.sessions"
+SESSION_CACHE_ALIAS = "sessions"
+SESSION_PERSIST_INTERVAL = 5
+SESSION_PURGE_BATCH_SIZE = 1000
+
+
+##  Idempotency keys (orders and payment)  ##
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_TTL = 86400  # seconds
+
+
+##  Rate limits (megano_store/ratelimit.py)  ##
+# Token bucket of every key of the client: <limit> requests at once, bucket is
+# refilled by <limit> tokens per <period> seconds. Keys: "ip", "user" (ID of
+# logged in user or IP), "username" (name of the login attempt).
+RATE_LIMIT_ENABLED = getenv("N_RATE_LIMIT", "1") == "1"
+RATE_LIMIT_IP_HEADER = "HTTP_X_REAL_IP"  # set by nginx (proxy_params)
+RATE_LIMITS = {
+    "auth": {"limit": 10, "period": 60, "keys": ("ip", "username")},
+    "catalog": {"limit": 120, "period": 60, "keys": ("user",)},
+}
+
 
 ##  Pagination  ##
 PAGE_ITEM_LIMIT = 20
 
+# Admin (megano_store/admin_utils.py): filtered lists are counted up to the limit,
+# number of reviews shown on the page of the product
+ADMIN_COUNT_LIMIT = 10000
+ADMIN_REVIEWS_PREVIEW = 10
+
+# Streaming of large lists (megano_store/streaming.py): rows are read from the
+# database by chunks, the response is sent by pieces of STREAM_BUFFER_SIZE bytes,
+# lists, which are encoded into more than STREAM_CACHE_MAX_BYTES, are not cached
+STREAM_CHUNK_SIZE = 500
+STREAM_BUFFER_SIZE = 64 * 1024
+STREAM_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
 
 ##  Site home page  ##
 
@@ -176,3 +311,67 @@ RATING_VALUE = "4"
 
 # Limit of products for section:
 PRODUCT_LIMIT = 8
+
+# "Frequently bought together": number of neighbors stored for every product
+# (PRODUCT_LIMIT of them are shown):
+RELATED_PRODUCTS_KEEP = 50
+
+
+##  Suggestions of the search box (api_product/suggest.py)  ##
+
+# Number of suggested products and tags, prefixes up to SUGGEST_PREFIX_DEPTH
+# characters keep their top items, keys are cut to SUGGEST_KEY_LENGTH characters,
+# version of the index (changes of products) is checked once per interval (seconds)
+SUGGEST_LIMIT = 10
+SUGGEST_PREFIX_DEPTH = 6
+SUGGEST_KEY_LENGTH = 32
+SUGGEST_CHECK_INTERVAL = 5
+
+
+##  Fuzzy search of the catalog (api_product/trigrams.py)  ##
+
+# Product is found, if it has this share of trigrams of the query,
+# max number of found products
+FUZZY_MIN_SIMILARITY = 0.5
+FUZZY_CANDIDATES = 200
+
+
+##  Import of the catalog (api_product/catalog_io.py)  ##
+
+# Queued images of imported products: max size of the file (bytes), timeout
+# of download (seconds)
+IMAGE_IMPORT_MAX_BYTES = 5 * 1024 * 1024
+IMAGE_IMPORT_TIMEOUT = 10
+
+
+##  Snapshot of the catalog (api_product/snapshot.py)  ##
+
+# Memory-mapped file of the catalog, which is shared by workers (it is built by
+# command <build_catalog_snapshot>). Workers check the file once per interval
+# (seconds) and do not use the snapshot, which is older than max age (seconds).
+SNAPSHOT_PATH = str(DB_DIR / "catalog.snapshot")
+SNAPSHOT_CHECK_INTERVAL = 5
+SNAPSHOT_MAX_AGE = 3600
+
+
+##  Avatars of users (api_auth/avatars.py)  ##
+
+# Max size of the uploaded file (bytes), max number of pixels of the image
+# (decompression bombs), allowed formats (PIL)
+AVATAR_MAX_BYTES = 2 * 1024 * 1024
+AVATAR_MAX_PIXELS = 40_000_000
+AVATAR_FORMATS = ("JPEG", "PNG", "GIF", "WEBP")
+# Stored avatar: JPEG of this size (pixels) and quality, number of threads
+# of resizing per process
+AVATAR_SIZE = 256
+AVATAR_QUALITY = 85
+AVATAR_WORKERS = 2
+
+
+##  Preload (gunicorn)  ##
+
+# Tree of categories and tags, which are loaded in the master process of gunicorn
+# (see megano_store/gunicorn_hooks.py), are used during (seconds), version of them
+# (changes of categories and tags) is checked once per interval (seconds)
+PRELOAD_TTL = 7200
+PRELOAD_CHECK_INTERVAL = 5
@@ -0,0 +1,70 @@
+"""
+SQLite backend for production (several gunicorn workers use one database file).
+
+On every new connection PRAGMAs are applied (see DEFAULT_PRAGMAS):
+- journal_mode = WAL - readers do not block the writer and vice versa;
+- synchronous = NORMAL - it is safe in WAL mode, fsync only on checkpoint;
+- busy_timeout - wait for the lock instead of <database is locked> error;
+- cache_size, mmap_size, temp_store - less reads from disk.
+Transactions (<transaction.atomic>) start with <BEGIN IMMEDIATE>: the write lock
+is taken at the start of the transaction, so a transaction which has read data
+never fails to upgrade its lock in the middle (SQLite returns SQLITE_BUSY
+at once in this case, busy_timeout does not help).
+
+PRAGMAs can be changed in settings: DATABASES[alias]["OPTIONS"]["pragmas"].
+For read-only connection (<mode=ro> in NAME) journal mode is not changed
+(it is stored in the database file and set by the writer) and
+<query_only> is switched on.
+See benchmarks/sqlite_contention.py for comparison with the default setup.
+"""
+
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 20000,  # milliseconds
+    "cache_size": -32000,  # negative value - size in KiB (32 MB)
+    "mmap_size": 268435456,  # 256 MB
+    "temp_store": "MEMORY",
+}
+
+DEFAULT_TRANSACTION_MODE = "IMMEDIATE"
+
+
+def apply_pragmas(conn, pragmas: dict) -> None:
+    """
+    Execute PRAGMAs on the connection (it is used by the benchmark too).
+    :param conn: sqlite3.Connection
+    :param pragmas: dictionary {name: value}
+    :return: None
+    """
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = {**DEFAULT_PRAGMAS, **kwargs.pop("pragmas", {})}
+
+        if self.is_read_only():
+            self.pragmas.pop("journal_mode", None)
+            self.pragmas["query_only"] = "ON"
+
+        if self.transaction_mode is None:
+            self.transaction_mode = DEFAULT_TRANSACTION_MODE
+
+        # timeout of python module sqlite3 (seconds) - the same busy timeout
+        kwargs.setdefault("timeout", self.pragmas["busy_timeout"] / 1000)
+
+        return kwargs
+
+    def is_read_only(self) -> bool:
+        return "mode=ro" in str(self.settings_dict["NAME"])
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        apply_pragmas(conn, self.pragmas)
+        return conn
@@ -0,0 +1,88 @@
+"""
+Context of the request for the body of streamed responses.
+
+The iterators of StreamingHttpResponse (see streaming.py) execute queries after
+the view has returned, when middlewares have already left their blocks.
+<keep_context> sets the context variable of the middleware around every step
+of the iterator and calls <on_finish> after the last step or when the response
+is closed (the client has disconnected, the body was not read):
+    response = self.get_response(request)
+    if response.streaming:
+        return keep_context(response, _current, stats, on_finish)
+"""
+
+from contextvars import ContextVar
+
+
+class ContextIteratorBase:
+    """
+    Body of the response with the method <close>: Django calls it, when the
+    response is closed.
+    """
+
+    def __init__(self, content, var: ContextVar, value, on_finish):
+        self.content = content
+        self.var = var
+        self.value = value
+        self.on_finish = on_finish
+        self.finished = False
+
+    def close(self) -> None:
+        if not self.finished:
+            self.finished = True
+            self.on_finish()
+
+
+# the classes of sync and async bodies are separate: the response is async
+# only if its body is not iterable by <iter>
+class ContextIterator(ContextIteratorBase):
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = self.var.set(self.value)
+        try:
+            return next(self.content)
+        except StopIteration:
+            self.close()
+            raise
+        finally:
+            self.var.reset(token)
+
+
+class AsyncContextIterator(ContextIteratorBase):
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        token = self.var.set(self.value)
+        try:
+            return await anext(self.content)
+        except StopAsyncIteration:
+            self.close()
+            raise
+        finally:
+            self.var.reset(token)
+
+
+def keep_context(response, var: ContextVar, value, on_finish):
+    """
+    Iterate the body of the streamed response with <var> = <value>.
+    :param response: StreamingHttpResponse (sync or async body)
+    :param var: context variable of the middleware
+    :param value: value of the variable for the request
+    :param on_finish: function without arguments, it is called once, when the
+        body is sent or the response is closed
+    :return: the same response
+    """
+    if response.is_async:
+        response.streaming_content = AsyncContextIterator(
+            aiter(response.streaming_content), var, value, on_finish
+        )
+    else:
+        response.streaming_content = ContextIterator(
+            iter(response.streaming_content), var, value, on_finish
+        )
+    return response
@@ -0,0 +1,233 @@
+"""
+Streaming JSON responses for large lists (full catalog, sales).
+
+JsonResponse keeps the whole list of dictionaries and its encoded string in
+memory. <stream_json_list> iterates the queryset by chunks of STREAM_CHUNK_SIZE
+rows (<iterator(chunk_size)>: prefetched relations are loaded per chunk too),
+formats and encodes items one by one and sends them by pieces of
+STREAM_BUFFER_SIZE bytes:
+    {"items": [item, item, ...], <fields, which depend on number of items>}
+Memory of the worker is bounded by one chunk, not by the size of the catalog.
+
+- Under ASGI the response iterates the queryset asynchronously (<aiterator>),
+  under WSGI - synchronously: Django would read the whole iterator of another
+  kind into memory before sending.
+- Queries are executed while the response is sent (after the view has
+  returned), so the iterator enters <read_only_db> itself.
+- Encoded items are collected for the cache while their size is not more than
+  STREAM_CACHE_MAX_BYTES: cached list is sent as is (without encoding),
+  larger lists are not cached and are streamed from the database. The stale
+  list is sent, while <acache_json_list> refreshes it in the background
+  (see megano_store/caching.py).
+- <stream_encoded_list> sends items, which are encoded beforehand (snapshot
+  of the catalog, see api_product/snapshot.py).
+"""
+
+import json
+
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+
+from megano_store.caching import aget_entry, aset_entry, set_entry
+from megano_store.routers import read_only_db
+from megano_store.settings import (STREAM_BUFFER_SIZE, STREAM_CACHE_MAX_BYTES,
+                                   STREAM_CHUNK_SIZE)
+from megano_store.utils import write_errors
+
+HEAD = b'{"items": ['
+
+
+def encode(data) -> bytes:
+    """
+    Encode data the same way as JsonResponse does.
+    """
+    return json.dumps(data, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def encode_tail(fields: dict) -> bytes:
+    """
+    End of the list and other fields: b'], "currentPage": 1, "lastPage": 5}'
+    """
+    return b"], " + encode(fields)[1:] if fields else b"]}"
+
+
+class JsonListWriter:
+    """
+    Encoder of items of the list, which is shared by synchronous and
+    asynchronous iterators of the response.
+    """
+
+    def __init__(self, get_fields, cache_key: str = None):
+        self.get_fields = get_fields  # function(number of items) -> dictionary
+        self.cache_key = cache_key
+        self.count = 0
+        self.buffer = [HEAD]
+        self.buffer_size = len(HEAD)
+        self.cached = [] if cache_key else None  # encoded items
+        self.cached_size = 0
+
+    def add(self, item: dict) -> bytes | None:
+        """
+        :return: piece of the response, if the buffer is full
+        """
+        return self.add_encoded(encode(item))
+
+    def add_encoded(self, data: bytes) -> bytes | None:
+        if self.count:
+            data = b", " + data
+        self.count += 1
+
+        if self.cached is not None:
+            self.cached_size += len(data)
+            if self.cached_size <= STREAM_CACHE_MAX_BYTES:
+                self.cached.append(data)
+            else:  # too large for the cache
+                self.cached = None
+
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= STREAM_BUFFER_SIZE:
+            return self.flush()
+        return None
+
+    def flush(self) -> bytes:
+        data = b"".join(self.buffer)
+        self.buffer.clear()
+        self.buffer_size = 0
+        return data
+
+    def finish(self) -> bytes:
+        self.buffer.append(encode_tail(self.get_fields(self.count)))
+        return self.flush()
+
+    def get_cached(self) -> tuple | None:
+        """
+        :return: value for the cache (number of items, encoded items) or None
+        """
+        if self.cached is None:
+            return None
+        return self.count, b"".join(self.cached)
+
+    def write_error(self, exc: Exception) -> None:
+        # the status is already sent, the client gets incomplete JSON
+        write_errors({"StreamError": f"{type(exc).__name__} : {exc}",
+                      "cache_key": self.cache_key, "items": self.count},
+                     "errors_from_streaming.log")
+
+
+def iter_json_list(queryset: QuerySet, format_item, writer: JsonListWriter,
+                   timeout: int = None):
+    with read_only_db():
+        try:
+            for obj in queryset.iterator(chunk_size=STREAM_CHUNK_SIZE):
+                data = writer.add(format_item(obj))
+                if data:
+                    yield data
+        except Exception as exc:
+            writer.write_error(exc)
+            raise
+
+    yield writer.finish()
+
+    cached = writer.get_cached()
+    if cached is not None:
+        set_entry(writer.cache_key, cached, timeout)
+
+
+async def aiter_json_list(queryset: QuerySet, format_item, writer: JsonListWriter,
+                          timeout: int = None):
+    with read_only_db():
+        try:
+            async for obj in queryset.aiterator(chunk_size=STREAM_CHUNK_SIZE):
+                data = writer.add(format_item(obj))
+                if data:
+                    yield data
+        except Exception as exc:
+            writer.write_error(exc)
+            raise
+
+    yield writer.finish()
+
+    cached = writer.get_cached()
+    if cached is not None:
+        await aset_entry(writer.cache_key, cached, timeout)
+
+
+def iter_encoded_list(items, writer: JsonListWriter):
+    for item in items:
+        data = writer.add_encoded(item)
+        if data:
+            yield data
+
+    yield writer.finish()
+
+
+async def aiter_encoded_list(items, writer: JsonListWriter):
+    for data in iter_encoded_list(items, writer):
+        yield data
+
+
+def stream_json_list(request, queryset: QuerySet, format_item, get_fields,
+                     cache_key: str = None, timeout: int = None) -> StreamingHttpResponse:
+    """
+    Stream list of formatted objects of the queryset (see the top of the module).
+    :param request: HttpRequest (ASGI or WSGI)
+    :param queryset: queryset with prefetched relations
+    :param format_item: function(object) -> dictionary
+    :param get_fields: function(number of items) -> other fields of the response
+    :param cache_key: key of the cache (None - the list is not cached)
+    :param timeout: timeout of the cache (seconds)
+    :return: StreamingHttpResponse
+    """
+    writer = JsonListWriter(get_fields, cache_key)
+    if isinstance(request, ASGIRequest):
+        content = aiter_json_list(queryset, format_item, writer, timeout)
+    else:
+        content = iter_json_list(queryset, format_item, writer, timeout)
+    return StreamingHttpResponse(content, content_type="application/json", status=200)
+
+
+def stream_encoded_list(request, items, get_fields) -> StreamingHttpResponse:
+    """
+    Stream list of items, which are already encoded (memory-mapped snapshot of
+    the catalog), the database is not read.
+    :param items: iterable of encoded JSON objects (bytes)
+    :param get_fields: function(number of items) -> other fields of the response
+    :return: StreamingHttpResponse
+    """
+    writer = JsonListWriter(get_fields)
+    if isinstance(request, ASGIRequest):
+        content = aiter_encoded_list(items, writer)
+    else:
+        content = iter_encoded_list(items, writer)
+    return StreamingHttpResponse(content, content_type="application/json", status=200)
+
+
+async def acache_json_list(queryset: QuerySet, format_item, cache_key: str,
+                           timeout: int) -> None:
+    """
+    Encode the list and put it into the cache without the response (refresh of
+    the stale list, see <get_cached_json_list>).
+    """
+    writer = JsonListWriter(lambda count: {}, cache_key)
+    async for _ in aiter_json_list(queryset, format_item, writer, timeout):
+        pass
+
+
+async def get_cached_json_list(cache_key: str, get_fields,
+                               refresh=None) -> HttpResponse | None:
+    """
+    Response from the list, which is cached by <stream_json_list>.
+    :param refresh: coroutine function, which caches the list again, when it is
+        stale (for example, by <acache_json_list>)
+    :return: HttpResponse or None (the list is not in the cache)
+    """
+    cached = await aget_entry(cache_key, refresh)
+    if cached is None:
+        return None
+
+    count, items = cached
+    return HttpResponse(HEAD + items + encode_tail(get_fields(count)),
+                        content_type="application/json", status=200)
@@ -0,0 +1,23 @@
+"""
+Shared settings of tests of the apps (python manage.py test).
+
+Caches and sessions of the tests are in memory: the file based caches and the
+background writer of sessions (megano_store/sessions.py) are shared with the
+server. Usage:
+    @test_settings
+    class CatalogTest(TestCase):
+        ...
+"""
+
+from django.test import override_settings
+
+TEST_SETTINGS = {
+    "CACHES": {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "sessions": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                     "LOCATION": "sessions"},
+    },
+    "SESSION_ENGINE": "django.contrib.sessions.backends.cache",
+}
+
+test_settings = override_settings(**TEST_SETTINGS)
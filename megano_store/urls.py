@@ -20,12 +20,18 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from megano_store.media import protected_media_view
+from megano_store.metrics import metrics_view
+
 urlpatterns = [
     path("", include("frontend.urls")),
     path("admin/", admin.site.urls),
     path("api/", include("api_auth.urls")),
     path("api/", include("api_product.urls")),
     path("api/", include("api_order.urls")),
+    path("metrics", metrics_view, name="metrics"),
+    path(settings.MEDIA_PROTECTED_URL + "<path:name>", protected_media_view,
+         name="protected-media"),
 ]
 
 if settings.DEBUG:
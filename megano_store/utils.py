@@ -1,17 +1,18 @@
 
 import functools
 import json
-from datetime import datetime, timezone
-from os.path import join as join_path
 from sqlite3 import DatabaseError
 
+from asgiref.sync import iscoroutinefunction
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db.models import QuerySet
+from django.db import connection
+from django.db.models import F, Model, QuerySet
 from django.http import JsonResponse
 
 from api_product.models import Product
-from megano_store.settings import DEBUG, DEBUG_DIR
+from megano_store.errorlog import log_errors
+from megano_store.settings import DEBUG
 
 User = get_user_model()
 
@@ -39,42 +40,47 @@ def format_queryset_to_list(products: QuerySet, count_for_cart_order=None) -> li
     :param count_for_cart_order: count of products (dictionary - {id: quantity})
     :return: list of dictionary (SHORT description of product)
     """
-    products_list = []
-
-    for product in products:
-
-        images_list = []
-        for item in product.images.all():
-            images_list.append({"src": item.image.url if item.image else "",
-                                "alt": item.description})
-        tags_list = []
-        for item in product.tags.all():
-            tags_list.append({"id": item.pk, "name": item.value})
-
-        data = {
-            "id": product.pk,
-            "category": product.category.pk,
-            "title": product.title,
-            "description": product.description_short,
-            "price": product.price,
-            "freeDelivery": product.free_delivery,
-            "date": product.created_at,
-            "rating": product.rating,
-            "images": images_list,
-            "tags": tags_list,
-            "reviews": product.reviews_count
-            # field <reviews_count> must be added to products queryset:
-            # products = products.annotate(reviews_count=Count("reviews"))
-        }
-        if isinstance(count_for_cart_order, dict):
-            data["count"] = count_for_cart_order[str(product.pk)]
-            # find required product and its quantity in <count_for_cart_order>
-        else:
-            data["count"] = product.count
-
-        products_list.append(data)
-
-    return products_list
+    return [format_product_to_dict(product, count_for_cart_order) for product in products]
+
+
+def format_product_to_dict(product: Product, count_for_cart_order=None) -> dict:
+    """
+    Format one product of the list (see <format_queryset_to_list> above),
+    it is used by streaming responses too (megano_store/streaming.py).
+    :param product: instance of Product (images and tags are prefetched)
+    :param count_for_cart_order: count of products (dictionary - {id: quantity})
+    :return: dictionary (SHORT description of product)
+    """
+    images_list = []
+    for item in product.images.all():
+        images_list.append({"src": item.image.url if item.image else "",
+                            "alt": item.description})
+    tags_list = []
+    for item in product.tags.all():
+        tags_list.append({"id": item.pk, "name": item.value})
+
+    data = {
+        "id": product.pk,
+        "category": product.category_id,
+        "title": product.title,
+        "description": product.description_short,
+        "price": product.price,
+        "freeDelivery": product.free_delivery,
+        "date": product.created_at,
+        "rating": product.rating,
+        "images": images_list,
+        "tags": tags_list,
+        "reviews": product.reviews_count
+        # field <reviews_count> must be added to products queryset:
+        # products = products.annotate(reviews_count=Count("reviews"))
+    }
+    if isinstance(count_for_cart_order, dict):
+        data["count"] = count_for_cart_order[str(product.pk)]
+        # find required product and its quantity in <count_for_cart_order>
+    else:
+        data["count"] = product.count
+
+    return data
 
 
 def format_instance_to_dict(product: Product) -> dict:
@@ -107,7 +113,7 @@ def format_instance_to_dict(product: Product) -> dict:
 
     data = {
         "id": product.pk,
-        "category": product.category.pk,
+        "category": product.category_id,
         "title": product.title,
         "description": product.description_short,
         "count": product.count,
@@ -124,31 +130,129 @@ def format_instance_to_dict(product: Product) -> dict:
     return data
 
 
+def add_increments(model: type[Model], key_fields: list, rows: dict) -> None:
+    """
+    Add increments to rows of the table by one statement for a batch of rows:
+    INSERT ... ON CONFLICT (<key_fields>) DO UPDATE SET field = field + excluded.field
+    (the rows, which do not exist, are created with the increments).
+    <key_fields> must be a unique constraint of the model. NULL does not conflict
+    with other NULLs, so rows with NULL in the key are updated one by one.
+    :param model: model
+    :param key_fields: names of fields of the unique constraint
+    :param rows: dictionary {tuple of values of <key_fields>: {field: increment}},
+      all rows have the same fields of increments
+    :return: None
+    """
+    if not rows:
+        return
+
+    increment_fields = list(next(iter(rows.values())))
+    fields = [model._meta.get_field(name) for name in key_fields + increment_fields]
+    quote = connection.ops.quote_name
+
+    params = []
+    for key, increments in rows.items():
+        if None in key:
+            lookup = dict(zip(key_fields, key))
+            updated = model.objects.filter(**lookup).update(
+                **{name: F(name) + value for name, value in increments.items()}
+            )
+            if not updated:
+                model.objects.create(**lookup, **increments)
+            continue
+
+        values = [*key, *(increments[name] for name in increment_fields)]
+        params.append([field.get_db_prep_save(value, connection)
+                       for field, value in zip(fields, values)])
+
+    sql = "INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) DO UPDATE SET {}"
+    columns = [quote(field.column) for field in fields]
+    update = ", ".join("{0} = {0} + excluded.{0}".format(column)
+                       for column in columns[len(key_fields):])
+    batch_size = connection.features.max_query_params // len(fields)
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(params), batch_size):
+            batch = params[i:i + batch_size]
+            cursor.execute(sql.format(
+                quote(model._meta.db_table), ", ".join(columns),
+                ", ".join(["({})".format(", ".join(["%s"] * len(fields)))] * len(batch)),
+                ", ".join(columns[:len(key_fields)]), update
+            ), [value for row in batch for value in row])
+
+
 def write_errors(errors: dict, file_name: str) -> None:
     """
-    This function is used to write errors into file:
+    This function is used to write errors into file (through the queue of
+    megano_store/errorlog.py, so the request does not wait for the disk):
     - 'errors_from_exc.log' - for arisen built-in and sqlite3 exceptions;
     - 'errors_from_if.log' - for errors, what are defined into 'if-else' statement.
     :param errors: dictionary of errors;
     :param file_name: string - name of log file;
     :return: None.
     """
-    path_full = join_path(DEBUG_DIR, file_name)
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d, %H:%M, %Z")
+    log_errors(errors, file_name)
+
+
+def handle_exception(exc: Exception) -> JsonResponse:
+    """
+    Collect errors of arisen exception, write them to the file 'errors_from_exc.log'
+    in JSON format and compose response.
+    :param exc: arisen exception
+    :return: JsonResponse
+    """
+    errors = {}
+
+    if isinstance(exc, ValidationError):
+        for j, item in enumerate(exc, start=1):
+            errors["Password_Error_" + str(j)] = item
+        status = 400
+
+    elif isinstance(exc, json.JSONDecodeError):
+        errors["JSON_Error"] = str(exc)
+        status = 400
+
+    elif isinstance(exc, (AttributeError, TypeError)):
+        errors["Data_Error"] = type(exc).__name__ + " : " + str(exc)
+        status = 400
+
+    elif isinstance(exc, ValueError):
+        errors["AssignValue_Error"] = type(exc).__name__ + " : " + str(exc)
+        status = 400
+
+    elif isinstance(exc, DatabaseError):
+        errors["DataBase_Error"] = type(exc).__name__ + " : " + str(exc)
+        status = 500
+
+    else:
+        errors["Unexpected_Error"] = type(exc).__name__ + " : " + str(exc)
+        status = 500
 
-    with open(path_full, mode="a", encoding="utf-8") as logfile:
-        logfile.write("\n" + timestamp + "\n")
-        json.dump(errors, logfile, ensure_ascii=False, indent=4)
-        logfile.write("\n")
+    write_errors(errors, "errors_from_exc.log")
+
+    return JsonResponse(errors, status=status)
 
 
 def exception_handler(func):
     """
     This decorator is handler of arisen built-in and sqlite3 exceptions,
-    it collects and writes errors to the file 'errors_from_exc.log' in JSON format.
+    it collects and writes errors to the file 'errors_from_exc.log' in JSON format
+    (see function <handle_exception> above).
+    Synchronous and asynchronous views are supported.
     :param func: function from <views.py>
     :return:
     """
+    if iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as exc:
+                return handle_exception(exc)
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
 
@@ -156,37 +260,7 @@ def exception_handler(func):
             return func(*args, **kwargs)
 
         except Exception as exc:
-
-            errors = {}
-
-            if isinstance(exc, ValidationError):
-                for j, item in enumerate(exc, start=1):
-                    errors["Password_Error_" + str(j)] = item
-                status = 400
-
-            elif isinstance(exc, json.JSONDecodeError):
-                errors["JSON_Error"] = str(exc)
-                status = 400
-
-            elif isinstance(exc, (AttributeError, TypeError)):
-                errors["Data_Error"] = type(exc).__name__ + " : " + str(exc)
-                status = 400
-
-            elif isinstance(exc, ValueError):
-                errors["AssignValue_Error"] = type(exc).__name__ + " : " + str(exc)
-                status = 400
-
-            elif isinstance(exc, DatabaseError):
-                errors["DataBase_Error"] = type(exc).__name__ + " : " + str(exc)
-                status = 500
-
-            else:
-                errors["Unexpected_Error"] = type(exc).__name__ + " : " + str(exc)
-                status = 500
-
-            write_errors(errors, "errors_from_exc.log")
-
-            return JsonResponse(errors, status=status)
+            return handle_exception(exc)
 
     return wrapper
 
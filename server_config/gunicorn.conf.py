@@ -1,7 +1,25 @@
 
+# WSGI deployment (megano_store.wsgi:application, see gunicorn_megano_wsgi.service):
+# async views of api_product are called through async_to_sync, the worker is
+# blocked until the view returns. The service uses gunicorn_asgi.conf.py.
 bind = "unix:/run/gunicorn_megano.sock"
 workers = 3
 timeout = 30
 accesslog = "/var/log/gunicorn/megano_access.log"
 errorlog = "/var/log/gunicorn/megano_error.log"
 loglevel = "warning"
+
+# The application is imported once in the master process, workers are forked
+# with models, URL patterns and catalog already in memory (see hooks below).
+# Note: with preload the code is not reloaded by HUP signal - restart the service.
+preload_app = True
+
+
+def on_starting(server):
+    from megano_store.gunicorn_hooks import warm_up_master
+    warm_up_master(server)
+
+
+def post_fork(server, worker):
+    from megano_store.gunicorn_hooks import reset_worker
+    reset_worker(server, worker)
@@ -0,0 +1,24 @@
+
+# ASGI deployment (megano_store.asgi:application, see gunicorn_megano.service):
+# async views of api_product are served by the event loop of the worker,
+# synchronous views (orders, auth) - by the thread pool of the worker.
+bind = "unix:/run/gunicorn_megano.sock"
+workers = 3
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 30
+accesslog = "/var/log/gunicorn/megano_access.log"
+errorlog = "/var/log/gunicorn/megano_error.log"
+loglevel = "warning"
+
+# See gunicorn.conf.py.
+preload_app = True
+
+
+def on_starting(server):
+    from megano_store.gunicorn_hooks import warm_up_master
+    warm_up_master(server)
+
+
+def post_fork(server, worker):
+    from megano_store.gunicorn_hooks import reset_worker
+    reset_worker(server, worker)